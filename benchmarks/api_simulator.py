@@ -0,0 +1,388 @@
+# A local stand-in for the endpoints of the Hetzner Cloud API that hetzner_snap_and_rotate uses:
+# paginated and filtered 'servers' and 'images', 'servers/{id}', 'servers/{id}/actions/{command}',
+# 'actions' and 'actions/{id}', and PUT/DELETE 'images/{id}'.
+#
+# Latency, page size, action durations, injected 423/429 responses and the
+# 'RateLimit-*' budget are configurable. Requests are counted by method, endpoint and status.
+#
+# Usage: python benchmarks/api_simulator.py [--port 8080] [--servers 10] [--snapshots 20] [...]
+#        then set "api-url": "http://localhost:8080/v1/" in the configuration file
+
+import json
+import math
+import random
+import threading
+import time
+
+from argparse import ArgumentParser
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+from urllib.parse import parse_qs, urlsplit
+
+from hetzner_snap_and_rotate.config import matches_label_selector
+from hetzner_snap_and_rotate.metrics import endpoint
+
+
+@dataclass(kw_only=True)
+class Settings:
+
+    # Delay (in s) added to each response
+    latency: float = 0
+
+    # Maximum number of entities per page
+    page_size: int = 50
+
+    # Time (in s) until an action completes, by command
+    action_durations: dict[str, float] = field(default_factory=lambda: {
+        'poweron': 1, 'shutdown': 1, 'poweroff': 0.5, 'create_image': 3
+    })
+
+    # Fractions of server actions that are rejected as locked (423),
+    # and of all requests that are rejected as rate-limited (429)
+    locked_rate: float = 0
+    throttled_rate: float = 0
+
+    # Requests per hour, refilled continuously like the Hetzner API; None disables rate limiting
+    rate_limit: Optional[int] = 3600
+
+    seed: int = 0
+
+
+class Reject(Exception):
+
+    def __init__(self, status: int, code: str, message: str):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+
+
+def timestamp(t: datetime) -> str:
+    return t.isoformat(timespec='seconds')
+
+
+class Simulator:
+
+    def __init__(self, settings: Settings = None):
+        self.settings = settings or Settings()
+        self.lock = threading.Lock()
+        self.random = random.Random(self.settings.seed)
+
+        self.servers: dict[int, dict] = {}
+        self.images: dict[int, dict] = {}
+        self.actions: dict[int, dict] = {}
+
+        # Effects of running actions, applied when they complete: action id -> (completion time, effect)
+        self.pending: dict[int, tuple[float, Callable[[], None]]] = {}
+
+        self.next_image_id = 1000000
+        self.next_action_id = 1
+
+        self.tokens = float(self.settings.rate_limit or 0)
+        self.refilled = time.time()
+
+        self.requests: Counter = Counter()
+        self.http_server: Optional[ThreadingHTTPServer] = None
+
+    def add_server(self, name: str, labels: dict = None, status: str = 'running') -> dict:
+        with self.lock:
+            srv = {'id': len(self.servers) + 1, 'name': name, 'status': status, 'labels': labels or {}}
+            self.servers[srv['id']] = srv
+            return srv
+
+    def add_snapshot(self, server: dict, description: str, created: datetime,
+                     labels: dict = None, protected: bool = False) -> dict:
+        with self.lock:
+            return self.new_image(server, description, created, labels, protected, 'available')
+
+    def new_image(self, server: dict, description: str, created: datetime,
+                  labels: Optional[dict], protected: bool, status: str) -> dict:
+        img = {
+            'id': self.next_image_id,
+            'type': 'snapshot',
+            'status': status,
+            'name': None,
+            'description': description,
+            'image_size': None,
+            'disk_size': 40,
+            'created': created,
+            'created_from': {'id': server['id'], 'name': server['name']},
+            'protection': {'delete': protected},
+            'labels': labels or {},
+        }
+
+        self.next_image_id += 1
+        self.images[img['id']] = img
+        return img
+
+    # Completes the actions whose duration has elapsed; expects the lock to be held
+    def settle(self, now: float):
+        for action_id, (done_at, effect) in list(self.pending.items()):
+            if done_at <= now:
+                action = self.actions[action_id]
+                action.update(status='success', progress=100,
+                              finished=datetime.fromtimestamp(done_at, tz=timezone.utc))
+                effect()
+                del self.pending[action_id]
+
+    # Token bucket like the one of the API; expects the lock to be held
+    def rate_limit_headers(self, now: float) -> dict[str, str]:
+        limit = self.settings.rate_limit
+        if limit is None:
+            return {}
+
+        self.tokens = min(limit, self.tokens + (now - self.refilled) * limit / 3600)
+        self.refilled = now
+
+        if self.tokens < 1:
+            raise Reject(429, 'rate_limit_exceeded', 'rate limit exceeded')
+
+        self.tokens -= 1
+        return {
+            'RateLimit-Limit': str(limit),
+            'RateLimit-Remaining': str(int(self.tokens)),
+            'RateLimit-Reset': str(int(now + (limit - self.tokens) * 3600 / limit)),
+        }
+
+    def page(self, name: str, entities: list, query: dict) -> dict:
+        per_page = max(1, min(int(query.get('per_page', ['25'])[0]), self.settings.page_size))
+        page = int(query.get('page', ['1'])[0])
+        last_page = max(1, math.ceil(len(entities) / per_page))
+
+        return {
+            name: entities[(page - 1) * per_page:page * per_page],
+            'meta': {'pagination': {
+                'page': page,
+                'per_page': per_page,
+                'previous_page': page - 1 if page > 1 else None,
+                'next_page': page + 1 if page < last_page else None,
+                'last_page': last_page,
+                'total_entries': len(entities),
+            }}
+        }
+
+    def start_action(self, command: str, server: dict, effect: Callable[[], None]) -> dict:
+        now = time.time()
+        action = {
+            'id': self.next_action_id,
+            'command': command,
+            'status': 'running',
+            'progress': 0,
+            'started': datetime.fromtimestamp(now, tz=timezone.utc),
+            'finished': None,
+            'resources': [{'id': server['id'], 'type': 'server'}],
+            'error': None,
+        }
+
+        self.next_action_id += 1
+        self.actions[action['id']] = action
+        self.pending[action['id']] = (now + self.settings.action_durations.get(command, 1), effect)
+        return action
+
+    def server_action(self, server: dict, command: str, data: dict) -> dict:
+        if self.random.random() < self.settings.locked_rate:
+            raise Reject(423, 'locked', f'server {server["id"]} is locked')
+
+        if command == 'create_image':
+            img = self.new_image(server, data.get('description'), datetime.now(tz=timezone.utc),
+                                 data.get('labels'), False, 'creating')
+            action = self.start_action(command, server, lambda: img.update(status='available'))
+            return {'action': action, 'image': img}
+
+        status = {'poweron': 'running', 'shutdown': 'off', 'poweroff': 'off'}.get(command)
+        if status is None:
+            raise Reject(404, 'not_found', f'unsupported action {command}')
+
+        return {'action': self.start_action(command, server, lambda: server.update(status=status))}
+
+    def lookup(self, entities: dict[int, dict], kind: str, entity_id: str) -> dict:
+        entity = entities.get(int(entity_id))
+        if entity is None:
+            raise Reject(404, 'not_found', f'{kind} with ID {entity_id} not found')
+
+        return entity
+
+    # Filters by the 'name', 'type' and 'label_selector' parameters and sorts the entities
+    @staticmethod
+    def listing(entities: dict[int, dict], query: dict) -> list[dict]:
+        selected = [
+            e for e in entities.values()
+            if all(e.get(p) in query[p] for p in ['name', 'type'] if p in query)
+            and all(matches_label_selector(s, e['labels']) for s in query.get('label_selector', []))
+        ]
+
+        for sort in query.get('sort', []):
+            key, _, order = sort.partition(':')
+            selected.sort(key=lambda e: e[key], reverse=(order == 'desc'))
+
+        return selected
+
+    # Returns the HTTP status and the response body of a request; expects the lock to be held
+    def handle(self, method: str, path: str, query: dict, data: dict) -> tuple[int, dict]:
+        match method, path.split('/'):
+            case 'GET', ['servers']:
+                return 200, self.page('servers', self.listing(self.servers, query), query)
+
+            case 'GET', ['servers', server_id]:
+                return 200, {'server': self.lookup(self.servers, 'server', server_id)}
+
+            case 'POST', ['servers', server_id, 'actions', command]:
+                return 201, self.server_action(self.lookup(self.servers, 'server', server_id), command, data)
+
+            case 'GET', ['images']:
+                return 200, self.page('images', self.listing(self.images, query), query)
+
+            case 'PUT', ['images', image_id]:
+                img = self.lookup(self.images, 'image', image_id)
+                img.update((k, v) for k, v in data.items() if k in ['description', 'labels'])
+                return 200, {'image': img}
+
+            case 'DELETE', ['images', image_id]:
+                img = self.lookup(self.images, 'image', image_id)
+                if img['protection']['delete']:
+                    raise Reject(423, 'protected', f'image {image_id} is protected')
+
+                del self.images[img['id']]
+                return 204, {}
+
+            case 'GET', ['actions']:
+                ids = {int(i) for i in query.get('id', [])}
+                return 200, self.page('actions', [a for a in self.actions.values() if a['id'] in ids], query)
+
+            case 'GET', ['actions', action_id]:
+                return 200, {'action': self.lookup(self.actions, 'action', action_id)}
+
+        raise Reject(404, 'not_found', f'{method} {path} is not supported')
+
+    def serve(self, port: int = 0, address: str = '127.0.0.1') -> str:
+        simulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+
+            def respond(self, method: str):
+                url = urlsplit(self.path)
+                path = url.path.removeprefix('/v1/').strip('/')
+                query = parse_qs(url.query)
+
+                length = int(self.headers.get('Content-Length') or 0)
+                data = json.loads(self.rfile.read(length) or b'{}') if length else {}
+
+                time.sleep(simulator.settings.latency)
+                headers = {}
+
+                with simulator.lock:
+                    now = time.time()
+
+                    try:
+                        headers = simulator.rate_limit_headers(now)
+                        if simulator.random.random() < simulator.settings.throttled_rate:
+                            raise Reject(429, 'rate_limit_exceeded', 'rate limit exceeded (injected)')
+
+                        simulator.settle(now)
+                        status, body = simulator.handle(method, path, query, data)
+
+                    except Reject as ex:
+                        status, body = ex.status, {'error': {'code': ex.code, 'message': str(ex)}}
+
+                    except (ValueError, KeyError) as ex:
+                        status, body = 400, {'error': {'code': 'invalid_input', 'message': repr(ex)}}
+
+                    simulator.requests[f'{method} {endpoint(path)} {status}'] += 1
+                    content = json.dumps(body, default=timestamp).encode() if status != 204 else b''
+
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                self.respond('GET')
+
+            def do_POST(self):
+                self.respond('POST')
+
+            def do_PUT(self):
+                self.respond('PUT')
+
+            def do_DELETE(self):
+                self.respond('DELETE')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.http_server = ThreadingHTTPServer((address, port), Handler)
+        self.http_server.daemon_threads = True
+        threading.Thread(target=self.http_server.serve_forever, name='simulator', daemon=True).start()
+
+        return f'http://{address}:{self.http_server.server_port}/v1/'
+
+    def shutdown(self):
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.http_server = None
+
+
+# Adds `count` servers with `snapshots` hourly snapshots each, the newest one an hour old
+def populate(simulator: Simulator, count: int, snapshots: int, labels: dict = None):
+    now = datetime.now(tz=timezone.utc).replace(microsecond=0)
+
+    for i in range(1, count + 1):
+        srv = simulator.add_server(f'server-{i}')
+        for j in range(snapshots, 0, -1):
+            created = now - timedelta(hours=j)
+            simulator.add_snapshot(srv, f'{srv["name"]}_{created:%Y-%m-%d_%H:%M:%S}', created, labels)
+
+
+def add_arguments(parser: ArgumentParser):
+    defaults = Settings()
+    parser.add_argument('--servers', type=int, default=10, help='number of servers, default: 10')
+    parser.add_argument('--snapshots', type=int, default=20, help='snapshots per server, default: 20')
+    parser.add_argument('--latency', type=float, default=defaults.latency, help='response delay (in s)')
+    parser.add_argument('--page-size', type=int, default=defaults.page_size, help='max. entities per page')
+    parser.add_argument('--action-duration', type=float, default=None,
+                        help='duration (in s) of all actions, default: 1 s, 3 s for create_image')
+    parser.add_argument('--locked-rate', type=float, default=defaults.locked_rate,
+                        help='fraction of server actions answered with 423')
+    parser.add_argument('--throttled-rate', type=float, default=defaults.throttled_rate,
+                        help='fraction of requests answered with 429')
+    parser.add_argument('--rate-limit', type=int, default=defaults.rate_limit,
+                        help='requests per hour, 0 disables the RateLimit-* headers, default: 3600')
+
+
+def settings(options) -> Settings:
+    s = Settings(latency=options.latency, page_size=options.page_size, locked_rate=options.locked_rate,
+                 throttled_rate=options.throttled_rate, rate_limit=options.rate_limit or None)
+    if options.action_duration is not None:
+        s.action_durations = {c: options.action_duration for c in s.action_durations}
+
+    return s
+
+
+def main():
+    parser = ArgumentParser(description='Serves a simulated Hetzner Cloud API')
+    parser.add_argument('--port', type=int, default=8080, help='default: 8080')
+    add_arguments(parser)
+    options = parser.parse_args()
+
+    simulator = Simulator(settings(options))
+    populate(simulator, options.servers, options.snapshots)
+    print(f'Serving {options.servers} servers at {simulator.serve(options.port)}, press Ctrl-C to stop')
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        for request, count in sorted(simulator.requests.items()):
+            print(f'{count:8} {request}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# Compares the former decoding path (regex timestamp sanitizing and dataclass_wizard)
+# with hetzner_snap_and_rotate.decoding on a synthetic page of 5,000 images.
+#
+# Usage: python benchmarks/bench_decoding.py [image_count] [repetitions]
+
+import json
+import os
+import sys
+
+from timeit import repeat
+
+from hetzner_snap_and_rotate.config import Config, set_default_config
+from hetzner_snap_and_rotate.decoding import decode, loads
+from hetzner_snap_and_rotate.snapshots import Snapshots
+
+# The former decoding path is kept with the tests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tests.reference import former_decode_snapshots  # noqa: E402
+
+
+# The command line of this benchmark is not meant for hetzner_snap_and_rotate.config
+set_default_config(Config(api_token='unused'))
+
+
+def payload(count: int) -> bytes:
+    images = [
+        {
+            'id': 1000000 + i,
+            'type': 'snapshot',
+            'status': 'available',
+            'name': None,
+            'description': f'server-{i % 80}_daily#{i % 7}_2025-07-01_12:34:56',
+            'image_size': 2.3,
+            'disk_size': 40,
+            'created': f'2025-07-{1 + i % 28:02}T12:34:{i % 60:02}.{i % 1000}Z',
+            'created_from': {'id': 4000 + i % 80, 'name': f'server-{i % 80}'},
+            'bound_to': None,
+            'os_flavor': 'ubuntu',
+            'os_version': '24.04',
+            'rapid_deploy': False,
+            'protection': {'delete': False},
+            'deprecated': None,
+            'deleted': None,
+            'labels': {'VERSION': '1.2.3', 'managed-by': 'snap-and-rotate'},
+            'architecture': 'x86',
+        }
+        for i in range(count)
+    ]
+
+    return json.dumps({
+        'images': images,
+        'meta': {'pagination': {'page': 1, 'per_page': count, 'next_page': None, 'last_page': 1}}
+    }).encode()
+
+
+def main(count: int = 5000, repetitions: int = 5):
+    content = payload(count)
+
+    def old():
+        return former_decode_snapshots(content.decode())
+
+    def new():
+        return decode(Snapshots, content)
+
+    assert old() == new()
+
+    print(f'{count} images, {len(content) / 1024:.0f} KiB, JSON parser: {loads.__module__}')
+    for name, fn in [('dataclass_wizard', old), ('decoding', new)]:
+        best = min(repeat(fn, number=1, repeat=repetitions))
+        print(f'{name:>16}: {best * 1000:8.1f} ms ({best / count * 1e6:.1f} us/image)')
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]])
@@ -0,0 +1,90 @@
+# Runs the command line interface of hetzner_snap_and_rotate against benchmarks/api_simulator.py
+# with N servers having M snapshots each, and reports the wall time and the API requests by endpoint.
+# Each server is shut down, snapshotted, restarted and has its snapshots rotated.
+#
+# Usage: python benchmarks/bench_end_to_end.py [--servers 10] [--snapshots 20] [--max-parallelism 4]
+#        [--latency 0.05] [--page-size 50] [--action-duration 1] [--locked-rate 0.1] [--throttled-rate 0.05]
+#        [--rate-limit 3600] [--early-restart] [--rotation-labels] [--cli-option=...]
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from argparse import ArgumentParser
+
+from api_simulator import Simulator, add_arguments, populate, settings
+
+
+def write_config(path: str, api_url: str, server_names: list[str], early_restart: bool, rotation_labels: bool):
+    content = {
+        'api-token': 'simulated',
+        'api-url': api_url,
+        'defaults': {
+            'create-snapshot': True,
+            'snapshot-timeout': 120,
+            # Names are not changed by rotation with rotation labels
+            'snapshot-name': ('{server}_{timestamp:%Y-%m-%d_%H:%M:%S}' if rotation_labels
+                              else '{server}_{period_type}#{period_number}_{timestamp:%Y-%m-%d_%H:%M:%S}'),
+            'shutdown-and-restart': True,
+            'early-restart': early_restart,
+            'shutdown-timeout': 30,
+            'rotate': True,
+            'rotation-labels': rotation_labels,
+            'hourly': 6,
+            'daily': 7,
+            'weekly': 4,
+        },
+        'servers': {name: {} for name in server_names},
+    }
+
+    with open(path, 'w') as f:
+        json.dump(content, f)
+
+
+def main():
+    parser = ArgumentParser(description='Runs hetzner_snap_and_rotate against a simulated API')
+    add_arguments(parser)
+    parser.add_argument('-P', '--max-parallelism', type=int, default=1, help='passed to the CLI, default: 1')
+    parser.add_argument('--early-restart', action='store_true', help='restart servers before snapshots complete')
+    parser.add_argument('--rotation-labels', action='store_true', help='label snapshots instead of renaming them')
+    parser.add_argument('--cli-option', action='append', default=[], help='additional CLI option, repeatable')
+    options = parser.parse_args()
+
+    simulator = Simulator(settings(options))
+    populate(simulator, options.servers, options.snapshots)
+    snapshots_before = len(simulator.images)
+    api_url = simulator.serve()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_path = os.path.join(tmp_dir, 'config.json')
+        write_config(config_path, api_url, [srv['name'] for srv in simulator.servers.values()],
+                     options.early_restart, options.rotation_labels)
+
+        command = [sys.executable, '-m', 'hetzner_snap_and_rotate', '--config', config_path,
+                   '--max-parallelism', str(options.max_parallelism), *options.cli_option]
+
+        start = time.monotonic()
+        completed = subprocess.run(command, capture_output=True, text=True)
+        wall_time = time.monotonic() - start
+
+    simulator.shutdown()
+
+    if completed.returncode != 0:
+        print(completed.stdout, completed.stderr, sep='', file=sys.stderr)
+
+    print(f'{options.servers} servers x {options.snapshots} snapshots, '
+          f'parallelism {options.max_parallelism}, latency {options.latency * 1000:.0f} ms')
+    print(f'exit status {completed.returncode}, wall time {wall_time:.2f} s, '
+          f'snapshots {snapshots_before} -> {len(simulator.images)}')
+    print(f'{sum(simulator.requests.values()):8} requests')
+    for request, count in sorted(simulator.requests.items()):
+        print(f'{count:8} {request}')
+
+    sys.exit(completed.returncode)
+
+
+if __name__ == '__main__':
+    main()
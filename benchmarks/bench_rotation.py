@@ -0,0 +1,49 @@
+# Compares rotate() with the former implementation that scanned all snapshots
+# for every period, on quarter-hourly snapshots with all seven period types configured.
+#
+# Usage: python benchmarks/bench_rotation.py [snapshot_count] [repetitions]
+
+import os
+import sys
+
+from datetime import datetime, timedelta, timezone
+from timeit import repeat
+
+from hetzner_snap_and_rotate.rotation import rotate
+from hetzner_snap_and_rotate.config import Config, set_default_config
+from hetzner_snap_and_rotate.periods import Period
+from hetzner_snap_and_rotate.servers import Server
+from hetzner_snap_and_rotate.snapshots import Snapshot, Protection
+
+# The former implementation is kept with the tests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tests.reference import former_rotate  # noqa: E402
+
+
+# The command line of this benchmark is not meant for hetzner_snap_and_rotate.config
+set_default_config(Config(api_token='unused'))
+
+
+def main(count: int = 10000, repetitions: int = 3):
+    config = Config.Defaults(quarter_hourly=96, hourly=48, daily=60, weekly=52, monthly=24, quarter_yearly=8, yearly=10)
+    p_end = datetime(2025, 7, 1, tzinfo=timezone.utc)
+    server = Server(id=1, name='server')
+
+    snapshots = [
+        Snapshot(id=i, description='', protection=Protection(), created_from=server,
+                 created=p_end - timedelta(minutes=15 * i + 1))
+        for i in range(count)
+    ]
+
+    expected = former_rotate(config, list(snapshots), p_end)
+    assert [(id(s), v) for s, v in expected.items()] == [(id(s), v) for s, v in rotate(config, list(snapshots), p_end).items()]
+
+    print(f'{count} snapshots, {sum(getattr(config, p.config_name) for p in Period)} slots, '
+          f'{len(expected)} snapshots retained')
+    for name, fn in [('former', former_rotate), ('rotate', rotate)]:
+        best = min(repeat(lambda: fn(config, list(snapshots), p_end), number=1, repeat=repetitions))
+        print(f'{name:>8}: {best * 1000:9.1f} ms')
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]])
@@ -1,128 +1,334 @@
 import sys
+import time
 
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 from datetime import datetime, timezone
-from syslog import LOG_DEBUG, LOG_ERR
+from syslog import LOG_DEBUG, LOG_ERR, LOG_NOTICE, LOG_WARNING
 from traceback import format_exc
-from typing import Dict, Tuple, Optional
-
-from hetzner_snap_and_rotate.config import Config
-from hetzner_snap_and_rotate.logger import log
-from hetzner_snap_and_rotate.periods import Period
-from hetzner_snap_and_rotate.servers import Servers, ServerStatus
-from hetzner_snap_and_rotate.snapshots import Snapshots, create_snapshot, Snapshot
+from typing import Optional
+
+from hetzner_snap_and_rotate import metrics
+from hetzner_snap_and_rotate.api import connection_stats
+from hetzner_snap_and_rotate.config import activate, bind_context, config
+from hetzner_snap_and_rotate.daemon import Daemon
+from hetzner_snap_and_rotate.durations import duration_history
+from hetzner_snap_and_rotate.inventory import Inventory
+from hetzner_snap_and_rotate.logger import enabled, log, log_tag
+from hetzner_snap_and_rotate.polling import polling_metrics
+from hetzner_snap_and_rotate.rotation import Operation, RotationPlan, plan_rotation, plan_migration, execute_plan
+from hetzner_snap_and_rotate.servers import Server, ServerAction, Servers, ServerStatus
+from hetzner_snap_and_rotate.snapshots import (
+    Snapshots, SnapshotListing, PendingSnapshot, begin_snapshot, create_snapshot
+)
+
+
+def log_snapshots(srv: Server, when: str):
+    if not enabled(LOG_DEBUG):
+        return
+
+    sn_len = len(srv.snapshots)
+    log('Server [%s]: %d snapshot%s %s rotation', LOG_DEBUG, srv.name, sn_len, 's'[:sn_len!=1], when,
+        server=srv.name)
+    for i, sn in enumerate(srv.snapshots, start=1):
+        log('%3d. %s', LOG_DEBUG, i, sn.description, server=srv.name, snapshot_id=sn.id)
+
+
+# Awaits a pending snapshot by `background` if specified or else right away
+def await_snapshot(pending: PendingSnapshot, background: Optional[Executor]) -> Future:
+    if background is not None:
+        return background.submit(bind_context(pending.wait))
+
+    completion = Future()
+    try:
+        completion.set_result(pending.wait())
+    except Exception as ex:
+        completion.set_exception(ex)
 
+    return completion
 
-# Associates snapshots with their Period type ('latest' if the Period is None) and number
-Rotated = Dict[Snapshot, Tuple[Optional[Period], int]]
 
+# Snapshots that are completed after an early restart are awaited by `background` if specified;
+# their completion is returned as a Future, and the rotation of the server must be dropped
+# unless it succeeds. The existing snapshots are taken from `listing` only if the server rotates them.
+def process_server(srv: Server, listing: SnapshotListing, tagged: bool = False,
+                   background: Optional[Executor] = None) -> tuple[int, list[Operation], Optional[Future]]:
+    return_value = 0
+    operations: list[Operation] = []
+    completion = None
+
+    with log_tag(srv.name if tagged else None):
+        # Create a new snapshot if so configured and preserve the server operating status
+        try:
+            new_snapshot = None
+            pending: Optional[PendingSnapshot] = None
+
+            if srv.config.create_snapshot:
+                caught = None
+                restart = False
+
+                try:
+                    if (srv.config.shutdown_and_restart
+                            and (srv.status in [ServerStatus.STARTING, ServerStatus.RUNNING])):
+                        restart = True
+                        srv.power(False)
+
+                    timeout = srv.timeout(ServerAction.CREATE_IMAGE, srv.config.snapshot_timeout)
+
+                    if restart and srv.config.early_restart:
+                        # The snapshot is consistent as soon as its creation has been accepted
+                        pending = begin_snapshot(srv, timeout)
+                        new_snapshot = pending.snapshot
+                    else:
+                        new_snapshot = create_snapshot(srv, timeout)
+
+                # If an exception occurred during powering down or taking the snapshot
+                # then throw it only after having restarted the server, if necessary
+                except Exception as ex:
+                    caught = ex
+
+                restart_error = None
+                if restart:
+                    try:
+                        srv.power(True)
+                    except Exception as ex:
+                        restart_error = ex
 
-def rotate(config: Config.Defaults, not_rotated: list[Snapshot], p_end: datetime) -> Rotated:
-    rotated: Rotated = {}
-    latest_start = None
+                # A pending snapshot is awaited even if the server could not be restarted
+                if pending is not None:
+                    completion = await_snapshot(pending, background)
 
-    for p in Period:
-        p_count = getattr(config, p.config_name, 0) or 0
+                if restart_error:
+                    raise restart_error
 
-        if p_count > 0:
-            if latest_start is None:
-                latest_start = p.start_of_period(p_end)
-                p_end = latest_start
+                if caught:
+                    raise caught
 
-            for p_num, p_start in enumerate(p.previous_periods(p_end, p_count), start=1):
-                p_sn = Snapshots.oldest(p_start, p_end, not_rotated)
+        except Exception:
+            log(format_exc(limit=-1), LOG_ERR)
+            metrics.errors.inc('snapshot')
+            return_value = 1
 
-                if p_sn:
-                    not_rotated.remove(p_sn)
-                    rotated[p_sn] = (p, p_num)
+        # Plan the rotation of the existing snapshots of this server if so configured
+        try:
+            if srv.config.rotate:
+                listing.attach(srv)
+                log_snapshots(srv, 'before')
 
-                    p_end = p_start
+                p_end = new_snapshot.created if new_snapshot is not None else datetime.now(tz=timezone.utc)
+                operations = plan_rotation(srv, p_end)
 
-    # Assign numbers (but no period types) to the latest snapshots,
-    # or to all snapshots if no rotation period was configured
-    for l_num, l_sn in enumerate(Snapshots.latest(latest_start, not_rotated), start=1):
-        not_rotated.remove(l_sn)
-        rotated[l_sn] = (None, l_num)
+        except Exception:
+            log(format_exc(limit=-1), LOG_ERR)
+            metrics.errors.inc('planning')
+            return_value = 1
 
-    return rotated
+    return return_value, operations, completion
 
 
-def main() -> int:
+# Creates snapshots and plans the rotation of the specified servers, returns the plan and 0 if all
+# operations succeeded or else 1
+def process_servers(servers: list[Server], listing: SnapshotListing) -> tuple[RotationPlan, int]:
+    return_value = 0
+    plan = RotationPlan()
+    tagged = config.max_parallelism > 1 and len(servers) > 1
+
+    # Threads awaiting the completion of snapshots after early restarts, started only if needed
+    with ThreadPoolExecutor(max_workers=max(len(servers), 1)) as background:
+        # Load the snapshot listing while the snapshots are being created, but only if it is needed;
+        # a failure is reported to the servers that need it
+        if any(srv.config.rotate for srv in servers):
+            background.submit(bind_context(listing.snapshots_by_server))
+
+        if tagged:
+            # Run the pipelines of different servers concurrently, tagging
+            # log messages with the server name to keep them apart
+            with ThreadPoolExecutor(max_workers=config.max_parallelism) as executor:
+                results = list(executor.map(
+                    bind_context(lambda srv: process_server(srv, listing, tagged=True, background=background)),
+                    servers
+                ))
+
+        else:
+            results = [process_server(srv, listing, background=background) for srv in servers]
+
+        for srv, (rv, ops, completion) in zip(servers, results):
+            if completion is not None:
+                try:
+                    completion.result()
+
+                except Exception:
+                    with log_tag(srv.name if tagged else None):
+                        log(format_exc(limit=-1), LOG_ERR)
+                    metrics.errors.inc('snapshot')
+                    rv = 1
+
+                    # The rotation must not rely on a snapshot that failed
+                    ops = []
+
+            # Apply the renames and deletions of all servers together
+            plan.operations.extend(ops)
+            return_value = max(return_value, rv)
+
+    return plan, return_value
+
+
+# Returns 0 if all operations succeeded or else 1, and the names of the configured servers
+# or None if they could not be listed
+def process_project(inventory: Optional[Inventory] = None) -> tuple[int, Optional[list[str]]]:
     return_value = 0
+    servers = None
 
     try:
-        snapshots = Snapshots.load_snapshots()
-        servers = Servers.load_configured_servers(snapshots)
+        # Servers are always listed anew since their status may have changed, snapshots only if needed
+        listing = SnapshotListing(inventory.refresh if inventory is not None else Snapshots.iter_snapshots)
+        servers = Servers.load_configured_servers()
+
+        if config.migrate_labels:
+            # Neither create nor rotate snapshots but only label them
+            for srv in servers.servers:
+                if srv.config.rotation_labels:
+                    listing.attach(srv)
+
+            plan = RotationPlan(operations=[op for srv in servers.servers for op in plan_migration(srv)])
+        else:
+            plan, return_value = process_servers(servers.servers, listing)
+
+        if config.dry_run and enabled(LOG_NOTICE):
+            log('Rotation plan: %s', LOG_NOTICE, plan.to_json())
+
+        return_value = max(return_value, execute_plan(plan, servers.servers, config.max_parallelism))
 
         for srv in servers.servers:
-            # Create a new snapshot if so configured and preserve the server operating status
-            try:
-                new_snapshot = None
+            if srv.config.rotate:
+                with log_tag(srv.name if config.max_parallelism > 1 else None):
+                    log_snapshots(srv, 'after')
 
-                if srv.config.create_snapshot:
-                    caught = None
-                    restart = False
+        # A dry run must not record snapshots that were not actually created, renamed or deleted.
+        # An inventory that was not refreshed is left as it is and catches up on the next refresh.
+        if inventory is not None and not config.dry_run and listing.loaded:
+            # Servers that were rotated keep their snapshots as they are after deletions
+            for srv in servers.servers:
+                listing.attach(srv)
 
-                    try:
-                        if (srv.config.shutdown_and_restart
-                                and (srv.status in [ServerStatus.STARTING, ServerStatus.RUNNING])):
-                            restart = True
-                            srv.power(False)
+            inventory.update(servers.servers)
+            inventory.save()
 
-                        new_snapshot = create_snapshot(srv, srv.config.snapshot_timeout)
+    except Exception as ex:
+        log(format_exc(limit=-1), LOG_ERR)
+        metrics.errors.inc('run')
+        return_value = 1
 
-                    # If an exception occurred during powering down or taking the snapshot
-                    # then throw it only after having restarted the server, if necessary
-                    except Exception as ex:
-                        caught = ex
+        # The inventory may no longer reflect the actual snapshots
+        if inventory is not None:
+            inventory.images = []
 
-                    if restart:
-                        srv.power(True)
+    return return_value, [srv.name for srv in servers.servers] if servers is not None else None
 
-                    if caught:
-                        raise caught
 
-            except Exception:
-                log(format_exc(limit=-1), LOG_ERR)
-                return_value = 1
+# Warns about the servers selected on the command line that are configured in none of the projects,
+# unless the servers of some project could not be listed
+def warn_unknown_servers(names: list[Optional[list[str]]]):
+    if config.selected_servers is None or None in names:
+        return
 
-            # Rotate existing snapshots of this server if so configured
-            try:
-                if srv.config.rotate:
-                    sn_len = len(srv.snapshots)
-                    log(f'Server [{srv.name}]: {sn_len} snapshot{"s"[:sn_len!=1]} before rotation', LOG_DEBUG)
-                    for i, sn in enumerate(srv.snapshots, start=1):
-                        log(f'{i:3}. {sn.description}', LOG_DEBUG)
+    found = {name for project_names in names for name in project_names}
+    for name in config.selected_servers:
+        if name not in found:
+            log('Server [%s] does not exist or is not configured', LOG_WARNING, name)
 
-                    # Find out which snapshots to preserve for the configured rotation periods,
-                    # and note the new rotation period they are now associated with
-                    not_rotated: list[Snapshot] = list(srv.snapshots)
 
-                    p_end = new_snapshot.created if new_snapshot is not None else datetime.now(tz=timezone.utc)
-                    rotated = rotate(config=srv.config, not_rotated=not_rotated, p_end=p_end)
+# Returns the inventory of the current project, or None if the inventory is neither
+# kept in a file nor in memory; `inventories` holds the inventories between daemon runs
+def project_inventory(inventories: dict[Optional[str], Inventory], project: Optional[str]) -> Optional[Inventory]:
+    path = Inventory.project_path(config.inventory, project) if config.inventory else None
+    if (path is None) and not config.daemon:
+        return None
 
-                    # Rename the snapshots which are now associated with a different rotation period
-                    for sn, (p, p_num) in rotated.items():
-                        sn.rename(created_from=srv, period=p, period_number=p_num)
+    inventory = inventories.get(project)
+    if (inventory is None) or (inventory.path != path) or (inventory.label_selector != config.label_selector()):
+        inventory = inventories[project] = Inventory.open(path)
 
-                    # Delete the snapshots which are not contained in any rotation period
-                    for sn in not_rotated:
-                        sn.delete(srv)
+    return inventory
 
-                    sn_len = len(srv.snapshots)
-                    log(f'Server [{srv.name}]: {sn_len} snapshot{"s"[:sn_len!=1]} after rotation', LOG_DEBUG)
-                    for i, sn in enumerate(srv.snapshots, start=1):
-                        log(f'{i:3}. {sn.description}', LOG_DEBUG)
 
-            except Exception:
-                log(format_exc(limit=-1), LOG_ERR)
-                return_value = 1
+def run_projects(inventories: dict[Optional[str], Inventory]) -> int:
+    projects = config.project_configs
+
+    # Each project has its own API token, thus its own rate limit budget and connection pool
+    def process(name: str) -> tuple[int, Optional[list[str]]]:
+        with activate(projects[name]), log_tag(name):
+            return process_project(project_inventory(inventories, name))
+
+    with ThreadPoolExecutor(max_workers=len(projects)) as executor:
+        results = dict(zip(projects, executor.map(bind_context(process), projects)))
+
+    failed = [name for name, (rv, _) in results.items() if rv != 0]
+    server_count = sum(len(names or []) for _, names in results.values())
+    warn_unknown_servers([names for _, names in results.values()])
+    log('%d project%s with %d server%s processed, %d failed', LOG_NOTICE if not failed else LOG_ERR,
+        len(projects), 's'[:len(projects)!=1], server_count, 's'[:server_count!=1], len(failed))
+
+    for name in failed:
+        log('Project [%s] failed', LOG_ERR, name)
+
+    return 1 if failed else 0
 
-    except Exception as ex:
-        log(format_exc(limit=-1), LOG_ERR)
-        return_value = 1
+
+def run(inventories: dict[Optional[str], Inventory]) -> int:
+    start = time.monotonic()
+
+    # The history is kept in memory between daemon runs
+    if config.history != duration_history.path:
+        duration_history.open(config.history)
+
+    if config.project_configs:
+        return_value = run_projects(inventories)
+    else:
+        return_value, names = process_project(project_inventory(inventories, None))
+        warn_unknown_servers([names])
+
+    log('HTTP connections: %d new, %d reused', LOG_DEBUG, connection_stats.new, connection_stats.reused)
+    if enabled(LOG_DEBUG):
+        for line in polling_metrics.summary():
+            log('Polling %s', LOG_DEBUG, line)
+
+    try:
+        duration_history.save()
+    except OSError as ex:
+        log('Unable to write the duration history to [%s]: %s', LOG_ERR, config.history, ex)
+
+    metrics.run_duration.observe(value=time.monotonic() - start)
+    metrics.last_run.set(value=time.time())
+    metrics.last_run_status.set(value=return_value)
+
+    if config.metrics_file:
+        try:
+            metrics.write_textfile(config.metrics_file)
+        except OSError as ex:
+            log('Unable to write metrics to [%s]: %s', LOG_ERR, config.metrics_file, ex)
 
     return return_value
 
 
+def main() -> int:
+    # Inventories by project (None if no projects are configured)
+    inventories: dict[Optional[str], Inventory] = {}
+
+    if config.history_report:
+        duration_history.open(config.history)
+        print('\n'.join(duration_history.report() or ['No durations recorded']))
+        return 0
+
+    # A migration is performed only once
+    if config.daemon and not config.migrate_labels:
+        if config.metrics_port is not None:
+            metrics.serve(config.metrics_port)
+
+        # Keep the inventories in memory between runs, and also in files if so configured
+        return Daemon(lambda: run(inventories), sys.argv).serve()
+
+    return run(inventories)
+
+
 if __name__ == '__main__':
     sys.exit(main())
@@ -1,17 +1,22 @@
 import json
-import re
 import requests
+import threading
 import time
 
+from concurrent.futures import ThreadPoolExecutor
 from dataclass_wizard import JSONWizard
 from dataclasses import dataclass
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from enum import Enum
-from typing import Optional
+from typing import Iterator, Optional
 
-from typing_extensions import Match
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from hetzner_snap_and_rotate.config import config
+from hetzner_snap_and_rotate.config import Config, activate, bind_context, config, current_config
+from hetzner_snap_and_rotate.decoding import decode
+from hetzner_snap_and_rotate.metrics import api_requests, api_request_duration, endpoint, errors
+from hetzner_snap_and_rotate.polling import PollingStrategy, FixedInterval, Detection, polling_metrics
 
 
 class ApiError(Exception):
@@ -22,23 +27,143 @@ class RecoverableError(Exception):
     pass
 
 
-# Matches JSON ISO 8601 timestamp strings with fewer than six
-# fractional digits and captures the fractional digits in group #1
-timestamp_pattern = re.compile('"\\d{4}-\\d{2}-\\d{2}T\\d{2}:\\d{2}:\\d{2}\\.(\\d{,5})(?=Z"|[+-]\\d{2}:\\d{2}")')
+@dataclass(kw_only=True)
+class ConnectionStats:
+
+    new: int = 0
+    reused: int = 0
+
+    def __post_init__(self):
+        self.lock = threading.Lock()
+
+    def count(self, connection):
+        if connection is None:
+            return
+
+        with self.lock:
+            # Connections that have already served a request are marked by an attribute
+            if getattr(connection, 'served_by_pool', False):
+                self.reused += 1
+            else:
+                connection.served_by_pool = True
+                self.new += 1
+
+
+connection_stats = ConnectionStats()
+
+
+# Counts how many requests were sent over new and over reused (kept-alive) connections
+class PoolingAdapter(HTTPAdapter):
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+
+        # The connection is still attached because the response content has not been read yet
+        connection_stats.count(getattr(response.raw, 'connection', None))
+
+        return response
+
+
+# HTTP sessions by API token, i.e. each project has a connection pool of its own
+sessions: dict[Optional[str], requests.Session] = {}
+sessions_lock = threading.Lock()
+
+
+# Returns the HTTP session shared by all API requests with the same API token, creating it on first use
+def get_session(api_token: Optional[str] = None) -> requests.Session:
+    with sessions_lock:
+        session = sessions.get(api_token)
+
+        if session is None:
+            # Retry only requests that are safe to repeat; 'POST' might create duplicate snapshots.
+            # Status codes 429 and 503 are retried by api_request()
+            retry = Retry(
+                total=config.max_retries,
+                backoff_factor=0.5,
+                status_forcelist=[502, 504],
+                allowed_methods=['GET', 'PUT', 'DELETE'],
+                raise_on_status=False
+            )
+
+            adapter = PoolingAdapter(
+                pool_connections=1,
+                pool_maxsize=max(config.pool_size, config.max_parallelism),
+                max_retries=retry
+            )
+
+            session = sessions[api_token] = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
 
+        return session
 
-# Adds trailing zero(s) to a timestamp so that there are six fractional digits
-def sanitize_timestamps(json_text: str):
-    def add_zeroes(match: Match):
-        return match.group(0) + ('0' * (6 - len(match.group(1))))
 
-    return timestamp_pattern.sub(add_zeroes, json_text)
+# Token bucket that paces the requests made with the same API token according
+# to the 'RateLimit-*' response headers, and that is shared by concurrent callers
+class RateLimiter:
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.tokens: Optional[float] = None
+        self.rate: float = 0
+        self.updated: float = 0
+
+    def refill(self, now: float):
+        if self.tokens is not None:
+            self.tokens += (now - self.updated) * self.rate
+        self.updated = now
+
+    # Blocks until a request may be sent
+    def acquire(self):
+        with self.condition:
+            while True:
+                now = time.time()
+                self.refill(now)
+
+                if (self.tokens is None) or (self.tokens >= 1):
+                    if self.tokens is not None:
+                        self.tokens -= 1
+                    return
+
+                self.condition.wait(timeout=self.delay())
+
+    # Seconds until the next request may be sent, based on the current budget
+    def delay(self) -> float:
+        if (self.tokens is None) or (self.tokens >= 1):
+            return 0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else 1
+
+    def update(self, headers):
+        try:
+            limit = int(headers['RateLimit-Limit'])
+            remaining = int(headers['RateLimit-Remaining'])
+            reset = int(headers['RateLimit-Reset'])
+        except (KeyError, ValueError):
+            return
+
+        with self.condition:
+            now = time.time()
+            self.refill(now)
+
+            # The budget is refilled continuously until it is full at the 'reset' instant
+            self.rate = (limit - remaining) / max(reset - now, 1) if remaining < limit else limit / 3600
+            self.tokens = min(remaining, self.tokens) if self.tokens is not None else remaining
+            self.condition.notify_all()
+
+
+rate_limiters: dict[str, RateLimiter] = {}
+rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(api_token: str) -> RateLimiter:
+    with rate_limiters_lock:
+        return rate_limiters.setdefault(api_token, RateLimiter())
 
 
 def api_request(return_type, api_path: str, api_token: str,
                 method: str = 'GET', params: dict = None, data: dict = None, timeout: int = 30):
 
-    url = 'https://api.hetzner.cloud/v1/' + api_path
+    url = config.api_url.rstrip('/') + '/' + api_path
     headers = {
         'Authorization': 'Bearer ' + api_token,
         'Content-Type': 'application/json',
@@ -46,15 +171,46 @@ def api_request(return_type, api_path: str, api_token: str,
     }
 
     if (method == 'GET') or (method == 'DELETE'):
-        response = requests.request(method=method, url=url, headers=headers, params=params, timeout=timeout)
-
+        body = None
     elif (method == 'POST') or (method == 'PUT'):
-        response = requests.request(method=method, url=url, headers=headers, params=params, timeout=timeout,
-                                    data=json.dumps(data, default=vars) if data is not None else None)
+        body = json.dumps(data, default=vars) if data is not None else None
     else:
         raise ApiError(f'Unsupported method: {method}')
 
+    rate_limiter = get_rate_limiter(api_token)
+    metrics_endpoint = endpoint(api_path)
+    start = time.monotonic()
+
+    # Requests that were rejected due to rate limiting or unavailability were not processed,
+    # so they can be retried regardless of the method
+    for attempt in range(config.max_retries + 1):
+        rate_limiter.acquire()
+        try:
+            response = get_session(api_token).request(method=method, url=url, headers=headers, params=params,
+                                              timeout=timeout, data=body)
+        except requests.RequestException:
+            api_requests.inc(metrics_endpoint, method, 'error')
+            errors.inc('api')
+            raise
+
+        api_requests.inc(metrics_endpoint, method, str(response.status_code))
+        rate_limiter.update(response.headers)
+
+        if (response.status_code not in [429, 503]) or (attempt >= config.max_retries):
+            break
+
+        try:
+            retry_after = float(response.headers['Retry-After'])
+        except (KeyError, ValueError):
+            retry_after = rate_limiter.delay() if response.status_code == 429 else 0
+
+        time.sleep(max(retry_after, 0.5 * 2**attempt))
+
+    api_request_duration.observe(metrics_endpoint, method, value=time.monotonic() - start)
+
     if not response.ok:
+        errors.inc('api')
+
         message = (
             f'{method} from {url} failed: '
             f'{response.reason} ({response.status_code}), {response.json()["error"]["message"]}'
@@ -65,7 +221,7 @@ def api_request(return_type, api_path: str, api_token: str,
         else:
             raise ApiError(message)
 
-    return return_type.from_json(sanitize_timestamps(response.text)) if return_type is not None else None
+    return decode(return_type, response.content) if return_type is not None else None
 
 
 @dataclass(kw_only=True)
@@ -78,31 +234,70 @@ class Page(JSONWizard):
         class Pagination:
             page: int
             next_page: Optional[int]
+            last_page: Optional[int] = None
+            total_entries: Optional[int] = None
 
         pagination: Pagination
 
     meta: Metadata
 
+    # Maximum number of entities per page supported by the API
+    max_per_page = 50
+
+    # Yields the pages of a listing in order; with `prefetch`, the remaining pages are
+    # loaded concurrently, otherwise only when requested
     @staticmethod
-    def load_page(return_type, api_path: str, api_token: str, params: dict = None):
+    def iter_pages(return_type, api_path: str, api_token: str, params: dict = None,
+                   prefetch: bool = True) -> Iterator:
         if params is None:
             params = {}
-        page = None
-        next_page = 1
 
-        while next_page is not None:
-            params['page'] = next_page
-            p = api_request(return_type=return_type, api_path=api_path, api_token=api_token, params=params)
-            next_page = p.meta.pagination.next_page
+        def load(number: int):
+            return api_request(return_type=return_type, api_path=api_path, api_token=api_token,
+                               params=params | {'page': number})
+
+        page = load(1)
+        pagination = page.meta.pagination
+        yield page
+
+        if prefetch and (pagination.next_page is not None) and (pagination.last_page is not None):
+            # The number of pages is known, therefore fetch the remaining pages concurrently
+            numbers = range(pagination.next_page, pagination.last_page + 1)
+            executor = ThreadPoolExecutor(max_workers=min(len(numbers), config.pool_size))
+
+            try:
+                yield from executor.map(bind_context(load), numbers)
+            finally:
+                executor.shutdown(cancel_futures=True)
+
+        else:
+            next_page = pagination.next_page
+
+            while next_page is not None:
+                page = load(next_page)
+                next_page = page.meta.pagination.next_page
+                yield page
+
+    # Yields the entities of a listing in order, without holding on to the pages.
+    # For all practical purposes, `api_path` also represents the name
+    # of the property that contains a list of the requested entities.
+    @staticmethod
+    def iter_entities(return_type, api_path: str, api_token: str, params: dict = None) -> Iterator:
+        for page in Page.iter_pages(return_type=return_type, api_path=api_path, api_token=api_token, params=params):
+            yield from getattr(page, api_path)
+
+    @staticmethod
+    def load_page(return_type, api_path: str, api_token: str, params: dict = None):
+        page = None
 
-            if not page:
+        for p in Page.iter_pages(return_type=return_type, api_path=api_path, api_token=api_token, params=params):
+            if page is None:
                 page = p
+                entities = getattr(page, api_path)
 
             else:
-                # For all practical purposes, `api_path` also represents the name
-                # of the property that contains a list of the requested entities.
                 # Accumulate all entities in the list of the result `Page`
-                setattr(page, api_path, getattr(page, api_path) + getattr(p, api_path))
+                entities.extend(getattr(p, api_path))
 
                 # Return the metadata of the last page
                 page.meta = p.meta
@@ -116,43 +311,152 @@ class ActionStatus(Enum):
     ERROR = 'error'
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, slots=True)
 class Action(JSONWizard):
 
     id: int
     command: str
     status: ActionStatus
     error: Optional[dict]
+    started: Optional[datetime] = None
+    finished: Optional[datetime] = None
 
-    def load_status(self) -> ActionStatus:
+    def wait_until_completed(self, timeout: int = 30, interval: int = 5, strategy: PollingStrategy = None):
 
-        @dataclass(kw_only=True)
-        class Wrapper(JSONWizard):
-            action: Action
+        if self.status in [ActionStatus.SUCCESS, ActionStatus.ERROR]:
+            return
 
-        wrapper = api_request(
-            return_type=Wrapper,
-            api_path=f'actions/{self.id}',
-            api_token=config.api_token
-        )
+        action_tracker.wait(self, timeout=timeout, strategy=strategy or FixedInterval(interval=interval))
 
-        return wrapper.action.status
 
-    def wait_until_completed(self, timeout: int = 30, interval: int = 5):
+@dataclass(kw_only=True)
+class ActionWrapper(JSONWizard):
 
-        if self.status in [ActionStatus.SUCCESS, ActionStatus.ERROR]:
-            return
+    action: Action
 
-        end = datetime.now() + timedelta(seconds=timeout)
 
-        while self.load_status() not in [ActionStatus.SUCCESS, ActionStatus.ERROR]:
-            if datetime.now() <= end:
-                time.sleep(interval)
-            else:
-                raise TimeoutError(f'Action {self.command} timed out after {timeout}s')
+@dataclass(kw_only=True)
+class Actions(Page, JSONWizard):
+
+    actions: list[Action]
 
 
 @dataclass(kw_only=True)
-class ActionWrapper(JSONWizard):
+class Waiter:
 
     action: Action
+    intervals: Iterator[float]
+    due: float
+    polls: int = 0
+
+    # Actions of different projects must be polled with their own API tokens, API URLs and retries
+    project: Optional[Config] = None
+
+    # The error of the last poll of this project, to be raised by the waiter rather than by whoever polled
+    error: Optional[Exception] = None
+
+
+# Polls the status of all pending actions together instead of one request per action,
+# so that concurrent waiters share a request whenever one of them is due for polling
+class ActionTracker:
+
+    batch_size = Page.max_per_page
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.waiters: dict[int, Waiter] = {}
+        self.polling = False
+
+    @staticmethod
+    def load_actions(ids: list[int], api_token: str) -> dict[int, Action]:
+        actions = {}
+
+        for i in range(0, len(ids), ActionTracker.batch_size):
+            page: Actions = Page.load_page(
+                return_type=Actions,
+                api_path='actions',
+                api_token=api_token,
+                params={'id': ids[i:i+ActionTracker.batch_size], 'per_page': ActionTracker.batch_size}
+            )
+            actions.update((a.id, a) for a in page.actions)
+
+        return actions
+
+    def poll(self):
+        self.polling = True
+        ids = list(self.waiters.keys())
+        by_project: dict[int, tuple[Config, list[int]]] = {}
+        for i, w in self.waiters.items():
+            by_project.setdefault(id(w.project), (w.project, []))[1].append(i)
+
+        actions = {}
+        errors: dict[int, Exception] = {}
+        self.condition.release()
+
+        try:
+            for key, (project, project_ids) in by_project.items():
+                try:
+                    with activate(project):
+                        actions.update(self.load_actions(project_ids, project.api_token))
+
+                except Exception as ex:
+                    errors[key] = ex
+
+        finally:
+            self.condition.acquire()
+            polled_at = time.monotonic()
+
+            # Update the polled actions and schedule their next poll; this also aligns
+            # the schedules of all waiters so that they keep sharing their polls
+            for i in ids:
+                w = self.waiters.get(i)
+                if w is not None:
+                    if i in actions:
+                        w.action.status = actions[i].status
+                        w.action.finished = actions[i].finished
+
+                    w.error = errors.get(id(w.project))
+                    w.polls += 1
+                    w.due = polled_at + next(w.intervals)
+
+            self.polling = False
+            self.condition.notify_all()
+
+    def wait(self, action: Action, timeout: int, strategy: PollingStrategy):
+        start = time.monotonic()
+        end = start + timeout
+
+        with self.condition:
+            waiter = Waiter(action=action, intervals=strategy.intervals(), due=start, project=current_config())
+            self.waiters[action.id] = waiter
+
+            try:
+                while True:
+                    if waiter.error is not None:
+                        raise waiter.error
+
+                    if action.status in [ActionStatus.SUCCESS, ActionStatus.ERROR]:
+                        polling_metrics.record(action.command, Detection(
+                            waited=timedelta(seconds=time.monotonic() - start),
+                            delay=datetime.now(tz=timezone.utc) - action.finished if action.finished else None,
+                            polls=waiter.polls
+                        ))
+                        return
+
+                    now = time.monotonic()
+                    if now > end:
+                        raise TimeoutError(f'Action {action.command} timed out after {timeout}s')
+
+                    due = min(w.due for w in self.waiters.values())
+
+                    if self.polling or (now < due):
+                        # Wait until another waiter has polled or until the next poll is due
+                        self.condition.wait(timeout=min(due - now if due > now else end - now, end - now))
+                    else:
+                        self.poll()
+
+            finally:
+                del self.waiters[action.id]
+
+
+action_tracker = ActionTracker()
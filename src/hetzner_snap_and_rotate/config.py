@@ -1,12 +1,17 @@
 import os
+import re
 import sys
+import threading
 
 from argparse import ArgumentParser
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
 from datetime import datetime, timezone
-from typing import Optional
+from fnmatch import fnmatchcase
+from typing import Callable, Optional
 
 from dataclass_wizard import JSONWizard
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, fields
 from syslog import (
     LOG_EMERG, LOG_ERR, LOG_WARNING, LOG_NOTICE, LOG_INFO, LOG_DEBUG, LOG_KERN, LOG_USER, LOG_MAIL,
     LOG_DAEMON, LOG_AUTH, LOG_LPR, LOG_NEWS, LOG_UUCP, LOG_CRON, LOG_SYSLOG, LOG_LOCAL0,
@@ -21,8 +26,72 @@ OptionalStr = Optional[str]
 OptionalInt = Optional[int]
 
 
+# A term of a label selector, e.g. 'env=prod', 'env!=prod', 'backup', '!backup' or 'env in (prod,stage)'
+selector_term = re.compile(
+    r'\s*(?:!\s*(?P<absent>[\w./-]+)'
+    r'|(?P<key>[\w./-]+)\s*(?:(?P<op>==|=|!=)\s*(?P<value>[\w.-]*)'
+    r'|\s+(?P<set_op>in|notin)\s*\((?P<values>[^)]*)\))?)\s*(?:,|$)'
+)
+
+
+def label_selector_terms(selector: str) -> list[re.Match]:
+    terms = []
+    pos = 0
+
+    while pos < len(selector):
+        m = selector_term.match(selector, pos)
+        if m is None or m.end() == pos:
+            raise ValueError(f'Invalid label selector: {selector}')
+
+        terms.append(m)
+        pos = m.end()
+
+    return terms
+
+
+def term_matches(term: re.Match, labels: dict[str, str]) -> bool:
+    key = term['key']
+
+    if term['absent']:
+        return term['absent'] not in labels
+
+    if term['op']:
+        return (labels.get(key) == term['value']) == (term['op'] != '!=')
+
+    if term['set_op']:
+        return (labels.get(key) in {v.strip() for v in term['values'].split(',')}) == (term['set_op'] == 'in')
+
+    return key in labels
+
+
+# Evaluates a label selector of the Hetzner API like the API does
+def matches_label_selector(selector: str, labels: dict[str, str]) -> bool:
+    return all(term_matches(t, labels) for t in label_selector_terms(selector))
+
+
 @dataclass(kw_only=True)
 class Config(JSONWizard):
+    @dataclass(kw_only=True)
+    class Polling:
+
+        initial_interval: float = 1
+        fast_poll_window: float = 10
+        factor: float = 2
+        max_interval: float = 30
+        jitter: float = 0.2
+
+    # Timeouts derived from the recorded durations of the actions of a server, see durations.DurationHistory
+    @dataclass(kw_only=True)
+    class AdaptiveTimeouts:
+
+        percentile: float = 99
+        factor: float = 2
+        floor: float = 30
+        ceiling: float = 1800
+
+        # Static timeouts apply until this many durations have been recorded
+        min_samples: int = 5
+
     @dataclass(kw_only=True)
     class Defaults:
 
@@ -30,10 +99,17 @@ class Config(JSONWizard):
         snapshot_timeout: OptionalInt = None
         snapshot_name: OptionalStr = None
         shutdown_and_restart: OptionalBool = None
+
+        # Restart the server as soon as snapshot creation has been accepted, instead of after its completion
+        early_restart: OptionalBool = None
         shutdown_timeout: OptionalInt = None
         allow_poweroff: OptionalBool = None
 
         rotate: OptionalBool = None
+
+        # Record the creation periods of new snapshots in labels instead of renaming snapshots during rotation
+        rotation_labels: OptionalBool = None
+
         quarter_hourly: OptionalInt = None
         hourly: OptionalInt = None
         daily: OptionalInt = None
@@ -42,6 +118,12 @@ class Config(JSONWizard):
         quarter_yearly: OptionalInt = None
         yearly: OptionalInt = None
 
+        # Polling strategies by action command ('poweron', 'shutdown', 'poweroff', 'create_image')
+        polling: Optional[dict[str, 'Config.Polling']] = None
+
+        # Replace the static timeouts once enough action durations have been recorded
+        adaptive_timeouts: Optional['Config.AdaptiveTimeouts'] = None
+
     @dataclass(kw_only=True)
     class Server(Defaults):
 
@@ -55,13 +137,86 @@ class Config(JSONWizard):
             if self.create_snapshot and not self.snapshot_name:
                 raise ValueError(f'No snapshot name pattern specified for server [{self.name}]')
 
+    # Servers selected by labels and/or by name, sharing the same settings
+    @dataclass(kw_only=True)
+    class ServerGroup(Defaults):
+
+        label_selector: OptionalStr = None
+
+        # Shell-style pattern, e.g. 'web-*'; an exact name is also passed to the API
+        name_pattern: OptionalStr = None
+
+        def matches(self, name: str, labels: dict[str, str]) -> bool:
+            return ((self.label_selector is None or matches_label_selector(self.label_selector, labels))
+                    and (self.name_pattern is None or fnmatchcase(name, self.name_pattern)))
+
+        # Query parameters that let the API select the servers of this group,
+        # or None if the group cannot be selected by the API
+        def params(self) -> Optional[dict[str, str]]:
+            params = {}
+
+            if self.label_selector:
+                params['label_selector'] = self.label_selector
+
+            if self.name_pattern:
+                if any(c in self.name_pattern for c in '*?['):
+                    if not params:
+                        return None
+                else:
+                    params['name'] = self.name_pattern
+
+            return params or None
+
+    @dataclass(kw_only=True)
+    class Project:
+
+        api_token: str = field(default=None)
+        defaults: 'Config.Defaults' = field(default=None)
+        servers: dict[str, 'Config.Server'] = field(default_factory=lambda: {})
+        server_groups: dict[str, 'Config.ServerGroup'] = field(default_factory=lambda: {})
+        snapshot_labels: Optional[dict[str, str]] = None
+        pool_size: OptionalInt = None
+        max_retries: OptionalInt = None
+        api_url: OptionalStr = None
+
     api_token: str = field(default=None)
     defaults: Defaults = field(default=None)
     servers: dict[str, Server] = field(default_factory=lambda: {})
 
-    dry_run: bool = field(init=False)
-    facility: int = field(init=False)
-    priority: int = field(init=False)
+    # Servers that are not configured individually are taken from the first group they belong to
+    server_groups: dict[str, ServerGroup] = field(default_factory=lambda: {})
+
+    # Labels stamped on new snapshots; if specified, only snapshots having these labels are rotated
+    snapshot_labels: dict[str, str] = field(default_factory=lambda: {})
+
+    pool_size: int = field(default=10)
+    max_retries: int = field(default=3)
+
+    # Base URL of the API, e.g. of a local stand-in for testing
+    api_url: str = field(default='https://api.hetzner.cloud/v1/')
+
+    # Hetzner projects by name, each having its own API token, defaults and servers
+    projects: dict[str, Project] = field(default_factory=lambda: {})
+
+    # Complete configurations of the projects, see init_projects()
+    project_configs: dict = field(init=False, default_factory=lambda: {})
+
+    dry_run: bool = field(init=False, default=False)
+    max_parallelism: int = field(init=False, default=1)
+    inventory: OptionalStr = field(init=False, default=None)
+    daemon: bool = field(init=False, default=False)
+    metrics_file: OptionalStr = field(init=False, default=None)
+    metrics_port: OptionalInt = field(init=False, default=None)
+    facility: OptionalInt = field(init=False, default=None)
+    priority: int = field(init=False, default=LOG_NOTICE)
+    log_format: str = field(init=False, default='text')
+    migrate_labels: bool = field(init=False, default=False)
+
+    history: OptionalStr = field(init=False, default=None)
+    history_report: bool = field(init=False, default=False)
+
+    # Names of the servers to process in this run, or None for all configured servers
+    selected_servers: Optional[list[str]] = field(init=False, default=None)
 
     local_tz: timezone = field(init=False, default=datetime.now(timezone.utc).astimezone().tzinfo)
 
@@ -70,8 +225,19 @@ class Config(JSONWizard):
             server.name = name
             server.apply_default(self.defaults)
 
+        # Validate the group settings and selectors
+        for name, group in self.server_groups.items():
+            if group.label_selector is None and group.name_pattern is None:
+                raise ValueError(f'Server group [{name}] needs a label selector or a name pattern')
+
+            if group.label_selector is not None:
+                label_selector_terms(group.label_selector)
+
+            self.group_server(group, name)
+
+    # An `api_token` replaces reading the API token from stdin again, e.g. when reloading the configuration
     @staticmethod
-    def read_config(sys_argv: list[str]):
+    def read_config(sys_argv: list[str], api_token: OptionalStr = None):
         parser = ArgumentParser(
             prog=sys.modules[__name__].__package__.replace('src.', ''),
             description='Creates and rotates snapshots of Hetzner cloud servers'
@@ -150,6 +316,15 @@ class Config(JSONWizard):
             help='log only messages up to this syslog priority, default: NOTICE'
         )
 
+        parser.add_argument(
+            '-l',
+            '--log-format',
+            choices=['text', 'json'],
+            action='store',
+            default='text',
+            help='log to stdout as text or as JSON lines, default: text'
+        )
+
         parser.add_argument(
             '-n',
             '--dry-run',
@@ -158,6 +333,78 @@ class Config(JSONWizard):
             help='perform a trial run with no changes made'
         )
 
+        parser.add_argument(
+            '-P',
+            '--max-parallelism',
+            action='store',
+            type=int,
+            default=1,
+            help='process up to this many servers concurrently, default: 1'
+        )
+
+        parser.add_argument(
+            '-d',
+            '--daemon',
+            action='store_true',
+            default=False,
+            help='keep running and repeat at the start of the shortest configured rotation period'
+        )
+
+        parser.add_argument(
+            '-i',
+            '--inventory',
+            action='store',
+            default=None,
+            help='cache the snapshot inventory in this file and refresh it incrementally, default: no cache'
+        )
+
+        parser.add_argument(
+            '-m',
+            '--metrics-file',
+            action='store',
+            default=None,
+            help='write metrics to this file after each run, e.g. for the node_exporter textfile collector'
+        )
+
+        parser.add_argument(
+            '-M',
+            '--metrics-port',
+            action='store',
+            type=int,
+            default=None,
+            help='serve metrics at http://<host>:<port>/metrics in daemon mode'
+        )
+
+        parser.add_argument(
+            '-s',
+            '--servers',
+            action='store',
+            default=None,
+            help='process only these servers (comma-separated names), default: all configured servers'
+        )
+
+        parser.add_argument(
+            '-H',
+            '--history',
+            action='store',
+            default=None,
+            help='record the durations of server actions in this file, e.g. for adaptive timeouts'
+        )
+
+        parser.add_argument(
+            '--history-report',
+            action='store_true',
+            default=False,
+            help='display the durations recorded in the --history file and exit'
+        )
+
+        parser.add_argument(
+            '--migrate-labels',
+            action='store_true',
+            default=False,
+            help='only add the creation period labels to existing snapshots of servers with "rotation-labels"'
+        )
+
         try:
             options = vars(parser.parse_args(sys_argv[1:]))
 
@@ -167,21 +414,44 @@ class Config(JSONWizard):
                 c = Config.from_json(config_file.read())
 
                 if options['api_token_from'] == '-':
-                    c.api_token = input()
+                    c.api_token = api_token or input()
                 elif options['api_token_from']:
                     c.api_token = os.getenv(options['api_token_from'])
 
-                if not c.api_token:
+                if c.projects:
+                    c.init_projects()
+                elif not c.api_token and not options['history_report']:
                     raise ValueError('No API token specified')
 
                 c.dry_run = options['dry_run']
+
+                if options['max_parallelism'] < 1:
+                    raise ValueError('Maximum parallelism must be at least 1')
+                c.max_parallelism = options['max_parallelism']
+                c.inventory = options['inventory']
+                c.daemon = options['daemon']
+                c.metrics_file = options['metrics_file']
+
+                if options['metrics_port'] is not None and not c.daemon:
+                    raise ValueError('--metrics-port requires --daemon')
+                c.metrics_port = options['metrics_port']
                 c.priority = priorities[options['priority']]
+                c.log_format = options['log_format']
+                c.migrate_labels = options['migrate_labels']
+                c.history = options['history']
+
+                if options['history_report'] and not c.history:
+                    raise ValueError('--history-report requires --history')
+                c.history_report = options['history_report']
+                if options['servers'] is not None:
+                    c.selected_servers = [n.strip() for n in options['servers'].split(',') if n.strip()]
 
                 try:
                     c.facility = facilities[options['facility']]
                 except KeyError:
                     c.facility = None
 
+                c.inherit_options()
                 return c
             finally:
                 config_file.close()
@@ -190,14 +460,131 @@ class Config(JSONWizard):
             print(f'Invalid configuration: {repr(ex)}', file=sys.stderr)
             exit(1)
 
+    # Settings missing from a project are taken from the global configuration
+    def init_projects(self):
+        if self.servers or self.server_groups:
+            raise ValueError('Servers and server groups must be configured within projects')
+
+        for name, project in self.projects.items():
+            if not project.api_token:
+                raise ValueError(f'No API token specified for project [{name}]')
+
+            self.project_configs[name] = Config(
+                api_token=project.api_token,
+                defaults=project.defaults if project.defaults is not None else self.defaults,
+                servers=project.servers,
+                server_groups=project.server_groups,
+                snapshot_labels=project.snapshot_labels if project.snapshot_labels is not None
+                    else self.snapshot_labels,
+                pool_size=project.pool_size or self.pool_size,
+                max_retries=project.max_retries if project.max_retries is not None else self.max_retries,
+                api_url=project.api_url or self.api_url
+            )
+
+    # Projects use the command line options of the global configuration
+    def inherit_options(self):
+        for project in self.project_configs.values():
+            for f in fields(self):
+                if not f.init and f.name != 'project_configs':
+                    setattr(project, f.name, getattr(self, f.name))
+
+    def label_selector(self) -> OptionalStr:
+        return ','.join(f'{k}={v}' for k, v in self.snapshot_labels.items()) or None
+
     def of_server(self, name: str):
         try:
             return self.servers[name]
         except KeyError:
             return None
 
+    # Returns the configuration of an individually configured server, or else the settings of
+    # the first group the server belongs to, or None if the server is not configured
+    def server_config(self, name: str, labels: dict[str, str]) -> Optional[Server]:
+        server = self.of_server(name)
+        if server is not None:
+            return server
+
+        for group in self.server_groups.values():
+            if group.matches(name, labels):
+                return self.group_server(group, name)
+
+        return None
+
+    def group_server(self, group: ServerGroup, name: str) -> Server:
+        server = Config.Server(name=name, **{f.name: getattr(group, f.name) for f in fields(Config.Defaults)})
+        server.apply_default(self.defaults)
+        return server
+
+
+# The configuration that is used if none has been activated, read from the command line on first use
+default_config: Optional[Config] = None
+default_config_lock = threading.Lock()
+
+# The configuration activated for the current thread or task
+active_config: ContextVar[Optional[Config]] = ContextVar('active_config', default=None)
+
+
+def current_config() -> Config:
+    global default_config
+
+    cfg = active_config.get()
+    if cfg is not None:
+        return cfg
+
+    if default_config is None:
+        with default_config_lock:
+            if default_config is None:
+                default_config = Config.read_config(sys.argv)
+
+    return default_config
+
+
+def set_default_config(cfg: Optional[Config]):
+    global default_config
+    default_config = cfg
+
+
+# Makes `cfg` the configuration of the current thread or task, and of the threads started by bind_context()
+@contextmanager
+def activate(cfg: Config):
+    token = active_config.set(cfg)
+    try:
+        yield cfg
+    finally:
+        active_config.reset(token)
+
+
+# Returns a function that runs `fn` in (a copy of) the context of the caller, e.g. in a worker thread
+def bind_context(fn: Callable) -> Callable:
+    context = copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+
+    return run
+
+
+# Forwards attribute access to the current configuration, so that modules can import `config`
+# without the command line being parsed and the configuration file being read at import time
+class ConfigProxy:
+
+    __slots__ = ()
+
+    @property
+    def __dict__(self):
+        return vars(current_config())
+
+    def __getattr__(self, name: str):
+        return getattr(current_config(), name)
+
+    def __setattr__(self, name: str, value):
+        setattr(current_config(), name, value)
+
+    def __delattr__(self, name: str):
+        delattr(current_config(), name)
+
+    def __repr__(self):
+        return repr(current_config())
+
 
-if 'unittest' in sys.modules:
-    config = Config(api_token='123456')
-else:
-    config: Config = Config.read_config(sys.argv)
+config: Config = ConfigProxy()
@@ -0,0 +1,102 @@
+import signal
+import time
+
+from datetime import datetime, timedelta, timezone
+from syslog import LOG_ERR, LOG_INFO, LOG_NOTICE
+from traceback import format_exc
+from typing import Callable
+
+from hetzner_snap_and_rotate.config import Config, config
+from hetzner_snap_and_rotate.logger import log
+from hetzner_snap_and_rotate.periods import Period
+
+
+# Delay after a period boundary, so that new snapshots are safely created within the new period
+tick_delay = timedelta(seconds=5)
+
+
+# Returns the shortest rotation period of any server, or DAILY if no rotation period is configured
+def tick_period(cfg: Config) -> Period:
+    server_configs = list(cfg.servers.values()) + [cfg.group_server(g, '') for g in cfg.server_groups.values()]
+    for project in cfg.project_configs.values():
+        server_configs.extend(project.servers.values())
+        server_configs.extend(project.group_server(g, '') for g in project.server_groups.values())
+
+    for p in Period:
+        if any((getattr(c, p.config_name, 0) or 0) > 0 for c in server_configs):
+            return p
+
+    return Period.DAILY
+
+
+# Replaces the configuration in place since other modules hold references to it,
+# returns whether the configuration was valid
+def reload_config(cfg: Config, sys_argv: list[str]) -> bool:
+    try:
+        reloaded = Config.read_config(sys_argv, api_token=cfg.api_token)
+
+    except SystemExit:
+        log('Unable to reload the configuration, keeping the previous one', LOG_ERR)
+        return False
+
+    vars(cfg).update(vars(reloaded))
+    log('Configuration has been reloaded', LOG_NOTICE)
+    return True
+
+
+# Calls `run` shortly after each start of the shortest configured rotation period
+# until SIGTERM or SIGINT is received. SIGHUP reloads the configuration.
+class Daemon:
+
+    def __init__(self, run: Callable[[], int], sys_argv: list[str]):
+        self.run = run
+        self.sys_argv = sys_argv
+        self.terminated = False
+        self.hangup = False
+
+    def terminate(self, signum=None, frame=None):
+        self.terminated = True
+
+    def reload(self, signum=None, frame=None):
+        self.hangup = True
+
+    def next_tick(self, now: datetime) -> datetime:
+        return tick_period(config).next_start(now) + tick_delay
+
+    # Sleeps in short steps so that signals are handled within a second,
+    # returns whether the tick was reached
+    def sleep_until(self, tick: datetime) -> bool:
+        while not (self.terminated or self.hangup):
+            remaining = (tick - datetime.now(tz=timezone.utc)).total_seconds()
+            if remaining <= 0:
+                return True
+
+            time.sleep(min(remaining, 1))
+
+        return False
+
+    def serve(self) -> int:
+        signal.signal(signal.SIGTERM, self.terminate)
+        signal.signal(signal.SIGINT, self.terminate)
+        signal.signal(signal.SIGHUP, self.reload)
+
+        log('Running as a daemon', LOG_NOTICE)
+
+        while not self.terminated:
+            tick = self.next_tick(datetime.now(tz=timezone.utc))
+            log('Next run at %s', LOG_INFO, tick.astimezone(config.local_tz))
+
+            if self.sleep_until(tick):
+                try:
+                    return_value = self.run()
+                    log('Run completed with exit status %d', LOG_INFO, return_value)
+
+                except Exception:
+                    log(format_exc(limit=-1), LOG_ERR)
+
+            if self.hangup:
+                self.hangup = False
+                reload_config(config, self.sys_argv)
+
+        log('Terminating', LOG_NOTICE)
+        return 0
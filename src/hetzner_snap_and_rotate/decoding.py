@@ -0,0 +1,157 @@
+import threading
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import fields, is_dataclass
+from datetime import datetime
+from enum import Enum
+from types import NoneType, UnionType
+from typing import Any, Callable, Optional, Union, get_args, get_origin, get_type_hints
+from weakref import WeakKeyDictionary
+
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
+
+
+# Parses ISO 8601 timestamps as returned by the API. Before Python 3.11, datetime.fromisoformat()
+# accepts neither 'Z' nor fractional seconds with a number of digits other than three or six
+def parse_timestamp(text: str) -> datetime:
+    if text.endswith('Z'):
+        text = text[:-1] + '+00:00'
+
+    dot = text.find('.')
+    if dot >= 0:
+        end = dot + 1
+        while (end < len(text)) and text[end].isdigit():
+            end += 1
+
+        fraction = text[dot+1:end]
+        text = text[:dot] + ('.' + (fraction + '00000')[:6] if fraction else '') + text[end:]
+
+    return datetime.fromisoformat(text)
+
+
+def identity(value):
+    return value
+
+
+def converter(tp) -> Callable[[Any], Any]:
+    origin = get_origin(tp)
+
+    if origin in [Union, UnionType]:
+        # Optional[X]; None values are never converted
+        args = [a for a in get_args(tp) if a is not NoneType]
+        return converter(args[0]) if len(args) == 1 else identity
+
+    if origin is list:
+        args = get_args(tp)
+        convert = converter(args[0]) if args else identity
+
+        if convert is identity:
+            return list
+
+        return lambda values: [convert(v) if v is not None else None for v in values]
+
+    if tp is datetime:
+        return parse_timestamp
+
+    if isinstance(tp, type) and issubclass(tp, Enum):
+        return tp
+
+    if is_dataclass(tp):
+        return decoder(tp)
+
+    return identity
+
+
+# Decoded objects of fields with metadata {'intern': True}, by type and JSON content. They are shared
+# only within an interning scope, so that they are released after decoding and do not keep outdated
+# configurations of servers; outside a scope, nothing is interned.
+interned: ContextVar[Optional[dict[tuple, Any]]] = ContextVar('interned', default=None)
+
+
+# Shares interned objects until the outermost scope is left
+@contextmanager
+def interning_scope():
+    token = interned.set({}) if interned.get() is None else None
+
+    try:
+        yield
+
+    finally:
+        if token is not None:
+            interned.reset(token)
+
+
+def interning(convert: Callable, cls) -> Callable:
+
+    def do_intern(value):
+        table = interned.get()
+        if table is None:
+            return convert(value)
+
+        try:
+            key = (cls, tuple(value.items()))
+            hash(key)
+        except (AttributeError, TypeError):
+            return convert(value)
+
+        obj = table.get(key)
+        if obj is None:
+            obj = table.setdefault(key, convert(value))
+
+        return obj
+
+    return do_intern
+
+
+# Decodes a JSON object into a dataclass through a field map that is compiled once per class
+class Decoder:
+
+    def __init__(self, cls):
+        self.cls = cls
+        self.fields: list[tuple[str, Callable]] = []
+
+    def compile(self):
+        hints = get_type_hints(self.cls)
+        self.fields = [
+            (f.name, interning(converter(hints[f.name]), hints[f.name]) if f.metadata.get('intern')
+                else converter(hints[f.name]))
+            for f in fields(self.cls) if f.init
+        ]
+
+    def __call__(self, obj: dict):
+        kwargs = {}
+
+        for name, convert in self.fields:
+            try:
+                value = obj[name]
+            except KeyError:
+                continue
+
+            kwargs[name] = convert(value) if value is not None else None
+
+        return self.cls(**kwargs)
+
+
+decoders: WeakKeyDictionary = WeakKeyDictionary()
+decoders_lock = threading.RLock()
+
+
+def decoder(cls) -> Decoder:
+    with decoders_lock:
+        d = decoders.get(cls)
+
+        if d is None:
+            # Register before compiling so that recursive types find their own decoder
+            d = decoders[cls] = Decoder(cls)
+            d.compile()
+
+        return d
+
+
+def decode(return_type, content: Union[bytes, str]):
+    with interning_scope():
+        return decoder(return_type)(loads(content))
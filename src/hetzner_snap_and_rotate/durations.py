@@ -0,0 +1,155 @@
+import json
+import math
+import os
+import threading
+import time
+
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from syslog import LOG_DEBUG, LOG_WARNING
+from typing import Optional
+
+from hetzner_snap_and_rotate.config import Config
+from hetzner_snap_and_rotate.logger import log
+
+
+# Returns the smallest sample that is not exceeded by `percent` percent of the samples (nearest rank)
+def percentile(samples: list[float], percent: float) -> float:
+    ordered = sorted(samples)
+    return ordered[max(math.ceil(len(ordered) * percent / 100), 1) - 1]
+
+
+# The durations (in s) of the actions of each server, keyed by server id since server names
+# need to be unique only within a project. Kept in a JSON file between runs if a path is specified.
+@dataclass(kw_only=True)
+class DurationHistory:
+
+    # Version of the file format
+    version = 1
+
+    # Number of durations that are kept per server and action
+    max_samples = 100
+
+    path: Optional[str] = None
+
+    # {server id: {'name': ..., 'durations': {command: [[unix time, duration(, 1 if timed out)], ...]}}},
+    # oldest first
+    servers: dict[str, dict] = field(default_factory=dict)
+
+    def __post_init__(self):
+        self.lock = threading.Lock()
+
+    # Replaces the recorded durations by those in the file
+    def open(self, path: Optional[str]):
+        servers = {}
+
+        if path is not None:
+            try:
+                with open(path) as f:
+                    content = json.load(f)
+
+                if content.get('version') == DurationHistory.version:
+                    servers = content['servers']
+                else:
+                    log('Duration history [%s] is outdated, ignoring it', LOG_WARNING, path)
+
+            except FileNotFoundError:
+                pass
+
+            except (OSError, ValueError, KeyError) as ex:
+                log('Duration history [%s] is unreadable, ignoring it: %s', LOG_WARNING, path, ex)
+
+        with self.lock:
+            self.path = path
+            self.servers = servers
+
+    def save(self):
+        if self.path is None:
+            return
+
+        with self.lock:
+            content = json.dumps({'version': DurationHistory.version, 'servers': self.servers})
+
+        # Replace the file atomically so that an interrupted run leaves the previous history intact
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+
+        os.replace(tmp_path, self.path)
+
+    # An action that timed out is recorded with the time elapsed until then, which is less than its actual duration
+    def record(self, server_id: int, server_name: str, command: str, duration: float, timed_out: bool = False):
+        with self.lock:
+            entry = self.servers.setdefault(str(server_id), {'name': server_name, 'durations': {}})
+            entry['name'] = server_name
+
+            samples = entry['durations'].setdefault(command, [])
+            samples.append([round(time.time()), round(duration, 3)] + ([1] if timed_out else []))
+            del samples[:-DurationHistory.max_samples]
+
+    def samples(self, server_id: int, command: str) -> list[list]:
+        with self.lock:
+            entry = self.servers.get(str(server_id), {})
+            return list(entry.get('durations', {}).get(command, []))
+
+    def durations(self, server_id: int, command: str) -> list[float]:
+        return [s[1] for s in self.samples(server_id, command)]
+
+    # Returns the timeout (in s) of an action of a server: a percentile of its recorded durations times
+    # a factor, between a floor and a ceiling, or `static` if adaptive timeouts are not configured
+    # or if there are too few durations. After the action has timed out, the larger of the ceiling and
+    # `static` applies once so that durations which have outgrown the timeout can be recorded.
+    def timeout(self, server_id: int, server_config: Config.Server, command: str, static: float) -> float:
+        adaptive = getattr(server_config, 'adaptive_timeouts', None)
+        if adaptive is None:
+            return static
+
+        samples = self.samples(server_id, command)
+        if samples and len(samples[-1]) > 2:
+            timeout = max(adaptive.ceiling, static)
+
+        elif len(samples) < adaptive.min_samples:
+            return static
+
+        else:
+            timeout = min(max(percentile([s[1] for s in samples], adaptive.percentile) * adaptive.factor,
+                              adaptive.floor), adaptive.ceiling)
+
+        log('Server [%s]: %s timeout is %.0fs', LOG_DEBUG, getattr(server_config, 'name', server_id), command,
+            timeout, action=command)
+        return timeout
+
+    # One line per server and action: number of durations, median, p99, latest duration, and the
+    # trend, i.e. how much the newer half of the durations differs on average from the older half
+    def report(self) -> list[str]:
+        lines = []
+
+        with self.lock:
+            servers = sorted(self.servers.items(), key=lambda item: item[1]['name'])
+
+            for server_id, entry in servers:
+                for command, samples in sorted(entry['durations'].items()):
+                    durations = [s[1] for s in samples]
+                    n = len(durations)
+                    latest = datetime.fromtimestamp(samples[-1][0], tz=timezone.utc).astimezone()
+
+                    trend = ''
+                    if n >= 4:
+                        older, newer = durations[:n // 2], durations[n // 2:]
+                        older_avg = sum(older) / len(older)
+                        newer_avg = sum(newer) / len(newer)
+                        if older_avg > 0:
+                            trend = f'{(newer_avg / older_avg - 1) * 100:+.0f}%'
+
+                    lines.append(f'{entry["name"]:<20} {command:<13} {n:>4} {percentile(durations, 50):>8.1f}s '
+                                 f'{percentile(durations, 99):>8.1f}s {durations[-1]:>8.1f}s {trend:>7}  '
+                                 f'{latest:%Y-%m-%d %H:%M}')
+
+        if lines:
+            lines.insert(0, f'{"Server":<20} {"Action":<13} {"n":>4} {"median":>9} {"p99":>9} {"latest":>9} '
+                            f'{"trend":>7}  latest at')
+
+        return lines
+
+
+duration_history = DurationHistory()
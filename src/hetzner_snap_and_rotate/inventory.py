@@ -0,0 +1,162 @@
+import json
+import os
+
+from dataclasses import dataclass, field
+from syslog import LOG_DEBUG, LOG_INFO, LOG_WARNING
+from typing import Iterable, Optional
+
+from hetzner_snap_and_rotate.api import Page
+from hetzner_snap_and_rotate.config import config
+from hetzner_snap_and_rotate.decoding import decoder, interning_scope, parse_timestamp
+from hetzner_snap_and_rotate.logger import log
+from hetzner_snap_and_rotate.servers import Server
+from hetzner_snap_and_rotate.snapshots import Snapshot, Snapshots
+
+
+def encode_snapshot(sn: Snapshot) -> dict:
+    return {
+        'id': sn.id,
+        'description': sn.description,
+        'protection': {'delete': sn.protection.delete} if sn.protection is not None else None,
+        'created': sn.created.isoformat(),
+        'created_from': {'id': sn.created_from.id, 'name': sn.created_from.name},
+        'labels': sn.labels,
+    }
+
+
+# A local copy of the snapshot listing that is kept in a JSON file between runs.
+# Since image ids increase with creation time, only snapshots that are newer
+# than the newest cached one need to be loaded from the API, newest first.
+@dataclass(kw_only=True)
+class Inventory:
+
+    # Version of the file format
+    version = 1
+
+    # Without a path, the inventory is kept only in memory
+    path: Optional[str] = None
+
+    # The label selector the cached listing was filtered by
+    label_selector: Optional[str] = None
+
+    # Cached snapshot JSON objects, newest first
+    images: list[dict] = field(default_factory=list)
+
+    @staticmethod
+    def open(path: Optional[str]):
+        inventory = Inventory(path=path, label_selector=config.label_selector())
+        if path is None:
+            return inventory
+
+        try:
+            with open(path) as f:
+                content = json.load(f)
+
+            if (content.get('version') == Inventory.version
+                    and content.get('label_selector') == inventory.label_selector):
+                inventory.images = content['images']
+            else:
+                log('Inventory [%s] is outdated, ignoring it', LOG_INFO, path)
+
+        except FileNotFoundError:
+            pass
+
+        except (OSError, ValueError, KeyError) as ex:
+            log('Inventory [%s] is unreadable, ignoring it: %s', LOG_WARNING, path, ex)
+
+        return inventory
+
+    # Each project needs an inventory file of its own, e.g. 'inventory-<project>.json'
+    @staticmethod
+    def project_path(path: str, project: Optional[str]) -> str:
+        if project is None:
+            return path
+
+        root, ext = os.path.splitext(path)
+        return f'{root}-{project}{ext}'
+
+    def save(self):
+        if self.path is None:
+            return
+
+        content = {'version': Inventory.version, 'label_selector': self.label_selector, 'images': self.images}
+
+        # Replace the file atomically so that an interrupted run leaves the previous inventory intact
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(content, f)
+
+        os.replace(tmp_path, self.path)
+
+    def snapshots(self) -> list[Snapshot]:
+        with interning_scope():
+            return list(map(decoder(Snapshot), self.images))
+
+    # Loads the snapshots that are newer than the newest cached one, and reloads
+    # the whole listing if the cache does not agree with the API
+    def refresh(self) -> list[Snapshot]:
+        if self.images:
+            try:
+                if self.load_newer():
+                    return self.snapshots()
+
+            except Exception as ex:
+                log('Inventory [%s] could not be refreshed: %s', LOG_WARNING, self.path, ex)
+
+            log('Inventory [%s] is inconsistent, reloading all snapshots', LOG_INFO, self.path)
+
+        self.images = [encode_snapshot(sn) for sn in Snapshots.iter_snapshots()]
+        self.images.sort(key=lambda img: parse_timestamp(img['created']), reverse=True)
+        return self.snapshots()
+
+    # Returns whether the cached and the newer snapshots together match the listing of the API
+    def load_newer(self) -> bool:
+        cached = {img['id']: img for img in self.images}
+        newer: list[dict] = []
+        total_entries = None
+        known = None
+
+        newer_ids: set[int] = set()
+
+        for page in Page.iter_pages(return_type=Snapshots, api_path='images', api_token=config.api_token,
+                                    params=Snapshots.params(sort='id:desc'), prefetch=False):
+            if total_entries is None:
+                total_entries = page.meta.pagination.total_entries
+
+            for sn in page.images:
+                known = cached.get(sn.id)
+                if known is not None:
+                    break
+
+                # An image created meanwhile shifts the later pages and repeats an entry
+                if sn.id not in newer_ids:
+                    newer_ids.add(sn.id)
+                    newer.append(encode_snapshot(sn))
+
+            if known is not None:
+                break
+
+        # The snapshot where loading stopped must be unchanged, and no cached snapshot
+        # must have been deleted by someone else
+        if known is not None and known != encode_snapshot(sn):
+            return False
+
+        if total_entries is None or total_entries != len(newer) + len(self.images):
+            return False
+
+        log('Inventory [%s]: %d new of %d snapshots', LOG_DEBUG, self.path, len(newer), total_entries)
+        self.images = newer + self.images
+        return True
+
+    # Records the snapshots of the specified servers after they were created, renamed or deleted
+    def update(self, servers: Iterable[Server]):
+        server_ids = set()
+        updated = []
+
+        for srv in servers:
+            server_ids.add(srv.id)
+            updated.extend(map(encode_snapshot, srv.snapshots))
+
+        updated.extend(img for img in self.images if img['created_from']['id'] not in server_ids)
+        updated.sort(key=lambda img: parse_timestamp(img['created']), reverse=True)
+        self.images = updated
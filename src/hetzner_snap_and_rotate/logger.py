@@ -1,7 +1,18 @@
+import atexit
+import json
+import logging
 import os
+import sys
+import threading
 
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
 from sys import argv
 from syslog import openlog, setlogmask, syslog, LOG_UPTO, LOG_INFO
+from typing import Optional
 
 from hetzner_snap_and_rotate.config import config
 
@@ -9,10 +20,115 @@ from hetzner_snap_and_rotate.config import config
 priorities = ['EMERG:  ', 'ALERT:  ', 'CRIT:   ', 'ERR:    ', 'WARNING:', 'NOTICE: ', 'INFO:   ', 'DEBUG:  ']
 syslog_open: bool = False
 
+# Holds the tag that is prepended to the messages logged by the current thread or task;
+# config.bind_context() passes it on to worker threads
+current_tag: ContextVar[Optional[str]] = ContextVar('current_tag', default=None)
+
+# Prevents lines printed by concurrent threads from being interleaved
+print_lock = threading.Lock()
+
+# The logging levels of the syslog priorities; NOTICE lies between INFO and WARNING
+NOTICE = 25
+logging.addLevelName(NOTICE, 'NOTICE')
+levels = [logging.CRITICAL, logging.CRITICAL, logging.CRITICAL, logging.ERROR, logging.WARNING, NOTICE,
+          logging.INFO, logging.DEBUG]
+
+# Messages in JSON format are emitted through this logger, so that other handlers can be attached to it
+json_logger = logging.getLogger('hetzner_snap_and_rotate')
+
+# Writes the queued JSON messages to stdout in a thread of its own
+queue_handler: Optional[QueueHandler] = None
+listener: Optional[QueueListener] = None
+listener_lock = threading.Lock()
+
+
+# Formats a message as a JSON object on a single line, including the tag and fields passed to log()
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+
+        tag = getattr(record, 'tag', None)
+        if tag is not None:
+            entry['tag'] = tag
+
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, default=str)
+
+
+def start_listener():
+    global queue_handler, listener
+
+    with listener_lock:
+        if listener is None:
+            queue = SimpleQueue()
+            handler = logging.StreamHandler(sys.stdout)
+            handler.setFormatter(JsonFormatter())
+
+            queue_handler = QueueHandler(queue)
+            json_logger.addHandler(queue_handler)
+            json_logger.setLevel(logging.DEBUG)
+            json_logger.propagate = False
+
+            listener = QueueListener(queue, handler)
+            listener.start()
+            atexit.register(stop_listener)
+
+
+# Writes all queued messages before returning
+def stop_listener():
+    global queue_handler, listener
+
+    with listener_lock:
+        if listener is not None:
+            json_logger.removeHandler(queue_handler)
+            listener.stop()
+            queue_handler = listener = None
+
+
+# Nested tags are joined, e.g. '[project/server]'; a tag of None leaves the current tag unchanged
+@contextmanager
+def log_tag(tag: Optional[str]):
+    previous = current_tag.get()
+    token = current_tag.set(f'{previous}/{tag}' if previous and tag else (tag or previous))
+    try:
+        yield
+    finally:
+        current_tag.reset(token)
+
+
+# Tells whether messages of this priority are logged, e.g. to skip preparing them
+def enabled(priority: int) -> bool:
+    return priority <= config.priority
+
+
+# `message` is formatted with `args` (%-style) only if it is actually logged.
+# `fields` (e.g. server, snapshot_id, action, duration) are added to messages in JSON format.
+def log(message: str, priority: int = LOG_INFO, *args, **fields):
+    if not enabled(priority):
+        return
+
+    if args:
+        message = message % args
+
+    tag = current_tag.get()
+
+    if config.facility is None and config.log_format == 'json':
+        if listener is None:
+            start_listener()
+
+        json_logger.log(levels[priority], message, extra={'tag': tag, 'fields': fields})
+        return
+
+    if tag is not None:
+        message = f'[{tag}] {message}'
 
-def log(message: str, priority: int = LOG_INFO):
     if config.facility is None:
-        if priority <= config.priority:
+        with print_lock:
             print(f'{priorities[priority]} {message}')
 
     else:
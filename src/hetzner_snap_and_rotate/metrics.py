@@ -0,0 +1,230 @@
+import os
+import re
+import threading
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Label values, in the order of the label names of a metric
+LabelValues = tuple[str, ...]
+
+
+def escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names: tuple[str, ...], values: LabelValues, extra: str = '') -> str:
+    pairs = [f'{n}="{escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+
+    type: str
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+
+    # The name of the sample family that HELP and TYPE refer to
+    @property
+    def family(self) -> str:
+        return self.name
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        return [f'# HELP {self.family} {self.help}', f'# TYPE {self.family} {self.type}'] + self.samples()
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self.values: dict[LabelValues, float] = {}
+
+    @property
+    def family(self) -> str:
+        return f'{self.name}_total'
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def value(self, *label_values: str) -> float:
+        with self.lock:
+            return self.values.get(label_values, 0)
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            return [f'{self.family}{format_labels(self.labels, lv)} {format_value(v)}'
+                    for lv, v in sorted(self.values.items())]
+
+
+class Gauge(Counter):
+
+    type = 'gauge'
+
+    @property
+    def family(self) -> str:
+        return self.name
+
+    def set(self, *label_values: str, value: float):
+        with self.lock:
+            self.values[label_values] = value
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            return [f'{self.name}{format_labels(self.labels, lv)} {format_value(v)}'
+                    for lv, v in sorted(self.values.items())]
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    # Durations (in s) of API requests, actions and snapshot creation
+    default_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = None):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets or Histogram.default_buckets) + (float('inf'),)
+
+        # Non-cumulative bucket counts and sum of the observed values
+        self.counts: dict[LabelValues, list[int]] = {}
+        self.sums: dict[LabelValues, float] = {}
+
+    def observe(self, *label_values: str, value: float):
+        with self.lock:
+            counts = self.counts.get(label_values)
+            if counts is None:
+                counts = self.counts[label_values] = [0] * len(self.buckets)
+                self.sums[label_values] = 0
+
+            counts[bisect_left(self.buckets, value)] += 1
+            self.sums[label_values] += value
+
+    def count(self, *label_values: str) -> int:
+        with self.lock:
+            return sum(self.counts.get(label_values, []))
+
+    def samples(self) -> list[str]:
+        lines = []
+
+        with self.lock:
+            for lv, counts in sorted(self.counts.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    le = f'le="{format_value(bound)}"'
+                    lines.append(f'{self.name}_bucket{format_labels(self.labels, lv, le)} {cumulative}')
+
+                lines.append(f'{self.name}_sum{format_labels(self.labels, lv)} {format_value(self.sums[lv])}')
+                lines.append(f'{self.name}_count{format_labels(self.labels, lv)} {cumulative}')
+
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    # Renders all metrics in the Prometheus text exposition format
+    def render(self) -> str:
+        return ''.join(line + '\n' for m in self.metrics for line in m.render())
+
+
+registry = Registry()
+
+api_requests = registry.register(Counter(
+    'hetzner_api_requests', 'API requests by endpoint, method and HTTP status', ('endpoint', 'method', 'status')))
+
+api_request_duration = registry.register(Histogram(
+    'hetzner_api_request_duration_seconds', 'API request latency, including retries',
+    ('endpoint', 'method'), buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)))
+
+action_duration = registry.register(Histogram(
+    'hetzner_action_duration_seconds', 'Time from starting a server action until it completed', ('command',)))
+
+snapshot_duration = registry.register(Histogram(
+    'hetzner_snapshot_creation_seconds', 'Time taken to create a snapshot, by server', ('server',)))
+
+rotation_operations = registry.register(Counter(
+    'hetzner_rotation_operations', 'Snapshots renamed or deleted by rotation', ('operation',)))
+
+errors = registry.register(Counter(
+    'hetzner_errors', 'Failures by stage', ('stage',)))
+
+run_duration = registry.register(Histogram(
+    'hetzner_run_duration_seconds', 'Duration of a complete run'))
+
+last_run = registry.register(Gauge(
+    'hetzner_last_run_timestamp_seconds', 'Unix time at which the last run completed'))
+
+last_run_status = registry.register(Gauge(
+    'hetzner_last_run_status', 'Exit status of the last run, 0 if all operations succeeded'))
+
+
+# Numeric path segments (ids) would give each server, image and action its own time series
+id_pattern = re.compile(r'(?<=/)\d+(?=/|$)')
+
+
+def endpoint(api_path: str) -> str:
+    return id_pattern.sub('{id}', api_path)
+
+
+# Writes the metrics atomically so that the node_exporter textfile collector never reads a partial file
+def write_textfile(path: str):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(registry.render())
+
+    os.replace(tmp_path, path)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+
+        content = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Serves the metrics at http://<address>:<port>/metrics from a background thread
+def serve(port: int, address: str = '') -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+
+    return server
@@ -1,6 +1,7 @@
 from calendar import monthrange
 from datetime import datetime, timedelta
 from enum import Enum
+from functools import lru_cache
 
 
 class Period(Enum):
@@ -14,6 +15,10 @@ class Period(Enum):
     def previous_quarter_hour(t: datetime):
         return t - timedelta(minutes=15)
 
+    @staticmethod
+    def next_quarter_hour(t: datetime):
+        return t + timedelta(minutes=15)
+
     @staticmethod
     def start_of_hour(t: datetime):
         prev = t - timedelta(seconds=1)
@@ -23,6 +28,10 @@ class Period(Enum):
     def previous_hour(t: datetime):
         return t - timedelta(hours=1)
 
+    @staticmethod
+    def next_hour(t: datetime):
+        return t + timedelta(hours=1)
+
     @staticmethod
     def start_of_day(t: datetime):
         prev = t - timedelta(seconds=1)
@@ -32,6 +41,10 @@ class Period(Enum):
     def previous_day(t: datetime):
         return t - timedelta(days=1)
 
+    @staticmethod
+    def next_day(t: datetime):
+        return t + timedelta(days=1)
+
     @staticmethod
     def start_of_week(t: datetime):
         prev = t - timedelta(seconds=1)
@@ -42,6 +55,10 @@ class Period(Enum):
     def previous_week(t: datetime):
         return t - timedelta(weeks=1)
 
+    @staticmethod
+    def next_week(t: datetime):
+        return t + timedelta(weeks=1)
+
     @staticmethod
     def start_of_month(t: datetime):
         prev = t - timedelta(seconds=1)
@@ -54,6 +71,13 @@ class Period(Enum):
         day = min(t.day, monthrange(year, month)[1])
         return datetime(year, month, day, t.hour, t.minute, t.second, t.microsecond, t.tzinfo)
 
+    @staticmethod
+    def next_month(t: datetime):
+        year = t.year if t.month < 12 else t.year+1
+        month = t.month+1 if t.month < 12 else 1
+        day = min(t.day, monthrange(year, month)[1])
+        return datetime(year, month, day, t.hour, t.minute, t.second, t.microsecond, t.tzinfo)
+
     @staticmethod
     def start_of_quarter_year(t: datetime):
         prev = t - timedelta(seconds=1)
@@ -66,6 +90,13 @@ class Period(Enum):
         day = min(t.day, monthrange(year, month)[1])
         return datetime(year, month, day, t.hour, t.minute, t.second, t.microsecond, t.tzinfo)
 
+    @staticmethod
+    def next_quarter_year(t: datetime):
+        year = t.year if t.month < 10 else t.year+1
+        month = t.month+3 if t.month < 10 else t.month-9
+        day = min(t.day, monthrange(year, month)[1])
+        return datetime(year, month, day, t.hour, t.minute, t.second, t.microsecond, t.tzinfo)
+
     @staticmethod
     def start_of_year(t: datetime):
         prev = t - timedelta(seconds=1)
@@ -77,32 +108,78 @@ class Period(Enum):
         day = t.day if (t.month != 2 and t.day != 29) else 28
         return datetime(year, t.month, day, t.hour, t.minute, t.second, t.microsecond, t.tzinfo)
 
-    QUARTER_HOURLY = 'quarter_hourly', start_of_quarter_hour, previous_quarter_hour
-    HOURLY = 'hourly', start_of_hour, previous_hour
-    DAILY = 'daily', start_of_day, previous_day
-    WEEKLY = 'weekly', start_of_week, previous_week
-    MONTHLY = 'monthly', start_of_month, previous_month
-    QUARTER_YEARLY = 'quarter_yearly', start_of_quarter_year, previous_quarter_year
-    YEARLY = 'yearly', start_of_year, previous_year
+    @staticmethod
+    def next_year(t: datetime):
+        year = t.year+1
+        day = t.day if (t.month != 2 and t.day != 29) else 28
+        return datetime(year, t.month, day, t.hour, t.minute, t.second, t.microsecond, t.tzinfo)
+
+    QUARTER_HOURLY = 'quarter_hourly', start_of_quarter_hour, previous_quarter_hour, next_quarter_hour
+    HOURLY = 'hourly', start_of_hour, previous_hour, next_hour
+    DAILY = 'daily', start_of_day, previous_day, next_day
+    WEEKLY = 'weekly', start_of_week, previous_week, next_week
+    MONTHLY = 'monthly', start_of_month, previous_month, next_month
+    QUARTER_YEARLY = 'quarter_yearly', start_of_quarter_year, previous_quarter_year, next_quarter_year
+    YEARLY = 'yearly', start_of_year, previous_year, next_year
 
     config_name: str
 
     def previous_period(self, t: datetime):
         pass
 
+    def next_period(self, t: datetime):
+        pass
+
     def start_of_period(self, t:datetime):
         pass
 
+    # Returns the first period boundary after t
+    def next_start(self, t: datetime) -> datetime:
+        return self.next_period(self.start_of_period(t + timedelta(seconds=1)))
+
     def previous_periods(self, start: datetime, count: int):
         for i in range(0, count):
             start = self.previous_period(start)
             yield start
 
-    def __new__(cls, value: str, start_of_period, previous_period):
+    # Same as previous_periods() but computed only once per run for each
+    # period, start and count, e.g. for all servers having the same schedule
+    def boundaries(self, start: datetime, count: int) -> tuple[datetime, ...]:
+        return period_boundaries(self, start, count)
+
+    def __new__(cls, value: str, start_of_period, previous_period, next_period):
         member = object.__new__(cls)
         member._value_ = value
         member.config_name = value
         member.previous_period = previous_period
+        member.next_period = next_period
         member.start_of_period = start_of_period
 
         return member
+
+
+@lru_cache(maxsize=1024)
+def period_boundaries(period: Period, start: datetime, count: int) -> tuple[datetime, ...]:
+    return tuple(period.previous_periods(start, count))
+
+
+# Formats of the keys of the calendar periods, see period_key()
+period_key_formats = {
+    Period.QUARTER_HOURLY: '%Y-%m-%d_%H%M',
+    Period.HOURLY: '%Y-%m-%d_%H',
+    Period.DAILY: '%Y-%m-%d',
+    Period.WEEKLY: '%G-W%V',
+    Period.MONTHLY: '%Y-%m',
+    Period.YEARLY: '%Y',
+}
+
+
+# Identifies the calendar period that contains t, e.g. '2025-W27' or '2025-Q3';
+# the key never changes and is a valid label value
+def period_key(period: Period, t: datetime) -> str:
+    start = period.start_of_period(t + timedelta(seconds=1))
+
+    if period == Period.QUARTER_YEARLY:
+        return f'{start.year}-Q{(start.month - 1) // 3 + 1}'
+
+    return start.strftime(period_key_formats[period])
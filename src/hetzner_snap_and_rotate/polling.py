@@ -0,0 +1,106 @@
+import threading
+
+from dataclasses import dataclass, field
+from datetime import timedelta
+from random import uniform
+from typing import Iterator, Optional
+
+from hetzner_snap_and_rotate.config import Config
+
+
+class PollingStrategy:
+
+    # Yields the successive intervals (in s) between polls
+    def intervals(self) -> Iterator[float]:
+        raise NotImplementedError
+
+
+@dataclass(kw_only=True)
+class FixedInterval(PollingStrategy):
+
+    interval: float = 5
+
+    def intervals(self) -> Iterator[float]:
+        while True:
+            yield self.interval
+
+
+@dataclass(kw_only=True)
+class ExponentialBackoff(PollingStrategy):
+
+    polling: Config.Polling
+
+    def intervals(self) -> Iterator[float]:
+        p = self.polling
+        interval = p.initial_interval
+        elapsed = 0.0
+
+        while True:
+            # Poll at the initial interval during the fast-poll window, then back off
+            if elapsed >= p.fast_poll_window:
+                interval = min(interval * p.factor, p.max_interval)
+
+            jittered = min(interval * uniform(1 - p.jitter, 1 + p.jitter), p.max_interval)
+            elapsed += jittered
+            yield jittered
+
+
+# Short actions finish within seconds, creating an image may take minutes
+default_polling: dict[str, Config.Polling] = {
+    'poweron': Config.Polling(initial_interval=1, fast_poll_window=10, factor=1.5, max_interval=5),
+    'poweroff': Config.Polling(initial_interval=1, fast_poll_window=10, factor=1.5, max_interval=5),
+    'shutdown': Config.Polling(initial_interval=1, fast_poll_window=10, factor=1.5, max_interval=5),
+    'create_image': Config.Polling(initial_interval=2, fast_poll_window=10, factor=1.5, max_interval=30),
+}
+
+
+def polling_strategy(config: Optional[Config.Defaults], command: str) -> PollingStrategy:
+    configured = getattr(config, 'polling', None) or {}
+    polling = configured.get(command) or default_polling.get(command) or Config.Polling()
+
+    return ExponentialBackoff(polling=polling)
+
+
+@dataclass(kw_only=True)
+class Detection:
+
+    # Time from the start of waiting until completion was detected
+    waited: timedelta
+
+    # Time from the completion of the action until it was detected, if known
+    delay: Optional[timedelta]
+
+    polls: int
+
+
+# Records how quickly the completion of actions was detected, for tuning the polling strategies
+@dataclass(kw_only=True)
+class PollingMetrics:
+
+    detections: dict[str, list[Detection]] = field(default_factory=dict)
+
+    def __post_init__(self):
+        self.lock = threading.Lock()
+
+    def record(self, command: str, detection: Detection):
+        with self.lock:
+            self.detections.setdefault(command, []).append(detection)
+
+    def summary(self) -> list[str]:
+        lines = []
+
+        with self.lock:
+            for command, detections in sorted(self.detections.items()):
+                n = len(detections)
+                waited = sum(d.waited.total_seconds() for d in detections) / n
+                polls = sum(d.polls for d in detections) / n
+                delays = [d.delay.total_seconds() for d in detections if d.delay is not None]
+                delay = f'{sum(delays) / len(delays):.1f}s' if delays else 'unknown'
+
+                lines.append(f'{command}: {n} action{"s"[:n!=1]}, avg. {waited:.1f}s waited, '
+                             f'{polls:.1f} polls, {delay} detection delay')
+
+        return lines
+
+
+polling_metrics = PollingMetrics()
@@ -0,0 +1,213 @@
+import json
+
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, asdict
+from datetime import datetime
+from enum import Enum
+from syslog import LOG_DEBUG, LOG_ERR
+from traceback import format_exc
+from typing import Dict, Tuple, Optional
+
+from hetzner_snap_and_rotate.config import Config, bind_context
+from hetzner_snap_and_rotate.logger import enabled, log, log_tag
+from hetzner_snap_and_rotate.metrics import errors, rotation_operations
+from hetzner_snap_and_rotate.periods import Period
+from hetzner_snap_and_rotate.servers import Server
+from hetzner_snap_and_rotate.snapshots import Snapshot
+
+
+# Associates snapshots with their Period type ('latest' if the Period is None) and number
+Rotated = Dict[Snapshot, Tuple[Optional[Period], int]]
+
+
+def rotate(config: Config.Defaults, not_rotated: list[Snapshot], p_end: datetime) -> Rotated:
+    rotated: Rotated = {}
+    latest_start = None
+
+    # Sort only once; the stable sort resolves ties by list order, like the former per-period scans
+    by_created = sorted(not_rotated, key=lambda s: s.created)
+    created = [s.created for s in by_created]
+
+    for p in Period:
+        p_count = getattr(config, p.config_name, 0) or 0
+
+        if p_count > 0:
+            if latest_start is None:
+                latest_start = p.start_of_period(p_end)
+                p_end = latest_start
+
+            for p_num, p_start in enumerate(p.boundaries(p_end, p_count), start=1):
+                # Snapshots are assigned from p_end towards the past, so no snapshot
+                # before p_end has been rotated yet, and the oldest one in this period
+                # is the first one at or after its start
+                start, end = min(p_start, p_end), max(p_start, p_end)
+                i = bisect_left(created, start)
+
+                if i < bisect_left(created, end, lo=i):
+                    rotated[by_created[i]] = (p, p_num)
+                    p_end = p_start
+
+    # Assign numbers (but no period types) to the latest snapshots,
+    # or to all snapshots if no rotation period was configured
+    latest = by_created[bisect_left(created, latest_start):] if latest_start is not None else by_created
+    for l_num, l_sn in enumerate(sorted(latest, key=lambda s: s.created, reverse=True), start=1):
+        rotated[l_sn] = (None, l_num)
+
+    # Leave only the snapshots that are not contained in any rotation period,
+    # also if another object with the same id is
+    rotated_ids = {s.id for s in rotated}
+    not_rotated[:] = [s for s in not_rotated if s.id not in rotated_ids]
+
+    return rotated
+
+
+class OperationType(str, Enum):
+
+    RENAME = 'rename'
+    DELETE = 'delete'
+    RELABEL = 'relabel'
+
+
+@dataclass(kw_only=True)
+class Operation:
+
+    type: OperationType
+    server: str
+    snapshot_id: int
+    description: str
+    new_description: Optional[str] = None
+    protected: bool = False
+    labels: Optional[dict[str, str]] = None
+
+
+@dataclass(kw_only=True)
+class RotationPlan:
+
+    operations: list[Operation] = field(default_factory=list)
+
+    def to_json(self, indent: Optional[int] = None) -> str:
+        return json.dumps(asdict(self), indent=indent)
+
+
+# Determines which snapshots of a server need to be renamed or deleted, without changing anything
+def plan_rotation(server: Server, p_end: datetime) -> list[Operation]:
+    operations: list[Operation] = []
+
+    # Find out which snapshots to preserve for the configured rotation periods,
+    # and note the new rotation period they are now associated with
+    not_rotated: list[Snapshot] = list({sn.id: sn for sn in server.snapshots}.values())
+    rotated = rotate(config=server.config, not_rotated=not_rotated, p_end=p_end)
+
+    # Rename only the snapshots which are now associated with a different rotation period.
+    # With rotation labels, snapshots keep their names, and the names that reflect
+    # their rotation periods are only derived for logging
+    for sn, (p, p_num) in rotated.items():
+        if server.config.rotation_labels:
+            if enabled(LOG_DEBUG):
+                log('Server [%s]: [%s] is [%s]', LOG_DEBUG, server.name, sn.description,
+                    Snapshot.snapshot_name(server=server, snapshot=sn, period=p, period_number=p_num),
+                    server=server.name, snapshot_id=sn.id)
+            continue
+
+        description = Snapshot.snapshot_name(server=server, snapshot=sn, period=p, period_number=p_num)
+
+        if description != sn.description:
+            operations.append(Operation(
+                type=OperationType.RENAME,
+                server=server.name,
+                snapshot_id=sn.id,
+                description=sn.description,
+                new_description=description,
+                protected=sn.protection is not None and sn.protection.delete
+            ))
+
+    # Delete the snapshots which are not contained in any rotation period, but never
+    # a snapshot that is kept, and none twice
+    planned = {sn.id for sn in rotated}
+    for sn in not_rotated:
+        if sn.id in planned:
+            continue
+
+        planned.add(sn.id)
+        operations.append(Operation(
+            type=OperationType.DELETE,
+            server=server.name,
+            snapshot_id=sn.id,
+            description=sn.description,
+            protected=sn.protection is not None and sn.protection.delete
+        ))
+
+    return operations
+
+
+# Adds the creation period labels to the snapshots of a server with rotation labels that do not have
+# all of them yet, and names these snapshots as if they had just been created, i.e. independently of rotation
+def plan_migration(server: Server) -> list[Operation]:
+    operations: list[Operation] = []
+
+    if not server.config.rotation_labels:
+        return operations
+
+    for sn in server.snapshots:
+        labels = Snapshot.period_labels(server, sn.created)
+
+        if not labels.keys() <= sn.labels.keys():
+            operations.append(Operation(
+                type=OperationType.RELABEL,
+                server=server.name,
+                snapshot_id=sn.id,
+                description=sn.description,
+                new_description=Snapshot.snapshot_name(server=server, snapshot=sn),
+                protected=sn.protection is not None and sn.protection.delete,
+                labels=sn.labels | labels
+            ))
+
+    return operations
+
+
+# Applies a plan to the snapshots of the specified servers with bounded concurrency,
+# returns 0 if all operations succeeded or else 1
+def execute_plan(plan: RotationPlan, servers: list[Server], max_parallelism: int = 1) -> int:
+    servers_by_name = {srv.name: srv for srv in servers}
+    snapshots_by_key = {(srv.name, sn.id): sn for srv in servers for sn in srv.snapshots}
+    deleted: set[tuple[str, int]] = set()
+    tagged = max_parallelism > 1
+
+    def apply(op: Operation) -> int:
+        with log_tag(op.server if tagged else None):
+            try:
+                srv = servers_by_name[op.server]
+                sn = snapshots_by_key[(op.server, op.snapshot_id)]
+
+                if op.type == OperationType.RENAME:
+                    sn.set_description(op.new_description)
+
+                elif op.type == OperationType.RELABEL:
+                    sn.relabel(op.labels, op.new_description)
+
+                elif sn.delete(srv, detach=False):
+                    deleted.add((srv.name, sn.id))
+
+                # Protected snapshots are neither renamed nor deleted but may be labeled
+                rotation_operations.inc(
+                    op.type.value if not op.protected or op.type == OperationType.RELABEL else 'protected')
+                return 0
+
+            except Exception:
+                log(format_exc(limit=-1), LOG_ERR)
+                errors.inc('rotation')
+                return 1
+
+    if tagged and len(plan.operations) > 1:
+        with ThreadPoolExecutor(max_workers=max_parallelism) as executor:
+            return_value = max(executor.map(bind_context(apply), plan.operations), default=0)
+    else:
+        return_value = max(map(apply, plan.operations), default=0)
+
+    # Detach the deleted snapshots from their servers in a single pass per server
+    if deleted:
+        for srv in servers:
+            srv.snapshots = [sn for sn in srv.snapshots if (srv.name, sn.id) not in deleted]
+
+    return return_value
@@ -5,11 +5,14 @@ from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from enum import Enum
 from syslog import LOG_NOTICE, LOG_INFO, LOG_WARNING
-from typing import Type
+from typing import Iterable, Type
 
 from hetzner_snap_and_rotate.api import api_request, ApiError, Page, ActionWrapper, RecoverableError
 from hetzner_snap_and_rotate.config import Config, config as global_config
+from hetzner_snap_and_rotate.durations import duration_history
 from hetzner_snap_and_rotate.logger import log
+from hetzner_snap_and_rotate.metrics import action_duration
+from hetzner_snap_and_rotate.polling import PollingStrategy, polling_strategy
 
 
 class ServerStatus(Enum):
@@ -33,7 +36,7 @@ class ServerAction(Enum):
     CREATE_IMAGE = 'create_image'
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, slots=True)
 class Server(JSONWizard):
 
     id: int
@@ -60,9 +63,15 @@ class Server(JSONWizard):
 
         return wrapper.server.status
 
+    # With `wait=False`, returns as soon as the action has been accepted
     def perform_action(self, action: ServerAction, return_type: Type[ActionWrapper] = ActionWrapper,
-                       data: dict = None, timeout: int = 30, retry_interval: int = 5):
+                       data: dict = None, timeout: int = 30, strategy: PollingStrategy = None, wait: bool = True):
+
+        if strategy is None:
+            strategy = polling_strategy(self.config, action.value)
 
+        intervals = strategy.intervals()
+        start = time.monotonic()
         end = datetime.now() + timedelta(seconds=timeout)
 
         while True:
@@ -78,38 +87,55 @@ class Server(JSONWizard):
 
             except RecoverableError as ex:
                 if datetime.now() <= end:
-                    time.sleep(retry_interval)
+                    time.sleep(next(intervals))
                 else:
                     raise ex
 
         if wrapper.action.error:
             raise ApiError(f'Server [{self.name}]: {action.name} failed, details: {wrapper.action.error}')
 
-        wrapper.action.wait_until_completed(timeout)
+        if wait:
+            try:
+                wrapper.action.wait_until_completed(timeout, strategy=strategy)
+            except TimeoutError:
+                duration_history.record(self.id, self.name, action.value, time.monotonic() - start, timed_out=True)
+                raise
+
+            duration = time.monotonic() - start
+            action_duration.observe(action.value, value=duration)
+            duration_history.record(self.id, self.name, action.value, duration)
 
         return wrapper
 
+    # The timeout of an action, adapted to its recorded durations if so configured
+    def timeout(self, action: ServerAction, static: float) -> float:
+        return duration_history.timeout(self.id, self.config, action.value, static)
+
     def power(self, turn_on: bool):
         if turn_on:
-            log(f'Server [{self.name}]: powering on', LOG_NOTICE)
+            log('Server [%s]: powering on', LOG_NOTICE, self.name, server=self.name, action='poweron')
             if not global_config.dry_run:
-                self.perform_action(ServerAction.POWER_ON)
-                log(f'Server [{self.name}]: starting or running', LOG_INFO)
+                self.perform_action(ServerAction.POWER_ON, timeout=self.timeout(ServerAction.POWER_ON, 30))
+                log('Server [%s]: starting or running', LOG_INFO, self.name, server=self.name, action='poweron')
 
         else:
             try:
-                log(f'Server [{self.name}]: shutting down', LOG_NOTICE)
+                log('Server [%s]: shutting down', LOG_NOTICE, self.name, server=self.name, action='shutdown')
                 if not global_config.dry_run:
-                    self.perform_action(ServerAction.SHUTDOWN, timeout = self.config.shutdown_timeout)
-                    log(f'Server [{self.name}]: has been shut down', LOG_INFO)
+                    self.perform_action(ServerAction.SHUTDOWN,
+                                        timeout=self.timeout(ServerAction.SHUTDOWN, self.config.shutdown_timeout))
+                    log('Server [%s]: has been shut down', LOG_INFO, self.name, server=self.name, action='shutdown')
 
             except TimeoutError as timeout_error:
                 if self.config.allow_poweroff:
                     # Unable to shut down in time, try powering off
-                    log(f'Server [{self.name}]: unable to shut down, powering off', LOG_WARNING)
+                    log('Server [%s]: unable to shut down, powering off', LOG_WARNING, self.name,
+                        server=self.name, action='poweroff')
                     if not global_config.dry_run:
-                        self.perform_action(ServerAction.POWER_OFF, timeout = self.config.shutdown_timeout)
-                        log(f'Server [{self.name}]: has been powered off', LOG_INFO)
+                        self.perform_action(ServerAction.POWER_OFF,
+                                            timeout=self.timeout(ServerAction.POWER_OFF, self.config.shutdown_timeout))
+                        log('Server [%s]: has been powered off', LOG_INFO, self.name,
+                            server=self.name, action='poweroff')
 
                 else:
                     # Unable to shut down in time and not allowed to power off
@@ -121,34 +147,49 @@ class Servers(Page, JSONWizard):
 
     servers: list[Server]
 
+    params = {'per_page': Page.max_per_page}
+
+    # Query parameters of the requests that list the configured servers: one request per server
+    # selected on the command line, one per server group if all servers are configured by groups
+    # that the API can select, or else a single request that lists all servers
     @staticmethod
-    def load_servers():
-        servers: Servers = Page.load_page(
-            return_type=Servers,
-            api_path='servers',
-            api_token=global_config.api_token
-        )
+    def queries() -> list[dict]:
+        if global_config.selected_servers is not None:
+            return [{'name': name} for name in global_config.selected_servers]
+
+        if global_config.server_groups and not global_config.servers:
+            queries = [group.params() for group in global_config.server_groups.values()]
+            if None not in queries:
+                return queries
 
-        return servers
+        return [{}]
 
+    # The snapshots are usually attached later and only if needed, see snapshots.SnapshotListing
     @staticmethod
-    def load_configured_servers(snapshots):
-        servers: Servers = Servers.load_servers()
+    def load_configured_servers(snapshots: Iterable = ()):
+        configured: list[Server] = []
         servers_by_id: dict[int, Server] = {}
+        meta = None
+
+        for query in Servers.queries():
+            for page in Page.iter_pages(return_type=Servers, api_path='servers',
+                                        api_token=global_config.api_token, params=Servers.params | query):
+                meta = page.meta
+
+                for srv in page.servers:
+                    if srv.id in servers_by_id:
+                        continue
 
-        for i in range(len(servers.servers)-1, -1, -1):
-            srv = servers.servers[i]
-            cfg: Config.Server = global_config.of_server(srv.name)
+                    cfg: Config.Server = global_config.server_config(srv.name, srv.labels)
 
-            if cfg:
-                srv.config = cfg
-                srv.snapshots = []
-                servers_by_id[srv.id] = srv
-            else:
-                servers.servers.pop(i)
+                    if cfg:
+                        srv.config = cfg
+                        srv.snapshots = []
+                        configured.append(srv)
+                        servers_by_id[srv.id] = srv
 
-        for sn in snapshots.images:
+        for sn in snapshots:
             if sn.created_from.id in servers_by_id:
                 servers_by_id[sn.created_from.id].snapshots.append(sn)
 
-        return servers
+        return Servers(servers=configured, meta=meta)
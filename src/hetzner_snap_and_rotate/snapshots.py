@@ -1,34 +1,46 @@
 import os
+import threading
+import time
 
 from dataclass_wizard import JSONWizard
 from dataclasses import dataclass, field
 from datetime import datetime, timezone
 from random import randint
 from syslog import LOG_INFO, LOG_NOTICE
-from typing import Optional
+from typing import Callable, Iterable, Iterator, Optional
 
-from hetzner_snap_and_rotate.api import Page, api_request, ActionWrapper
+from hetzner_snap_and_rotate.api import Page, api_request, ActionWrapper, ActionStatus, ApiError
 from hetzner_snap_and_rotate.config import config
+from hetzner_snap_and_rotate.decoding import interning_scope
+from hetzner_snap_and_rotate.durations import duration_history
 from hetzner_snap_and_rotate.logger import log
-from hetzner_snap_and_rotate.periods import Period
+from hetzner_snap_and_rotate.metrics import action_duration, snapshot_duration
+from hetzner_snap_and_rotate.periods import Period, period_key
+from hetzner_snap_and_rotate.polling import polling_strategy
 from hetzner_snap_and_rotate.servers import Server, ServerAction
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, slots=True)
 class Protection(JSONWizard):
 
     delete: bool = field(default=False)
 
 
-@dataclass(kw_only=True, unsafe_hash=True)
+# Prefix of the labels that record the calendar periods in which a snapshot was created
+period_label_prefix = 'snap-and-rotate/'
+
+
+@dataclass(kw_only=True, unsafe_hash=True, slots=True)
 class Snapshot(JSONWizard):
 
+    # Equal protections, source servers and labels are decoded into shared objects
+    # which therefore must not be modified
     id: int
     description: str = field(compare=False)
-    protection: Protection = field(compare=False)
+    protection: Protection = field(compare=False, metadata={'intern': True})
     created: datetime = field(compare=False)
-    created_from: Server = field(compare=False)
-    labels: dict = field(default_factory=dict, compare=False)
+    created_from: Server = field(compare=False, metadata={'intern': True})
+    labels: dict = field(default_factory=dict, compare=False, metadata={'intern': True})
 
     @staticmethod
     def snapshot_name(server: Server,
@@ -59,41 +71,90 @@ class Snapshot(JSONWizard):
 
         return result
 
+    # Labels with the keys of the configured rotation periods that contain `created`,
+    # e.g. {'snap-and-rotate/daily': '2025-07-01'}; they remain valid for the lifetime of a snapshot.
+    # Like the rotation periods, these periods start in UTC.
+    @staticmethod
+    def period_labels(server: Server, created: datetime) -> dict[str, str]:
+        created = created.astimezone(tz=timezone.utc)
+        return {
+            period_label_prefix + p.config_name: period_key(p, created)
+            for p in Period if (getattr(server.config, p.config_name, 0) or 0) > 0
+        }
+
     def rename(self, created_from: Server, period: Period, period_number: int):
+        description = Snapshot.snapshot_name(server=created_from, snapshot=self,
+                                             period=period, period_number=period_number)
+
+        if description != self.description:
+            self.set_description(description)
+
+    def set_description(self, description: str):
 
         @dataclass(kw_only=True)
         class Wrapper(JSONWizard):
             image: Snapshot
 
-        description = Snapshot.snapshot_name(server=created_from, snapshot=self,
-                                             period=period, period_number=period_number)
+        if self.protection is None or not self.protection.delete:
+            log('Server [%s]: renaming [%s] to [%s]', LOG_NOTICE,
+                self.created_from.name, self.description, description,
+                server=self.created_from.name, snapshot_id=self.id, action='rename')
 
-        if description != self.description:
-            if self.protection is None or not self.protection.delete:
-                log(f'Server [{self.created_from.name}]: renaming [{self.description}] to [{description}]', LOG_NOTICE)
-
-                if not config.dry_run:
-                    wrapper = api_request(
-                        method='PUT',
-                        return_type=Wrapper,
-                        api_path=f'images/{self.id}',
-                        api_token=config.api_token,
-                        data={'description': description}
-                    )
-                    log(f'Server [{self.created_from.name}]: snapshot [{self.description}] '
-                        f'has been renamed to [{wrapper.image.description}]',
-                        LOG_INFO)
-                    self.description = wrapper.image.description
-
-                else:
-                    self.description = description
+            if not config.dry_run:
+                wrapper = api_request(
+                    method='PUT',
+                    return_type=Wrapper,
+                    api_path=f'images/{self.id}',
+                    api_token=config.api_token,
+                    data={'description': description}
+                )
+                log('Server [%s]: snapshot [%s] has been renamed to [%s]', LOG_INFO,
+                    self.created_from.name, self.description, wrapper.image.description,
+                    server=self.created_from.name, snapshot_id=self.id, action='rename')
+                self.description = wrapper.image.description
 
             else:
-                log(f'Server [{self.created_from.name}]: NOT renaming protected snapshot [{self.description}]', LOG_NOTICE)
+                self.description = description
+
+        else:
+            log('Server [%s]: NOT renaming protected snapshot [%s]', LOG_NOTICE,
+                self.created_from.name, self.description,
+                server=self.created_from.name, snapshot_id=self.id, action='rename')
+
+    # Replaces the labels, and also the description unless the snapshot is protected
+    def relabel(self, labels: dict[str, str], description: str):
+
+        @dataclass(kw_only=True)
+        class Wrapper(JSONWizard):
+            image: Snapshot
+
+        if self.protection is not None and self.protection.delete:
+            description = self.description
+
+        log('Server [%s]: labeling snapshot [%s] as [%s]', LOG_NOTICE,
+            self.created_from.name, self.description, description,
+            server=self.created_from.name, snapshot_id=self.id, action='relabel')
 
-    def delete(self, server: Server):
+        if not config.dry_run:
+            wrapper = api_request(
+                method='PUT',
+                return_type=Wrapper,
+                api_path=f'images/{self.id}',
+                api_token=config.api_token,
+                data={'description': description, 'labels': labels}
+            )
+            self.description = wrapper.image.description
+            self.labels = wrapper.image.labels
+
+        else:
+            self.description = description
+            self.labels = labels
+
+    # Returns whether the snapshot was deleted; `detach` also removes it from the snapshots of the server
+    def delete(self, server: Server, detach: bool = True) -> bool:
         if self.protection is None or not self.protection.delete:
-            log(f'Server [{server.name}]: deleting snapshot [{self.description}]', LOG_NOTICE)
+            log('Server [%s]: deleting snapshot [%s]', LOG_NOTICE, server.name, self.description,
+                server=server.name, snapshot_id=self.id, action='delete')
             if not config.dry_run:
                 api_request(
                     method='DELETE',
@@ -101,12 +162,18 @@ class Snapshot(JSONWizard):
                     api_path=f'images/{self.id}',
                     api_token=config.api_token
                 )
-                log(f'Server [{server.name}]: snapshot [{self.description}] has been deleted', LOG_INFO)
+                log('Server [%s]: snapshot [%s] has been deleted', LOG_INFO, server.name, self.description,
+                    server=server.name, snapshot_id=self.id, action='delete')
+
+            if detach:
+                server.snapshots.remove(self)
 
-            server.snapshots.remove(self)
+            return True
 
         else:
-            log(f'Server [{server.name}]: NOT deleting protected snapshot [{self.description}]', LOG_NOTICE)
+            log('Server [%s]: NOT deleting protected snapshot [%s]', LOG_NOTICE, server.name, self.description,
+                server=server.name, snapshot_id=self.id, action='delete')
+            return False
 
 
 @dataclass(kw_only=True)
@@ -115,37 +182,85 @@ class SnapshotWrapper(ActionWrapper, JSONWizard):
     image: Snapshot
 
 
+# A snapshot whose creation has been accepted by the API but may not have completed yet.
+# It is already contained in the snapshots of its server.
+@dataclass(kw_only=True)
+class PendingSnapshot:
+
+    server: Server
+    snapshot: Snapshot
+    wrapper: Optional[SnapshotWrapper] = None
+    timeout: int = 300
+    start: float = field(default_factory=time.monotonic)
+
+    # Waits until the snapshot has been created, or removes it from the snapshots of its server
+    def wait(self) -> Snapshot:
+        if self.wrapper is None:
+            return self.snapshot
+
+        try:
+            action = self.wrapper.action
+            action.wait_until_completed(self.timeout,
+                                        strategy=polling_strategy(self.server.config, ServerAction.CREATE_IMAGE.value))
+            if action.status == ActionStatus.ERROR:
+                raise ApiError(f'Server [{self.server.name}]: snapshot [{self.snapshot.description}] failed')
+
+        except Exception as ex:
+            if isinstance(ex, TimeoutError):
+                duration_history.record(self.server.id, self.server.name, ServerAction.CREATE_IMAGE.value,
+                                        time.monotonic() - self.start, timed_out=True)
+
+            self.server.snapshots.remove(self.snapshot)
+            raise
+
+        duration = time.monotonic() - self.start
+        action_duration.observe(ServerAction.CREATE_IMAGE.value, value=duration)
+        snapshot_duration.observe(self.server.name, value=duration)
+        duration_history.record(self.server.id, self.server.name, ServerAction.CREATE_IMAGE.value, duration)
+        log('Server [%s]: snapshot [%s] has been created', LOG_INFO, self.server.name, self.snapshot.description,
+            server=self.server.name, snapshot_id=self.snapshot.id, action='create_image', duration=round(duration, 3))
+        return self.snapshot
+
+
 # Ugly hack -- this should be a method of class servers.Server
 # but this would lead to a circular depencency
-def create_snapshot(server: Server, timeout: int = 300) -> Snapshot:
+def begin_snapshot(server: Server, timeout: int = 300) -> PendingSnapshot:
     description = Snapshot.snapshot_name(server=server)
+    labels = server.labels | config.snapshot_labels
+    if server.config.rotation_labels:
+        labels = labels | Snapshot.period_labels(server, datetime.now(tz=timezone.utc))
+
     data = {
         'description': description,
-        'labels': server.labels,
+        'labels': labels,
         'type': 'snapshot'
     }
 
-    log(f'Server [{server.name}]: creating snapshot [{description}]', LOG_NOTICE)
+    log('Server [%s]: creating snapshot [%s]', LOG_NOTICE, server.name, description,
+        server=server.name, action='create_image')
     if not config.dry_run:
+        start = time.monotonic()
         wrapper = server.perform_action(ServerAction.CREATE_IMAGE, return_type=SnapshotWrapper,
-                                        data=data, timeout=timeout)
+                                        data=data, timeout=timeout, wait=False)
         wrapper.image.created_from = server
-        server.snapshots.append(wrapper.image)
-
-        log(f'Server [{server.name}]: snapshot [{description}] has been created', LOG_INFO)
-        return wrapper.image
+        pending = PendingSnapshot(server=server, snapshot=wrapper.image, wrapper=wrapper, timeout=timeout, start=start)
 
     else:
-        snapshot = Snapshot(
+        pending = PendingSnapshot(server=server, snapshot=Snapshot(
             id=randint(1000000, 9999999),
             description=description,
             protection=Protection(delete=False),
             created=datetime.now(tz=timezone.utc),
             created_from=server,
-            labels=server.labels
-        )
-        server.snapshots.append(snapshot)
-        return snapshot
+            labels=labels
+        ))
+
+    server.snapshots.append(pending.snapshot)
+    return pending
+
+
+def create_snapshot(server: Server, timeout: int = 300) -> Snapshot:
+    return begin_snapshot(server, timeout).wait()
 
 
 @dataclass(kw_only=True)
@@ -153,34 +268,84 @@ class Snapshots(Page, JSONWizard):
 
     images: list[Snapshot]
 
+    # Images created while a listing is paged through get higher ids and therefore do not shift
+    # the page boundaries of the default order, unlike with 'created:desc'
     @staticmethod
-    def load_snapshots():
-        return Page.load_page(
-            return_type=Snapshots,
-            api_path='images',
-            api_token=config.api_token,
-            params={'type': 'snapshot'}
-        )
+    def params(sort: str = 'id:asc') -> dict:
+        params = {'type': 'snapshot', 'sort': sort, 'per_page': Page.max_per_page}
 
-    @staticmethod
-    def oldest(start: datetime, end: datetime, snapshots: list[Snapshot]) -> Optional[Snapshot]:
-        if start > end:
-            start, end = end, start
+        # Let the API skip snapshots that were not created by this script
+        label_selector = config.label_selector()
+        if label_selector:
+            params['label_selector'] = label_selector
 
-        matching = sorted(
-            filter(lambda s: start <= s.created < end, snapshots),
-            key=lambda s: s.created
-        )
-
-        return matching[0] if len(matching) else None
+        return params
 
     @staticmethod
-    def latest(start: Optional[datetime], snapshots: list[Snapshot]) -> list[Snapshot]:
-        predicate = (lambda s: s.created >= start) if start is not None else (lambda s: True)
-        matching = sorted(
-            filter(predicate, snapshots),
-            key=lambda s: s.created,
-            reverse=True
+    def iter_snapshots() -> Iterator[Snapshot]:
+        return Page.iter_entities(
+            return_type=Snapshots,
+            api_path='images',
+            api_token=config.api_token,
+            params=Snapshots.params()
         )
 
-        return matching
+
+# Loads the snapshot listing of a project only when the snapshots of a server are first needed,
+# and only once even if they are needed by concurrent threads
+class SnapshotListing:
+
+    def __init__(self, load: Callable[[], Iterable[Snapshot]] = Snapshots.iter_snapshots):
+        self.load = load
+        self.lock = threading.Lock()
+        self.by_server: Optional[dict[int, list[Snapshot]]] = None
+        self.error: Optional[Exception] = None
+
+        # Identities of the Server objects that the listed snapshots were attached to
+        self.attached: set[int] = set()
+
+    @property
+    def loaded(self) -> bool:
+        return self.by_server is not None
+
+    # Returns the listed snapshots by server id, loading them first if necessary
+    def snapshots_by_server(self) -> dict[int, list[Snapshot]]:
+        with self.lock:
+            if self.error is not None:
+                raise self.error
+
+            if self.by_server is None:
+                by_server: dict[int, list[Snapshot]] = {}
+                listed: set[int] = set()
+
+                try:
+                    # Share source servers, protections and labels across all pages of the listing
+                    with interning_scope():
+                        for sn in self.load():
+                            # A snapshot may be listed twice if the listing changed while it was paged through
+                            if sn.id not in listed:
+                                listed.add(sn.id)
+                                by_server.setdefault(sn.created_from.id, []).append(sn)
+
+                except Exception as ex:
+                    # Do not page through the listing again for every server
+                    self.error = ex
+                    raise
+
+                self.by_server = by_server
+
+            return self.by_server
+
+    def of_server(self, server_id: int) -> list[Snapshot]:
+        return self.snapshots_by_server().get(server_id, [])
+
+    # Adds the listed snapshots to those the server already has, e.g. a snapshot that was created
+    # in this run and that may or may not be contained in the listing. This happens only once
+    # per server so that snapshots deleted in the meantime are not attached again.
+    def attach(self, server: Server):
+        if id(server) in self.attached:
+            return
+
+        own_ids = {sn.id for sn in server.snapshots}
+        server.snapshots = [sn for sn in self.of_server(server.id) if sn.id not in own_ids] + server.snapshots
+        self.attached.add(id(server))
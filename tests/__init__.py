@@ -0,0 +1,4 @@
+from hetzner_snap_and_rotate.config import Config, set_default_config
+
+# Tests must not parse their own command line as options of this script
+set_default_config(Config(api_token='123456'))
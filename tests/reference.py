@@ -0,0 +1,82 @@
+# Former implementations that tests and benchmarks compare the current ones with
+
+import re
+
+from datetime import datetime
+from typing import Optional
+
+from hetzner_snap_and_rotate.config import Config
+from hetzner_snap_and_rotate.periods import Period
+from hetzner_snap_and_rotate.rotation import Rotated
+from hetzner_snap_and_rotate.snapshots import Snapshot, Snapshots
+
+
+# Matches JSON ISO 8601 timestamp strings with fewer than six
+# fractional digits and captures the fractional digits in group #1
+timestamp_pattern = re.compile('"\\d{4}-\\d{2}-\\d{2}T\\d{2}:\\d{2}:\\d{2}\\.(\\d{,5})(?=Z"|[+-]\\d{2}:\\d{2}")')
+
+
+# Adds trailing zero(s) to a timestamp so that there are six fractional digits,
+# as the former decoding path did before passing responses to dataclass_wizard
+def sanitize_timestamps(json_text: str):
+    def add_zeroes(match: re.Match):
+        return match.group(0) + ('0' * (6 - len(match.group(1))))
+
+    return timestamp_pattern.sub(add_zeroes, json_text)
+
+
+# Decodes a snapshot listing page the way the former decoding path did
+def former_decode_snapshots(json_text: str) -> Snapshots:
+    return Snapshots.from_json(sanitize_timestamps(json_text))
+
+
+def oldest(start: datetime, end: datetime, snapshots: list[Snapshot]) -> Optional[Snapshot]:
+    if start > end:
+        start, end = end, start
+
+    matching = sorted(
+        filter(lambda s: start <= s.created < end, snapshots),
+        key=lambda s: s.created
+    )
+
+    return matching[0] if len(matching) else None
+
+
+def latest(start: Optional[datetime], snapshots: list[Snapshot]) -> list[Snapshot]:
+    predicate = (lambda s: s.created >= start) if start is not None else (lambda s: True)
+    matching = sorted(
+        filter(predicate, snapshots),
+        key=lambda s: s.created,
+        reverse=True
+    )
+
+    return matching
+
+
+# The former rotation, which scans all snapshots for every period
+def former_rotate(config: Config.Defaults, not_rotated: list[Snapshot], p_end: datetime) -> Rotated:
+    rotated: Rotated = {}
+    latest_start = None
+
+    for p in Period:
+        p_count = getattr(config, p.config_name, 0) or 0
+
+        if p_count > 0:
+            if latest_start is None:
+                latest_start = p.start_of_period(p_end)
+                p_end = latest_start
+
+            for p_num, p_start in enumerate(p.previous_periods(p_end, p_count), start=1):
+                p_sn = oldest(p_start, p_end, not_rotated)
+
+                if p_sn:
+                    not_rotated.remove(p_sn)
+                    rotated[p_sn] = (p, p_num)
+
+                    p_end = p_start
+
+    for l_num, l_sn in enumerate(latest(latest_start, not_rotated), start=1):
+        not_rotated.remove(l_sn)
+        rotated[l_sn] = (None, l_num)
+
+    return rotated
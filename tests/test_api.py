@@ -1,14 +1,22 @@
 import json
+import time
 
 from datetime import datetime, timedelta
 from dataclass_wizard import JSONWizard
 from dataclasses import dataclass
 from parameterized import parameterized
+from threading import Thread
 from requests_mock import Mocker
 from unittest import TestCase
+from unittest.mock import patch
 from urllib.parse import urlencode
 
-from hetzner_snap_and_rotate.api import api_request, sanitize_timestamps, ApiError, RecoverableError, Page, Action, ActionStatus
+from hetzner_snap_and_rotate.api import (
+    api_request, ApiError, RecoverableError, Page, Action, ActionStatus, ConnectionStats, get_session,
+    RateLimiter, get_rate_limiter
+)
+from hetzner_snap_and_rotate.config import Config, activate
+from hetzner_snap_and_rotate.polling import ExponentialBackoff
 
 api_base = 'https://api.hetzner.cloud/v1/'
 api_path = 'test'
@@ -109,6 +117,28 @@ class ApiTest(TestCase):
         mocker.get(api_url, status_code=423, reason='Locked', json=self.error_json)
         self.assertRaises(RecoverableError, api_request, MockResponse, api_path=api_path, api_token=api_token)
 
+    @parameterized.expand([
+        (429, 'Too Many Requests'),
+        (503, 'Service Unavailable'),
+    ])
+    @Mocker()
+    def test_transparent_retry(self, status_code: int, reason: str, mocker):
+        mocker.get(api_url, [
+            {'status_code': status_code, 'reason': reason, 'json': self.error_json, 'headers': {'Retry-After': '0'}},
+            {'text': self.response_text},
+        ])
+        response = api_request(MockResponse, api_path=api_path, api_token=api_token)
+        self.assertEqual(response, self.mock_response, 'Wrong response data')
+        self.assertEqual(mocker.call_count, 2, 'Request was not retried')
+
+    @Mocker()
+    def test_retries_exhausted(self, mocker):
+        mocker.get(api_url, status_code=429, reason='Too Many Requests', json=self.error_json,
+                   headers={'Retry-After': '0'})
+        with patch('time.sleep'):
+            self.assertRaises(ApiError, api_request, MockResponse, api_path=api_path, api_token=api_token)
+        self.assertEqual(mocker.call_count, 4, 'Wrong number of attempts')
+
     @parameterized.expand([
         (400, 'Bad Request'),
         (401, 'Unauthorized'),
@@ -121,28 +151,27 @@ class ApiTest(TestCase):
         self.assertRaises(ApiError, api_request, MockResponse, api_path=api_path, api_token=api_token)
 
 
-    @parameterized.expand([
-        ('', ''),
-        ('abc', 'abc'),
-        ('2025-07-01T12:34:56.789Z', '2025-07-01T12:34:56.789Z'),
-        ('"2025-07-01T12:34:56.789Z ..."', '"2025-07-01T12:34:56.789Z ..."'),
-        ('"... 2025-07-01T12:34:56.789Z"', '"... 2025-07-01T12:34:56.789Z"'),
-        ('2025-07-01T12:34:56.789+01:00', '2025-07-01T12:34:56.789+01:00'),
-        ('"2025-07-01T12:34:56.789+01:00 ..."', '"2025-07-01T12:34:56.789+01:00 ..."'),
-        ('"... 2025-07-01T12:34:56.789+01:00"', '"... 2025-07-01T12:34:56.789+01:00"'),
-        ('"2025-07-01T12:34:56.789012Z"', '"2025-07-01T12:34:56.789012Z"'),
-        ('"2025-07-01T12:34:56.78901Z"', '"2025-07-01T12:34:56.789010Z"'),
-        ('"2025-07-01T12:34:56.7890Z"', '"2025-07-01T12:34:56.789000Z"'),
-        ('"2025-07-01T12:34:56.789Z"', '"2025-07-01T12:34:56.789000Z"'),
-        ('"2025-07-01T12:34:56.78Z"', '"2025-07-01T12:34:56.780000Z"'),
-        ('"2025-07-01T12:34:56.7Z"', '"2025-07-01T12:34:56.700000Z"'),
-        ('"2025-07-01T12:34:56.Z"', '"2025-07-01T12:34:56.000000Z"'),
-        ('"2025-07-01T12:34:56.789Z" "2024-07-01T12:34:56.789Z"', '"2025-07-01T12:34:56.789000Z" "2024-07-01T12:34:56.789000Z"'),
-        ('"2025-07-01T12:34:56.789+00:00"', '"2025-07-01T12:34:56.789000+00:00"'),
-        ('"2025-07-01T12:34:56.789-01:00"', '"2025-07-01T12:34:56.789000-01:00"'),
-    ])
-    def test_timestamp_sanitizing(self, text: str, expected: str):
-        self.assertEqual(expected, sanitize_timestamps(text))
+    def test_shared_session(self):
+        session = get_session()
+        self.assertIs(session, get_session(), 'Session is not shared')
+
+        adapter = session.get_adapter(api_base)
+        self.assertGreaterEqual(adapter._pool_maxsize, 1, 'Wrong pool size')
+        self.assertEqual(adapter.max_retries.total, 3, 'Wrong number of retries')
+        self.assertNotIn('POST', adapter.max_retries.allowed_methods, 'POST must not be retried')
+
+    def test_connection_stats(self):
+        class Connection:
+            pass
+
+        stats = ConnectionStats()
+        first, second = Connection(), Connection()
+
+        for connection in [first, first, second, None, first]:
+            stats.count(connection)
+
+        self.assertEqual(stats.new, 2, 'Wrong number of new connections')
+        self.assertEqual(stats.reused, 2, 'Wrong number of reused connections')
 
 
 @dataclass(kw_only=True)
@@ -150,22 +179,62 @@ class MockPage(Page, JSONWizard):
     test: list[MockResponse]
 
 
+class RateLimiterTest(TestCase):
+
+    @staticmethod
+    def headers(limit: int, remaining: int, reset_in: int):
+        return {
+            'RateLimit-Limit': str(limit),
+            'RateLimit-Remaining': str(remaining),
+            'RateLimit-Reset': str(int(time.time()) + reset_in),
+        }
+
+    def test_without_headers(self):
+        limiter = RateLimiter()
+        limiter.update({})
+        start = time.time()
+        for _ in range(100):
+            limiter.acquire()
+        self.assertLess(time.time() - start, 0.1, 'Requests were delayed without rate limit')
+
+    def test_pacing(self):
+        # Two requests left, refilled at 10 requests per second
+        limiter = RateLimiter()
+        limiter.update(RateLimiterTest.headers(limit=12, remaining=2, reset_in=1))
+
+        start = time.time()
+        threads = [Thread(target=limiter.acquire) for _ in range(7)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertGreaterEqual(time.time() - start, 0.4, 'Requests were not paced')
+        self.assertLess(time.time() - start, 1.5, 'Requests were paced too slowly')
+
+    @Mocker()
+    def test_headers_are_honored(self, mocker):
+        token = 'rate-limited'
+        mocker.get(api_url, text=ApiTest.response_text, headers=RateLimiterTest.headers(limit=3600, remaining=0, reset_in=3600))
+        api_request(MockResponse, api_path=api_path, api_token=token)
+        self.assertGreater(get_rate_limiter(token).delay(), 0.5, 'Exhausted budget was not noticed')
+
+
 class PageTest(TestCase):
 
     @staticmethod
-    def serve_pages(pages: int):
-        page = 0
+    def serve_pages(pages: int, with_last_page: bool = False):
 
         def do_serve(request, context):
-            nonlocal page
-            page += 1
+            page = int(request.qs['page'][0])
 
             return {
                 'test': [vars(MockResponse(number=page*10, text=str(page*10)))],
                 'meta': {
                     'pagination': {
                         'page': page,
-                        'next_page': page+1 if page < pages else None
+                        'next_page': page+1 if page < pages else None,
+                        'last_page': pages if with_last_page else None,
                     }
                 }
             }
@@ -173,20 +242,47 @@ class PageTest(TestCase):
         return do_serve
 
     @parameterized.expand([
-        (1,),
-        (2,),
-        (5,),
+        (1, False),
+        (2, False),
+        (5, False),
+        (1, True),
+        (2, True),
+        (25, True),
     ])
     @Mocker()
-    def test_load_page(self, pages: int, mocker):
-        mocker.get(api_url, json=PageTest.serve_pages(pages))
-        test_page = Page.load_page(MockPage, api_path=api_path, api_token=api_token)
+    def test_load_page(self, pages: int, with_last_page: bool, mocker):
+        mocker.get(api_url, json=PageTest.serve_pages(pages, with_last_page))
+        test_page = Page.load_page(MockPage, api_path=api_path, api_token=api_token, params={'key': 'value'})
         self.assertIsInstance(test_page, MockPage, 'Wrong response type')
         self.assertEqual(len(test_page.test), pages, 'Wrong number of entities')
         for i, t in enumerate(test_page.test, start=1):
             self.assertIsInstance(t, MockResponse, 'Wrong entity type')
             self.assertEqual(t.number, i*10, 'Wrong entity content')
 
+        self.assertEqual(mocker.call_count, pages, 'Wrong number of requests')
+        self.assertEqual(sorted(int(r.qs['page'][0]) for r in mocker.request_history), list(range(1, pages+1)),
+                         'Wrong pages requested')
+        for r in mocker.request_history:
+            self.assertEqual(r.qs['key'], ['value'], 'Wrong query params')
+
+
+    @parameterized.expand([
+        (3, False),
+        (3, True),
+    ])
+    @Mocker()
+    def test_iter_entities(self, pages: int, with_last_page: bool, mocker):
+        mocker.get(api_url, json=PageTest.serve_pages(pages, with_last_page))
+        entities = Page.iter_entities(MockPage, api_path=api_path, api_token=api_token)
+        self.assertEqual([10*i for i in range(1, pages+1)], [t.number for t in entities], 'Wrong entities')
+
+    @Mocker()
+    def test_stop_iterating(self, mocker):
+        mocker.get(api_url, json=PageTest.serve_pages(5))
+        pages = Page.iter_pages(MockPage, api_path=api_path, api_token=api_token)
+        next(pages)
+        self.assertEqual(mocker.call_count, 1, 'Pages were loaded before being requested')
+
 
 class ActionTest(TestCase):
 
@@ -195,37 +291,99 @@ class ActionTest(TestCase):
         self.success_action = Action(id=42, command='Test', status=ActionStatus.SUCCESS, error=None)
 
     @staticmethod
-    def wrapped_action_json(action: Action):
-        return f'{{ "action": {action.to_json()} }}'
-
-    @Mocker()
-    def test_load_status(self, mocker):
-        mocker.get(f'{api_base}actions/{self.running_action.id}',
-                   text=ActionTest.wrapped_action_json(self.success_action))
-        status = self.running_action.load_status()
-        self.assertEqual(status, ActionStatus.SUCCESS, 'Wrong ActionStatus')
+    def actions_json(actions: list[Action]):
+        return json.dumps({
+            'actions': [json.loads(a.to_json()) for a in actions],
+            'meta': {'pagination': {'page': 1, 'next_page': None}}
+        })
 
-    def serve_success_action(self, delay: int):
+    def serve_success_actions(self, delay: int):
 
         success_at = datetime.now() + timedelta(seconds=delay)
 
         def do_serve(request, context):
-            if datetime.now() < success_at:
-                return ActionTest.wrapped_action_json(self.running_action)
-            else:
-                return ActionTest.wrapped_action_json(self.success_action)
+            status = ActionStatus.RUNNING if datetime.now() < success_at else ActionStatus.SUCCESS
+            return ActionTest.actions_json([
+                Action(id=int(i), command='Test', status=status, error=None) for i in request.qs['id']
+            ])
 
         return do_serve
 
     @Mocker()
     def test_action_completed(self, mocker):
         delay = 2
-        mocker.get(f'{api_base}actions/{self.running_action.id}', text=self.serve_success_action(delay=delay))
+        mocker.get(f'{api_base}actions', text=self.serve_success_actions(delay=delay))
         self.running_action.wait_until_completed(timeout=delay+1, interval=1)
+        self.assertEqual(self.running_action.status, ActionStatus.SUCCESS, 'Wrong ActionStatus')
 
     @Mocker()
     def test_action_timeout(self, mocker):
         delay = 3
-        mocker.get(f'{api_base}actions/{self.running_action.id}', text=self.serve_success_action(delay=delay))
+        mocker.get(f'{api_base}actions', text=self.serve_success_actions(delay=delay))
         self.assertRaises(TimeoutError, self.running_action.wait_until_completed, timeout=delay-1, interval=1)
 
+    @Mocker()
+    def test_polling_strategy(self, mocker):
+        delay = 2
+        mocker.get(f'{api_base}actions', text=self.serve_success_actions(delay=delay))
+        strategy = ExponentialBackoff(polling=Config.Polling(initial_interval=0.1, fast_poll_window=0.5,
+                                                             factor=2, max_interval=1, jitter=0))
+        self.running_action.wait_until_completed(timeout=delay+2, strategy=strategy)
+        self.assertEqual(self.running_action.status, ActionStatus.SUCCESS, 'Wrong ActionStatus')
+
+        # 0.5s fast polling at 0.1s, then at 0.2s, 0.4s, 0.8s and 1.0s
+        self.assertGreaterEqual(mocker.call_count, 8, 'Too few polls during the fast-poll window')
+        self.assertLessEqual(mocker.call_count, 10, 'Too many polls after the fast-poll window')
+
+    @Mocker()
+    def test_batched_polling(self, mocker):
+        delay = 2
+        mocker.get(f'{api_base}actions', text=self.serve_success_actions(delay=delay))
+        actions = [Action(id=i, command='Test', status=ActionStatus.RUNNING, error=None) for i in range(1, 6)]
+
+        threads = [Thread(target=a.wait_until_completed, kwargs={'timeout': delay+2, 'interval': 1}) for a in actions]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        for a in actions:
+            self.assertEqual(a.status, ActionStatus.SUCCESS, 'Wrong ActionStatus')
+
+        # Requests are shared by all actions instead of one request per action and polling interval
+        self.assertLess(mocker.call_count, len(actions) * delay, 'Too many polling requests')
+        self.assertTrue(any(len(r.qs['id']) > 1 for r in mocker.request_history), 'Actions were not polled together')
+
+    @Mocker()
+    def test_polling_error_of_other_project(self, mocker):
+        delay = 2
+        other_base = 'https://other.example.com/v1/'
+        mocker.get(f'{api_base}actions', text=self.serve_success_actions(delay=delay))
+        mocker.get(f'{other_base}actions', status_code=403, reason='Forbidden', json=ApiTest.error_json)
+
+        projects = {
+            1: Config(api_token=api_token),
+            2: Config(api_token='other', api_url=other_base, max_retries=0),
+        }
+        actions = {i: Action(id=i, command='Test', status=ActionStatus.RUNNING, error=None) for i in projects}
+        errors = {}
+
+        def wait(i: int):
+            with activate(projects[i]):
+                try:
+                    actions[i].wait_until_completed(timeout=delay+2, interval=1)
+                except Exception as ex:
+                    errors[i] = ex
+
+        threads = [Thread(target=wait, args=(i,)) for i in projects]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # Each project is polled with its own API URL, and only its own waiter sees its error
+        self.assertEqual(ActionStatus.SUCCESS, actions[1].status, 'Wrong ActionStatus')
+        self.assertNotIn(1, errors)
+        self.assertIsInstance(errors.get(2), ApiError)
+        self.assertTrue(all(r.headers['Authorization'] == 'Bearer other'
+                            for r in mocker.request_history if r.url.startswith(other_base)))
@@ -2,6 +2,7 @@ import io
 import os
 import sys
 
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
 from parameterized import parameterized
 from random import random
@@ -9,7 +10,9 @@ from unittest import TestCase
 from unittest.mock import patch
 
 from hetzner_snap_and_rotate.__version__ import __version__
-from hetzner_snap_and_rotate.config import Config
+from hetzner_snap_and_rotate.config import (
+    Config, activate, bind_context, config, current_config, matches_label_selector
+)
 
 
 class TestConfig(TestCase):
@@ -68,6 +71,7 @@ class TestConfig(TestCase):
         ('blank', "JSONDecodeError('Expecting value: line 1 column 1 (char 0)')"),
         ('empty', "ValueError('No API token specified')"),
         ('no-snapshot-name', "ValueError('No snapshot name pattern specified for server [server-1]')"),
+        ('no-group-selector', "ValueError('Server group [web] needs a label selector or a name pattern')"),
     ])
     def test_read_invalid_config(self, file_name: str, expected_err: str):
         with patch('sys.stderr', new=StringIO()) as mocked_stderr:
@@ -81,6 +85,8 @@ class TestConfig(TestCase):
     def test_read_regular_config(self):
         config = TestConfig.read_config('regular')
         self.assertEqual(config.api_token, '123456')
+        self.assertEqual(config.pool_size, 4)
+        self.assertEqual(config.max_retries, 2)
         self.assert_default(config.defaults, self.configured_default)
 
         srv = config.servers['server-1']
@@ -92,6 +98,8 @@ class TestConfig(TestCase):
     def test_read_without_default_config(self):
         config = TestConfig.read_config('without-default')
         self.assertEqual(config.api_token, '123456')
+        self.assertEqual(config.pool_size, 10)
+        self.assertEqual(config.max_retries, 3)
         self.assert_default(config.defaults, None)
 
         srv = config.servers['server-1']
@@ -100,6 +108,77 @@ class TestConfig(TestCase):
         srv = config.servers['server-2']
         self.assert_server(srv, self.builtin_default, self.server2_default_override)
 
+    def test_read_projects_config(self):
+        config = TestConfig.read_config('projects', ['--dry-run', '--max-parallelism', '2'])
+        self.assertIsNone(config.api_token)
+        self.assertEqual(['project-a', 'project-b'], list(config.project_configs))
+
+        project_a = config.project_configs['project-a']
+        self.assertEqual(project_a.api_token, 'token-a')
+        self.assertEqual(project_a.pool_size, 4)
+        self.assertEqual(project_a.snapshot_labels, {})
+        self.assertEqual(project_a.api_url, 'https://api.hetzner.cloud/v1/')
+        self.assertTrue(project_a.servers['server-a'].create_snapshot)
+        self.assertEqual(project_a.servers['server-a'].daily, 5)
+
+        project_b = config.project_configs['project-b']
+        self.assertEqual(project_b.api_token, 'token-b')
+        self.assertEqual(project_b.pool_size, 2)
+        self.assertEqual(project_b.api_url, 'http://localhost:8080/v1/')
+        self.assertEqual(project_b.label_selector(), 'managed-by=snap-and-rotate')
+        self.assertFalse(project_b.servers['server-b'].create_snapshot)
+        self.assertIsNone(project_b.servers['server-b'].daily)
+        self.assertEqual(project_b.servers['server-b'].hourly, 3)
+
+        for project in [project_a, project_b]:
+            self.assertTrue(project.dry_run)
+            self.assertEqual(project.max_parallelism, 2)
+            self.assertEqual(project.priority, config.priority)
+
+    def test_read_groups_config(self):
+        config = TestConfig.read_config('groups', ['--servers', 'web-1, db-2'])
+        self.assertEqual(['web-1', 'db-2'], config.selected_servers)
+
+        web = config.server_config('web-1', {'role': 'web', 'env': 'stage'})
+        self.assertEqual(('web-1', 3, 5, True), (web.name, web.hourly, web.daily, web.create_snapshot))
+        self.assertIsNone(config.server_config('web-2', {'role': 'web', 'env': 'test'}))
+        self.assertEqual(Config.AdaptiveTimeouts(factor=3, min_samples=2), web.adaptive_timeouts)
+
+        # Servers configured individually take precedence over groups
+        self.assertEqual(10, config.server_config('db-1', {}).daily)
+        self.assertTrue(config.server_config('db-2', {}).rotate)
+        self.assertIsNone(config.server_config('db-2', {}).hourly)
+
+        self.assertEqual({'label_selector': 'role=web,env in (prod, stage)'}, config.server_groups['web'].params())
+        self.assertIsNone(config.server_groups['db'].params())
+
+    def test_history_report_requires_history(self):
+        with patch('sys.stderr', new=StringIO()) as mocked_stderr:
+            with self.assertRaises(SystemExit):
+                TestConfig.read_config('groups', ['--history-report'])
+
+        self.assertIn('--history-report requires --history', mocked_stderr.getvalue())
+
+    def test_metrics_port_requires_daemon(self):
+        with patch('sys.stderr', new=StringIO()) as mocked_stderr:
+            with self.assertRaises(SystemExit):
+                TestConfig.read_config('groups', ['--metrics-port', '9100'])
+
+        self.assertIn('--metrics-port requires --daemon', mocked_stderr.getvalue())
+
+    @parameterized.expand([
+        ('', {}, True),
+        ('env=prod', {'env': 'prod'}, True),
+        ('env==prod', {'env': 'stage'}, False),
+        ('env!=prod', {}, True),
+        ('backup', {'backup': ''}, True),
+        ('!backup', {'backup': ''}, False),
+        ('env in (prod, stage),backup', {'env': 'stage', 'backup': 'yes'}, True),
+        ('env notin (prod,stage)', {'env': 'prod'}, False),
+    ])
+    def test_label_selector(self, selector: str, labels: dict, expected: bool):
+        self.assertEqual(expected, matches_label_selector(selector, labels))
+
     def test_api_token_env(self):
         expected_api_token = str(random())
         os.environ['API_TOKEN'] = expected_api_token
@@ -117,3 +196,44 @@ class TestConfig(TestCase):
         with self.assertRaises(SystemExit):
             TestConfig.read_config('regular', ['--version'])
         self.assertRegex(mock_stdout.getvalue(), f'.*{__version__}.*')
+
+
+class TestConfigContext(TestCase):
+
+    def test_activate(self):
+        cfg = Config(api_token='abc', pool_size=3)
+
+        with activate(cfg):
+            self.assertIs(cfg, current_config())
+            self.assertEqual('abc', config.api_token)
+            self.assertEqual(3, config.pool_size)
+
+        self.assertIsNot(cfg, current_config())
+
+    def test_proxy_forwards_changes(self):
+        cfg = Config(api_token='abc')
+
+        with activate(cfg):
+            with patch.object(config, 'pool_size', 7):
+                self.assertEqual(7, cfg.pool_size)
+
+            self.assertEqual(10, cfg.pool_size)
+            self.assertIs(vars(cfg), vars(config))
+
+    def test_workers_with_different_configs(self):
+        configs = [Config(api_token=f'token-{i}') for i in range(8)]
+
+        def worker(cfg: Config) -> list[str]:
+            with activate(cfg):
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    return list(executor.map(bind_context(lambda _: config.api_token), range(4)))
+
+        with ThreadPoolExecutor(max_workers=len(configs)) as executor:
+            results = list(executor.map(worker, configs))
+
+        self.assertEqual([[cfg.api_token] * 4 for cfg in configs], results)
+
+    def test_lazy_default(self):
+        with patch('hetzner_snap_and_rotate.config.default_config', None):
+            with patch('sys.argv', [sys.argv[0], '-c', 'tests/config/regular.json']):
+                self.assertEqual(4, config.pool_size)
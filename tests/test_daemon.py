@@ -0,0 +1,77 @@
+import sys
+
+from datetime import datetime, timezone
+from unittest import TestCase
+from unittest.mock import patch
+
+from hetzner_snap_and_rotate.config import Config
+from hetzner_snap_and_rotate.daemon import Daemon, reload_config, tick_period
+from hetzner_snap_and_rotate.periods import Period
+
+
+def read_config(file_name: str) -> Config:
+    return Config.read_config([sys.argv[0], '-c', f'tests/config/{file_name}.json'])
+
+
+@patch('hetzner_snap_and_rotate.daemon.log')
+class TestDaemon(TestCase):
+
+    def test_tick_period(self, mocked_log):
+        self.assertEqual(Period.QUARTER_HOURLY, tick_period(read_config('regular')))
+        self.assertEqual(Period.DAILY, tick_period(Config(api_token='123456')))
+
+    def test_reload_config(self, mocked_log):
+        cfg = Config(api_token='123456')
+
+        self.assertTrue(reload_config(cfg, [sys.argv[0], '-c', 'tests/config/regular.json', '--daemon']))
+        self.assertEqual(4, cfg.pool_size)
+        self.assertTrue(cfg.daemon)
+        self.assertIn('server-1', cfg.servers)
+
+    @patch('sys.stderr')
+    def test_reload_invalid_config(self, mocked_stderr, mocked_log):
+        cfg = Config(api_token='123456')
+
+        self.assertFalse(reload_config(cfg, [sys.argv[0], '-c', 'tests/config/missing.json']))
+        self.assertEqual(10, cfg.pool_size)
+
+    @patch('hetzner_snap_and_rotate.daemon.signal.signal')
+    def test_serve(self, mocked_signal, mocked_log):
+        runs = []
+
+        def run() -> int:
+            runs.append(datetime.now(tz=timezone.utc))
+            if len(runs) == 3:
+                daemon.terminate()
+            return 0
+
+        daemon = Daemon(run, [])
+        with patch.object(daemon, 'next_tick', lambda now: now):
+            self.assertEqual(0, daemon.serve())
+
+        self.assertEqual(3, len(runs))
+
+    @patch('hetzner_snap_and_rotate.daemon.reload_config')
+    @patch('hetzner_snap_and_rotate.daemon.signal.signal')
+    def test_hangup(self, mocked_signal, mocked_reload_config, mocked_log):
+        def run() -> int:
+            daemon.reload()
+            return 1
+
+        def reload(cfg, sys_argv):
+            daemon.terminate()
+
+        mocked_reload_config.side_effect = reload
+
+        daemon = Daemon(run, ['prog', '-c', 'config.json'])
+        with patch.object(daemon, 'next_tick', lambda now: now):
+            self.assertEqual(0, daemon.serve())
+
+        mocked_reload_config.assert_called_once()
+        self.assertEqual(['prog', '-c', 'config.json'], mocked_reload_config.call_args.args[1])
+
+    def test_signal_interrupts_sleep(self, mocked_log):
+        daemon = Daemon(lambda: 0, [])
+        daemon.terminate()
+
+        self.assertFalse(daemon.sleep_until(datetime.max.replace(tzinfo=timezone.utc)))
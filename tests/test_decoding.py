@@ -0,0 +1,93 @@
+import json
+
+from datetime import datetime, timezone, timedelta
+from parameterized import parameterized
+from unittest import TestCase
+
+from hetzner_snap_and_rotate.api import Action, ActionStatus
+from hetzner_snap_and_rotate.decoding import decode, decoder, interned, interning_scope, parse_timestamp
+from hetzner_snap_and_rotate.servers import Servers, ServerStatus
+from hetzner_snap_and_rotate.snapshots import Snapshots
+
+from tests.reference import former_decode_snapshots
+
+
+def image(i: int, created: str = '2025-07-01T12:34:56.789Z'):
+    return {
+        'id': i,
+        'type': 'snapshot',
+        'description': f'snapshot-{i}',
+        'created': created,
+        'created_from': {'id': i % 10, 'name': f'server-{i % 10}'},
+        'protection': {'delete': i % 2 == 0},
+        'labels': {'VERSION': str(i)},
+        'image_size': 1.5,
+        'os_flavor': 'ubuntu',
+    }
+
+
+def page(key: str, entities: list):
+    return json.dumps({key: entities, 'meta': {'pagination': {'page': 1, 'next_page': None}}})
+
+
+class TestDecoding(TestCase):
+
+    @parameterized.expand([
+        ('2025-07-01T12:34:56Z', datetime(2025, 7, 1, 12, 34, 56, tzinfo=timezone.utc)),
+        ('2025-07-01T12:34:56.7Z', datetime(2025, 7, 1, 12, 34, 56, 700000, tzinfo=timezone.utc)),
+        ('2025-07-01T12:34:56.789Z', datetime(2025, 7, 1, 12, 34, 56, 789000, tzinfo=timezone.utc)),
+        ('2025-07-01T12:34:56.78901Z', datetime(2025, 7, 1, 12, 34, 56, 789010, tzinfo=timezone.utc)),
+        ('2025-07-01T12:34:56.789012Z', datetime(2025, 7, 1, 12, 34, 56, 789012, tzinfo=timezone.utc)),
+        ('2025-07-01T12:34:56.Z', datetime(2025, 7, 1, 12, 34, 56, tzinfo=timezone.utc)),
+        ('2025-07-01T12:34:56+00:00', datetime(2025, 7, 1, 12, 34, 56, tzinfo=timezone.utc)),
+        ('2025-07-01T12:34:56.789-01:00', datetime(2025, 7, 1, 12, 34, 56, 789000, tzinfo=timezone(timedelta(hours=-1)))),
+    ])
+    def test_parse_timestamp(self, text: str, expected: datetime):
+        self.assertEqual(expected, parse_timestamp(text))
+
+    def test_snapshots_like_before(self):
+        text = page('images', [image(i, created) for i, created in enumerate([
+            '2025-07-01T12:34:56.789Z', '2025-07-01T12:34:56+00:00', '2025-07-01T12:34:56.7+02:00'
+        ])])
+
+        expected = former_decode_snapshots(text)
+        actual = decode(Snapshots, text.encode())
+
+        self.assertEqual(expected, actual)
+        for e, a in zip(expected.images, actual.images):
+            self.assertEqual(e.description, a.description)
+            self.assertEqual(e.created, a.created)
+            self.assertEqual(e.protection, a.protection)
+            self.assertEqual(e.labels, a.labels)
+            self.assertEqual((e.created_from.id, e.created_from.name), (a.created_from.id, a.created_from.name))
+
+    def test_interning_is_scoped(self):
+        text = page('images', [image(1), image(11)])
+
+        first, second = decode(Snapshots, text), decode(Snapshots, text)
+
+        self.assertIs(first.images[0].created_from, first.images[1].created_from)
+        self.assertIsNot(first.images[0].created_from, second.images[0].created_from)
+        self.assertIsNone(interned.get())
+
+        # Objects decoded individually are shared only within an explicit scope
+        with interning_scope():
+            shared = [decoder(Snapshots)(json.loads(text)) for _ in range(2)]
+        self.assertIs(shared[0].images[0].created_from, shared[1].images[0].created_from)
+        self.assertIsNone(interned.get())
+
+    def test_servers(self):
+        text = page('servers', [{'id': 1, 'name': 'server-1', 'status': 'off', 'labels': {}, 'public_net': {}}])
+        servers = decode(Servers, text)
+        self.assertEqual(1, servers.servers[0].id)
+        self.assertEqual(ServerStatus.OFF, servers.servers[0].status)
+        self.assertIsNone(servers.meta.pagination.next_page)
+
+    def test_optional_fields(self):
+        action = decode(Action, '{"id": 1, "command": "poweron", "status": "success", "error": null}')
+        self.assertEqual(ActionStatus.SUCCESS, action.status)
+        self.assertIsNone(action.error)
+        self.assertIsNone(action.finished)
+
+    def test_missing_field(self):
+        self.assertRaises(TypeError, decode, Action, '{"id": 1}')
@@ -0,0 +1,108 @@
+import json
+import os
+
+from parameterized import parameterized
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from hetzner_snap_and_rotate.config import Config
+from hetzner_snap_and_rotate.durations import DurationHistory, percentile
+
+
+class DurationHistoryTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'history.json')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    @parameterized.expand([
+        ([5], 99, 5),
+        ([1, 2, 3, 4], 50, 2),
+        (list(range(100, 0, -1)), 99, 99),
+        (list(range(1, 101)) + [1000], 99, 100),
+    ])
+    def test_percentile(self, samples: list, percent: float, expected: float):
+        self.assertEqual(expected, percentile(samples, percent))
+
+    def test_samples_are_limited(self):
+        history = DurationHistory()
+        for d in range(DurationHistory.max_samples + 10):
+            history.record(1, 'server-1', 'shutdown', d)
+
+        durations = history.durations(1, 'shutdown')
+        self.assertEqual(DurationHistory.max_samples, len(durations))
+        self.assertEqual(10, durations[0])
+        self.assertEqual([], history.durations(2, 'shutdown'))
+
+    @parameterized.expand([
+        # Static timeouts without adaptive timeouts or with too few durations
+        [None, [60] * 10, 300],
+        [Config.AdaptiveTimeouts(min_samples=11), [60] * 10, 300],
+        # p99 times the factor
+        [Config.AdaptiveTimeouts(), [50] * 9 + [70], 140],
+        # Floor and ceiling
+        [Config.AdaptiveTimeouts(), [5] * 10, 30],
+        [Config.AdaptiveTimeouts(factor=3, ceiling=100), [60] * 10, 100],
+    ])
+    def test_timeout(self, adaptive: Config.AdaptiveTimeouts, durations: list, expected: float):
+        history = DurationHistory()
+        for d in durations:
+            history.record(1, 'server-1', 'create_image', d)
+
+        server_config = Config.Server(name='server-1', adaptive_timeouts=adaptive)
+        self.assertEqual(expected, history.timeout(1, server_config, 'create_image', 300))
+
+    def test_timeout_after_timeout(self):
+        history = DurationHistory()
+        server_config = Config.Server(name='server-1', adaptive_timeouts=Config.AdaptiveTimeouts())
+        for d in [60] * 10:
+            history.record(1, 'server-1', 'create_image', d)
+        self.assertEqual(120, history.timeout(1, server_config, 'create_image', 300))
+
+        # The action has outgrown its timeout: the ceiling applies once, then the new duration counts
+        history.record(1, 'server-1', 'create_image', 120, timed_out=True)
+        self.assertEqual(1800, history.timeout(1, server_config, 'create_image', 300))
+
+        history.record(1, 'server-1', 'create_image', 130)
+        self.assertEqual(260, history.timeout(1, server_config, 'create_image', 300))
+        self.assertEqual([60] * 10 + [120, 130], history.durations(1, 'create_image'))
+        self.assertEqual(2, len(history.report()))
+
+    def test_save_and_open(self):
+        history = DurationHistory(path=self.path)
+        history.record(1, 'server-1', 'create_image', 120.5)
+        history.record(1, 'server-1', 'create_image', 130)
+        history.save()
+
+        reopened = DurationHistory()
+        reopened.open(self.path)
+        self.assertEqual([120.5, 130], reopened.durations(1, 'create_image'))
+
+        # Another path replaces the durations
+        reopened.open(os.path.join(self.tmp_dir.name, 'missing.json'))
+        self.assertEqual([], reopened.durations(1, 'create_image'))
+
+    @patch('hetzner_snap_and_rotate.durations.log')
+    def test_unreadable_file(self, mocked_log):
+        with open(self.path, 'w') as f:
+            json.dump({'version': 0, 'servers': {'1': {}}}, f)
+
+        history = DurationHistory()
+        history.open(self.path)
+        self.assertEqual({}, history.servers)
+
+    def test_report(self):
+        history = DurationHistory()
+        for d in [100, 100, 150, 150]:
+            history.record(2, 'server-2', 'create_image', d)
+        history.record(1, 'server-1', 'shutdown', 10)
+
+        lines = history.report()
+        self.assertEqual(3, len(lines))
+        self.assertTrue(lines[1].startswith('server-1') and 'shutdown' in lines[1])
+        self.assertIn(' +50%', lines[2])
+        self.assertEqual([], DurationHistory().report())
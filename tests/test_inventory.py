@@ -0,0 +1,143 @@
+import os
+
+from requests_mock import Mocker
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from hetzner_snap_and_rotate.inventory import Inventory
+from hetzner_snap_and_rotate.servers import Server
+
+api_base = 'https://api.hetzner.cloud/v1/'
+
+
+def image(i: int, description: str = None) -> dict:
+    return {
+        'id': i,
+        'description': description or f'snapshot-{i}',
+        'protection': {'delete': False},
+        'created': f'2025-07-01T12:{i:02}:00+00:00',
+        'created_from': {'id': 1, 'name': 'server-1'},
+        'labels': {},
+    }
+
+
+def page(images: list[dict], number: int = 1, next_page: int = None, total_entries: int = None) -> dict:
+    return {
+        'images': images,
+        'meta': {'pagination': {'page': number, 'next_page': next_page, 'total_entries': total_entries}}
+    }
+
+
+@patch('hetzner_snap_and_rotate.inventory.log')
+class InventoryTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'inventory.json')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def cached(self, *ids: int) -> Inventory:
+        inventory = Inventory.open(self.path)
+        inventory.images = [image(i) for i in ids]
+        inventory.save()
+        return Inventory.open(self.path)
+
+    @Mocker()
+    def test_full_load_without_cache(self, mocked_log, mocker):
+        mocker.get(f'{api_base}images', json=page([image(1), image(2), image(3)], total_entries=3))
+
+        snapshots = Inventory.open(self.path).refresh()
+
+        self.assertEqual([3, 2, 1], [sn.id for sn in snapshots])
+        self.assertEqual(1, mocker.call_count)
+        self.assertEqual(['id:asc'], mocker.last_request.qs['sort'])
+
+    @Mocker()
+    def test_incremental_refresh(self, mocked_log, mocker):
+        inventory = self.cached(2, 1)
+        mocker.get(f'{api_base}images', [
+            {'json': page([image(4), image(3)], next_page=2, total_entries=4)},
+            {'json': page([image(2), image(1)], number=2, total_entries=4)},
+        ])
+
+        snapshots = inventory.refresh()
+
+        self.assertEqual([4, 3, 2, 1], [sn.id for sn in snapshots])
+        self.assertEqual(2, mocker.call_count)
+        self.assertEqual(['id:desc'], mocker.last_request.qs['sort'])
+
+    @Mocker()
+    def test_refresh_skips_repeated_snapshot(self, mocked_log, mocker):
+        # Snapshot 5 was created after the first page had been loaded
+        inventory = self.cached(1)
+        mocker.get(f'{api_base}images', [
+            {'json': page([image(4), image(3)], next_page=2, total_entries=4)},
+            {'json': page([image(3), image(2)], number=2, next_page=3, total_entries=5)},
+            {'json': page([image(1)], number=3, total_entries=5)},
+        ])
+
+        snapshots = inventory.refresh()
+
+        self.assertEqual([4, 3, 2, 1], [sn.id for sn in snapshots])
+        self.assertEqual(3, mocker.call_count)
+
+    @Mocker()
+    def test_refresh_stops_at_known_snapshot(self, mocked_log, mocker):
+        inventory = self.cached(2, 1)
+        mocker.get(f'{api_base}images', json=page([image(3), image(2)], next_page=2, total_entries=3))
+
+        snapshots = inventory.refresh()
+
+        self.assertEqual([3, 2, 1], [sn.id for sn in snapshots])
+        self.assertEqual(1, mocker.call_count)
+
+    @Mocker()
+    def test_reload_if_snapshot_was_deleted(self, mocked_log, mocker):
+        inventory = self.cached(3, 2, 1)
+        mocker.get(f'{api_base}images', json=page([image(4), image(3), image(1)], total_entries=3))
+
+        snapshots = inventory.refresh()
+
+        self.assertEqual([4, 3, 1], [sn.id for sn in snapshots])
+        self.assertEqual(2, mocker.call_count)
+
+    @Mocker()
+    def test_reload_if_snapshot_was_renamed(self, mocked_log, mocker):
+        inventory = self.cached(2, 1)
+        mocker.get(f'{api_base}images', json=page([image(2, 'renamed'), image(1)], total_entries=2))
+
+        snapshots = inventory.refresh()
+
+        self.assertEqual(['renamed', 'snapshot-1'], [sn.description for sn in snapshots])
+        self.assertEqual(2, mocker.call_count)
+
+    def test_outdated_label_selector(self, mocked_log):
+        self.cached(2, 1)
+
+        with patch('hetzner_snap_and_rotate.inventory.config.label_selector', return_value='a=b'):
+            inventory = Inventory.open(self.path)
+
+        self.assertEqual([], inventory.images)
+
+    def test_unreadable_inventory(self, mocked_log):
+        with open(self.path, 'w') as f:
+            f.write('{')
+
+        self.assertEqual([], Inventory.open(self.path).images)
+
+    @Mocker()
+    def test_update(self, mocked_log, mocker):
+        mocker.get(f'{api_base}images', json=page([image(3), image(2), image(1)], total_entries=3))
+        inventory = Inventory.open(self.path)
+        snapshots = inventory.refresh()
+
+        server = Server(id=1, name='server-1', snapshots=[snapshots[0], snapshots[2]])
+        snapshots[0].description = 'renamed'
+        inventory.update([server])
+        inventory.save()
+
+        self.assertEqual(['renamed', 'snapshot-1'],
+                         [sn.description for sn in Inventory.open(self.path).snapshots()])
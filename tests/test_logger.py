@@ -1,5 +1,6 @@
 import importlib
 import io
+import json
 import os
 import re
 
@@ -26,7 +27,7 @@ class TestLogger(TestCase):
     @patch('syslog.setlogmask')
     @patch('syslog.syslog')
     def test_syslog(self, facility, priority, mock_syslog, mock_setlogmask, mock_openlog):
-        with patch('hetzner_snap_and_rotate.config.config', new=config.Config(api_token='xyz')) as mock_config:
+        with config.activate(config.Config(api_token='xyz')) as mock_config:
             mock_config.facility = facility
             mock_config.priority = priority
 
@@ -49,7 +50,7 @@ class TestLogger(TestCase):
         (LOG_DEBUG,),
     ])
     def test_stdout(self, priority):
-        with patch('hetzner_snap_and_rotate.config.config', new=config.Config(api_token='xyz')) as mock_config:
+        with config.activate(config.Config(api_token='xyz')) as mock_config:
             mock_config.facility = None
             mock_config.priority = priority
 
@@ -66,3 +67,87 @@ class TestLogger(TestCase):
                     else:
                         self.assertEqual(mock_stdout.getvalue(), '')
 
+
+    def test_tag(self):
+        with config.activate(config.Config(api_token='xyz')) as mock_config:
+            mock_config.facility = None
+            mock_config.priority = LOG_DEBUG
+
+            # Simulate initial module import
+            importlib.reload(logger)
+
+            with patch('sys.stdout', new=io.StringIO()) as mock_stdout:
+                with logger.log_tag('server-1'):
+                    logger.log('Tagged message', LOG_INFO)
+                logger.log('Untagged message', LOG_INFO)
+
+                lines = mock_stdout.getvalue().splitlines()
+                self.assertRegex(lines[0], r'.*\[server-1\] Tagged message$')
+                self.assertRegex(lines[1], r'^INFO: +Untagged message$')
+
+    def test_nested_tags(self):
+        with config.activate(config.Config(api_token='xyz')) as mock_config:
+            mock_config.facility = None
+            mock_config.priority = LOG_DEBUG
+
+            with patch('sys.stdout', new=io.StringIO()) as mock_stdout:
+                with logger.log_tag('project-a'):
+                    with logger.log_tag('server-1'):
+                        logger.log('Nested message', LOG_INFO)
+                    with logger.log_tag(None):
+                        logger.log('Project message', LOG_INFO)
+
+                lines = mock_stdout.getvalue().splitlines()
+                self.assertRegex(lines[0], r'.*\[project-a/server-1\] Nested message$')
+                self.assertRegex(lines[1], r'.*\[project-a\] Project message$')
+
+    def test_json(self):
+        with config.activate(config.Config(api_token='xyz')) as mock_config:
+            mock_config.facility = None
+            mock_config.priority = LOG_INFO
+            mock_config.log_format = 'json'
+
+            with patch('sys.stdout', new=io.StringIO()) as mock_stdout:
+                try:
+                    with logger.log_tag('server-1'):
+                        logger.log('Deleting snapshot [%s]', LOG_NOTICE, 'daily#1',
+                                   server='server-1', snapshot_id=42, action='delete')
+                    logger.log('Not logged', LOG_DEBUG)
+                    logger.log('Untagged message', LOG_ERR)
+
+                finally:
+                    logger.stop_listener()
+
+                entries = [json.loads(line) for line in mock_stdout.getvalue().splitlines()]
+
+        self.assertEqual(2, len(entries))
+        self.assertEqual({
+            'level': 'NOTICE',
+            'message': 'Deleting snapshot [daily#1]',
+            'tag': 'server-1',
+            'server': 'server-1',
+            'snapshot_id': 42,
+            'action': 'delete',
+        }, {k: v for k, v in entries[0].items() if k != 'time'})
+        self.assertEqual({'time', 'level', 'message'}, set(entries[1]))
+        self.assertEqual('ERROR', entries[1]['level'])
+
+    def test_lazy_formatting(self):
+        class Expensive:
+            formatted = 0
+
+            def __str__(self):
+                Expensive.formatted += 1
+                return 'expensive'
+
+        with config.activate(config.Config(api_token='xyz')) as mock_config:
+            mock_config.facility = None
+            mock_config.priority = LOG_INFO
+
+            with patch('sys.stdout', new=io.StringIO()) as mock_stdout:
+                logger.log('Filtered %s', LOG_DEBUG, Expensive())
+                self.assertEqual(0, Expensive.formatted)
+
+                logger.log('Logged %s', LOG_INFO, Expensive())
+                self.assertEqual(1, Expensive.formatted)
+                self.assertRegex(mock_stdout.getvalue(), r'^INFO: +Logged expensive$')
@@ -1,22 +1,29 @@
+import json
+import os
+import tempfile
+
 from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
 from enum import Enum
 from syslog import LOG_INFO
+from random import Random
 from typing import Optional
 
 from parameterized import parameterized
+from requests_mock import Mocker
 from unittest import TestCase
 from unittest.mock import patch
 
-from setuptools.command.rotate import rotate
-
-from hetzner_snap_and_rotate.__main__ import rotate, Rotated, main
+from hetzner_snap_and_rotate.__main__ import main
 from hetzner_snap_and_rotate.api import Page, ApiError
-from hetzner_snap_and_rotate.config import Config
+from hetzner_snap_and_rotate.config import Config, activate, config as global_config
 from hetzner_snap_and_rotate.periods import Period
+from hetzner_snap_and_rotate.rotation import rotate, Rotated
 from hetzner_snap_and_rotate.servers import Server, Servers, ServerStatus
 from hetzner_snap_and_rotate.snapshots import Snapshot, Snapshots, Protection
 
+from tests.reference import former_rotate
+
 
 class PowerFailure(Enum):
     NONE = 0
@@ -58,7 +65,7 @@ class ServerMock(Server):
 
 def mocked_server(id: int, status: ServerStatus = ServerStatus.RUNNING,
                   shutdown_and_restart: bool = True, allow_poweroff: bool = False,
-                  power_failure: PowerFailure = PowerFailure.NONE):
+                  power_failure: PowerFailure = PowerFailure.NONE, early_restart: bool = False):
 
     server: Server = ServerMock(id=id, name=f'test-server#{id}', status=status, power_failure=power_failure)
 
@@ -68,6 +75,7 @@ def mocked_server(id: int, status: ServerStatus = ServerStatus.RUNNING,
     config.snapshot_timeout = 1
     config.shutdown_and_restart = shutdown_and_restart
     config.allow_poweroff = allow_poweroff
+    config.early_restart = early_restart
     server.config = config
 
     return server
@@ -244,6 +252,40 @@ class MainTest(TestCase):
 
         self.assertEqual(expected, snapshots, 'Snapshots not rotated as expected')
 
+    @parameterized.expand([(seed,) for seed in range(20)])
+    def test_rotation_equivalence(self, seed: int):
+        rnd = Random(seed)
+
+        for _ in range(25):
+            config = Config.Defaults(**{
+                p.config_name: rnd.choice([0, 0, 1, 2, 5, 12]) for p in Period
+            })
+
+            p_end = datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=rnd.randrange(2 * 366 * 24 * 60))
+            span = rnd.choice([timedelta(hours=6), timedelta(days=10), timedelta(days=400), timedelta(days=3000)])
+
+            # Coarse creation instants produce ties
+            snapshots = [
+                Snapshot(
+                    id=i,
+                    description='',
+                    protection=Protection(),
+                    created_from=Server(id=0, name=''),
+                    created=p_end - timedelta(minutes=rnd.randrange(int(span.total_seconds() // 60)) // 5 * 5)
+                )
+                for i in range(rnd.randrange(0, 200))
+            ]
+
+            expected_not_rotated = list(snapshots)
+            expected = former_rotate(config, expected_not_rotated, p_end)
+
+            actual_not_rotated = list(snapshots)
+            actual = rotate(config, actual_not_rotated, p_end)
+
+            self.assertEqual([(id(s), v) for s, v in expected.items()], [(id(s), v) for s, v in actual.items()],
+                             f'Different rotation for {config}, {p_end}')
+            self.assertEqual(list(map(id, expected_not_rotated)), list(map(id, actual_not_rotated)),
+                             f'Different snapshots not rotated for {config}, {p_end}')
 
     @parameterized.expand([
         [
@@ -254,6 +296,7 @@ class MainTest(TestCase):
             PowerFailure.NONE,
             CreateFailure.NONE,
             0,
+            1,
         ],
         [
             1,
@@ -263,6 +306,7 @@ class MainTest(TestCase):
             PowerFailure.SHUT_DOWN,
             CreateFailure.NONE,
             1,
+            1,
         ],
         [
             1,
@@ -272,6 +316,7 @@ class MainTest(TestCase):
             PowerFailure.POWER_ON,
             CreateFailure.NONE,
             1,
+            1,
         ],
         [
             1,
@@ -281,6 +326,7 @@ class MainTest(TestCase):
             PowerFailure.SHUT_DOWN,
             CreateFailure.NONE,
             0,
+            1,
         ],
         [
             1,
@@ -290,6 +336,7 @@ class MainTest(TestCase):
             PowerFailure.POWER_OFF,
             CreateFailure.NONE,
             1,
+            1,
         ],
         [
             1,
@@ -299,6 +346,7 @@ class MainTest(TestCase):
             PowerFailure.NONE,
             CreateFailure.API_ERROR,
             1,
+            1,
         ],
         [
             1,
@@ -308,6 +356,7 @@ class MainTest(TestCase):
             PowerFailure.NONE,
             CreateFailure.TIMEOUT,
             1,
+            1,
         ],
         [
             2,
@@ -317,10 +366,40 @@ class MainTest(TestCase):
             PowerFailure.SHUT_DOWN,
             CreateFailure.NONE,
             1,
+            1,
+        ],
+        [
+            3,
+            ServerStatus.RUNNING,
+            True,
+            False,
+            PowerFailure.NONE,
+            CreateFailure.NONE,
+            0,
+            3,
+        ],
+        [
+            4,
+            ServerStatus.RUNNING,
+            True,
+            False,
+            PowerFailure.SHUT_DOWN,
+            CreateFailure.NONE,
+            1,
+            2,
+        ],
+        [
+            4,
+            ServerStatus.RUNNING,
+            True,
+            False,
+            PowerFailure.NONE,
+            CreateFailure.TIMEOUT,
+            1,
+            4,
         ],
     ])
-    @patch('hetzner_snap_and_rotate.snapshots.Snapshots.load_snapshots')
-    @patch('hetzner_snap_and_rotate.servers.Servers.load_servers')
+    @patch('hetzner_snap_and_rotate.snapshots.Snapshots.iter_snapshots')
     @patch('hetzner_snap_and_rotate.servers.Servers.load_configured_servers')
     @patch('hetzner_snap_and_rotate.__main__.create_snapshot')
     @patch('hetzner_snap_and_rotate.__main__.log')
@@ -328,9 +407,8 @@ class MainTest(TestCase):
     def test_creating_snapshots(self,
                                 server_count: int, status: ServerStatus, shutdown_and_restart: bool, allow_poweroff: bool,
                                 power_failure: PowerFailure, create_failure: CreateFailure,
-                                expected_return_value: int,
-                                mocked_log, mocked_create_snapshot, mocked_load_configured_servers, mocked_load_servers,
-                                mocked_load_snapshots):
+                                expected_return_value: int, max_parallelism: int,
+                                mocked_log, mocked_create_snapshot, mocked_load_configured_servers, mocked_iter_snapshots):
 
         servers: list[Server] = [mocked_server(
             id=i,
@@ -344,15 +422,12 @@ class MainTest(TestCase):
         meta: Page.Metadata = Page.Metadata(pagination=Page.Metadata.Pagination(page=1, next_page=None))
         snapshots_created = 0
 
-        def load_snapshots():
-            return Snapshots(images=[], meta=meta)
+        def iter_snapshots():
+            return iter([])
 
-        def load_servers():
+        def load_configured_servers(snapshots=()):
             return Servers(servers=servers, meta=meta)
 
-        def load_configured_servers(snapshots: Snapshots):
-            return load_servers()
-
         def create_snapshot(server: Server, timeout: int = 300) -> Snapshot:
             nonlocal snapshots_created
 
@@ -367,17 +442,17 @@ class MainTest(TestCase):
             snapshots_created += 1
             return snapshot
 
-        def log(message: str, priority: int = LOG_INFO):
+        def log(message: str, priority: int = LOG_INFO, *args, **fields):
             pass
 
 
-        mocked_load_snapshots.side_effect = load_snapshots
-        mocked_load_servers.side_effect = load_servers
+        mocked_iter_snapshots.side_effect = iter_snapshots
         mocked_load_configured_servers.side_effect = load_configured_servers
         mocked_create_snapshot.side_effect = create_snapshot
         mocked_log.side_effect = log
 
-        return_value = main()
+        with patch.object(global_config, 'max_parallelism', max_parallelism):
+            return_value = main()
 
         self.assertEqual(expected_return_value, return_value,
                          f'main() return value id {return_value}, expected: {expected_return_value}')
@@ -388,3 +463,266 @@ class MainTest(TestCase):
             expected_status = status if power_failure != PowerFailure.POWER_ON else ServerStatus.OFF
             self.assertEqual(expected_status, srv.status,
                              f'Server {srv.id} has status {srv.status}, expected: {expected_status}')
+
+
+class EarlyRestartTest(TestCase):
+
+    @parameterized.expand([
+        # Completion succeeded, sequentially and concurrently
+        [False, 1, 0],
+        [False, 3, 0],
+        # Completion failed after the server had been restarted
+        [True, 1, 1],
+        [True, 3, 1],
+    ])
+    @patch('hetzner_snap_and_rotate.snapshots.Snapshots.iter_snapshots', return_value=[])
+    @patch('hetzner_snap_and_rotate.servers.Servers.load_configured_servers')
+    @patch('hetzner_snap_and_rotate.__main__.execute_plan')
+    @patch('hetzner_snap_and_rotate.__main__.create_snapshot')
+    @patch('hetzner_snap_and_rotate.__main__.begin_snapshot')
+    @patch('hetzner_snap_and_rotate.__main__.log')
+    def test_early_restart(self, completion_fails: bool, max_parallelism: int, expected_return_value: int,
+                           mocked_log, mocked_begin_snapshot, mocked_create_snapshot, mocked_execute_plan,
+                           mocked_load_configured_servers, mocked_iter_snapshots):
+
+        servers = [mocked_server(id=i, early_restart=True) for i in range(2)]
+        now = datetime.now(tz=timezone.utc)
+        for srv in servers:
+            srv.config.rotate = True
+            srv.config.daily = 1
+            srv.config.snapshot_name = 'snapshot'
+            srv.snapshots = [mocked_snapshot(created=now - timedelta(days=d)) for d in [3, 5]]
+
+        events = []
+
+        class Pending:
+
+            def __init__(self, server: Server):
+                self.server = server
+                self.snapshot = mocked_snapshot(created=datetime.now(tz=timezone.utc))
+
+            def wait(self):
+                events.append(('completed', self.server.id, self.server.status))
+                if completion_fails and self.server.id == 0:
+                    raise ApiError('Snapshot failed')
+                return self.snapshot
+
+        mocked_begin_snapshot.side_effect = lambda server, timeout: Pending(server)
+        mocked_load_configured_servers.return_value = Servers(
+            servers=servers, meta=Page.Metadata(pagination=Page.Metadata.Pagination(page=1, next_page=None)))
+        mocked_execute_plan.return_value = 0
+
+        with patch.object(global_config, 'max_parallelism', max_parallelism):
+            self.assertEqual(expected_return_value, main())
+
+        mocked_create_snapshot.assert_not_called()
+
+        # Completion is awaited only after the server has been restarted
+        self.assertEqual({0, 1}, {srv_id for _, srv_id, _ in events})
+        self.assertTrue(all(status == ServerStatus.RUNNING for _, _, status in events))
+
+        # No rotation relies on a failed snapshot
+        plan = mocked_execute_plan.call_args.args[0]
+        self.assertEqual(completion_fails, all(op.server != servers[0].name for op in plan.operations))
+
+    @parameterized.expand([
+        # The snapshot completed although the server could not be restarted
+        [False],
+        # Neither the restart nor the snapshot succeeded
+        [True],
+    ])
+    @patch('hetzner_snap_and_rotate.snapshots.Snapshots.iter_snapshots', return_value=[])
+    @patch('hetzner_snap_and_rotate.servers.Servers.load_configured_servers')
+    @patch('hetzner_snap_and_rotate.__main__.execute_plan')
+    @patch('hetzner_snap_and_rotate.__main__.begin_snapshot')
+    @patch('hetzner_snap_and_rotate.__main__.log')
+    def test_power_on_failure(self, completion_fails: bool, mocked_log, mocked_begin_snapshot,
+                              mocked_execute_plan, mocked_load_configured_servers, mocked_iter_snapshots):
+
+        srv = mocked_server(id=0, early_restart=True, power_failure=PowerFailure.POWER_ON)
+        now = datetime.now(tz=timezone.utc)
+        srv.config.rotate = True
+        srv.config.daily = 1
+        srv.config.snapshot_name = 'snapshot'
+        srv.snapshots = [mocked_snapshot(created=now - timedelta(days=d)) for d in [3, 5]]
+
+        completed = []
+
+        class Pending:
+
+            def __init__(self, server: Server):
+                self.snapshot = mocked_snapshot(created=datetime.now(tz=timezone.utc))
+
+            def wait(self):
+                completed.append(self.snapshot)
+                if completion_fails:
+                    raise ApiError('Snapshot failed')
+                return self.snapshot
+
+        mocked_begin_snapshot.side_effect = lambda server, timeout: Pending(server)
+        mocked_load_configured_servers.return_value = Servers(
+            servers=[srv], meta=Page.Metadata(pagination=Page.Metadata.Pagination(page=1, next_page=None)))
+        mocked_execute_plan.return_value = 0
+
+        self.assertEqual(1, main())
+
+        # The snapshot was awaited, and the rotation was planned only if it completed
+        self.assertEqual(1, len(completed))
+        plan = mocked_execute_plan.call_args.args[0]
+        self.assertEqual(completion_fails, not plan.operations)
+
+
+class LazyListingTest(TestCase):
+
+    @parameterized.expand([
+        # Create-only runs do not list the snapshots
+        [False, 1, 0],
+        [False, 3, 0],
+        # Rotating servers share a single listing
+        [True, 1, 1],
+        [True, 3, 1],
+    ])
+    @patch('hetzner_snap_and_rotate.snapshots.Snapshots.iter_snapshots', return_value=[])
+    @patch('hetzner_snap_and_rotate.servers.Servers.load_configured_servers')
+    @patch('hetzner_snap_and_rotate.__main__.create_snapshot')
+    @patch('hetzner_snap_and_rotate.__main__.log')
+    def test_listing(self, rotate: bool, max_parallelism: int, expected_listings: int,
+                     mocked_log, mocked_create_snapshot, mocked_load_configured_servers, mocked_iter_snapshots):
+        servers = [mocked_server(id=i) for i in range(3)]
+        for srv in servers:
+            srv.config.rotate = rotate
+            srv.config.daily = 1
+            srv.config.snapshot_name = 'snapshot'
+
+        mocked_create_snapshot.side_effect = lambda server, timeout: mocked_snapshot(created=datetime.now(tz=timezone.utc))
+        mocked_load_configured_servers.return_value = Servers(
+            servers=servers, meta=Page.Metadata(pagination=Page.Metadata.Pagination(page=1, next_page=None)))
+
+        with patch.object(global_config, 'max_parallelism', max_parallelism):
+            self.assertEqual(0, main())
+
+        self.assertEqual(3, mocked_create_snapshot.call_count)
+        self.assertEqual(expected_listings, mocked_iter_snapshots.call_count)
+
+
+class InventoryTest(TestCase):
+
+    api_base = 'https://api.hetzner.cloud/v1/'
+
+    @staticmethod
+    def image(id: int, description: str, created: datetime) -> dict:
+        return {
+            'id': id,
+            'description': description,
+            'created': created.isoformat(),
+            'created_from': {'id': 1, 'name': 'server-1'},
+            'protection': {'delete': False},
+            'labels': {},
+        }
+
+    @Mocker()
+    @patch('hetzner_snap_and_rotate.__main__.log')
+    def test_deleted_snapshots_not_saved(self, mocker, mocked_log):
+        now = datetime.now(tz=timezone.utc)
+        images = [
+            self.image(10, 'old-1', now - timedelta(days=30)),
+            self.image(11, 'old-2', now - timedelta(days=20)),
+            self.image(12, 'server-1', now - timedelta(minutes=1)),
+        ]
+        pagination = {'page': 1, 'next_page': None, 'last_page': 1, 'total_entries': len(images)}
+
+        mocker.get(f'{self.api_base}servers', json={
+            'servers': [{'id': 1, 'name': 'server-1', 'status': 'running', 'labels': {}}],
+            'meta': {'pagination': pagination | {'total_entries': 1}}
+        })
+        mocker.get(f'{self.api_base}images', json={'images': images, 'meta': {'pagination': pagination}})
+        mocker.delete(f'{self.api_base}images/10', status_code=204)
+        mocker.delete(f'{self.api_base}images/11', status_code=204)
+
+        cfg = Config(api_token='123456',
+                     servers={'server-1': Config.Server(rotate=True, daily=1, snapshot_name='{server}')})
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cfg.inventory = os.path.join(tmp_dir, 'inventory.json')
+
+            with activate(cfg):
+                self.assertEqual(0, main())
+
+            with open(cfg.inventory) as f:
+                saved = json.load(f)
+
+        # The rotation deleted all but the latest snapshot, and the inventory must not bring them back
+        self.assertEqual(['DELETE', 'DELETE'], [r.method for r in mocker.request_history if r.method != 'GET'])
+        self.assertEqual([12], [img['id'] for img in saved['images']])
+
+
+class ProjectsTest(TestCase):
+
+    api_base = 'https://api.hetzner.cloud/v1/'
+
+    @staticmethod
+    def projects_config() -> Config:
+        cfg = Config()
+        cfg.project_configs = {
+            name: Config(api_token=f'token-{name}', servers={f'server-{name}': Config.Server(rotate=True, daily=1)})
+            for name in ['a', 'b']
+        }
+
+        return cfg
+
+    def mock_project(self, mocker: Mocker, name: str, server_id: int, status_code: int = 200):
+        headers = {'Authorization': f'Bearer token-{name}'}
+        pagination = {'page': 1, 'next_page': None, 'last_page': 1, 'total_entries': 1}
+
+        if status_code == 200:
+            servers = {'servers': [{'id': server_id, 'name': f'server-{name}', 'status': 'running', 'labels': {}}],
+                       'meta': {'pagination': pagination}}
+            mocker.get(f'{self.api_base}servers', request_headers=headers, json=servers)
+        else:
+            mocker.get(f'{self.api_base}servers', request_headers=headers, status_code=status_code,
+                       json={'error': {'message': 'failed'}})
+
+        mocker.get(f'{self.api_base}images', request_headers=headers,
+                   json={'images': [], 'meta': {'pagination': pagination | {'total_entries': 0}}})
+
+    @parameterized.expand([
+        (200, 0, '2 projects with 2 servers processed, 0 failed'),
+        (500, 1, '2 projects with 1 server processed, 1 failed'),
+    ])
+    @Mocker()
+    @patch('hetzner_snap_and_rotate.__main__.log')
+    def test_projects(self, status_code_b: int, expected_return_value: int, expected_summary: str, mocked_log, mocker):
+        self.mock_project(mocker, 'a', 1)
+        self.mock_project(mocker, 'b', 2, status_code=status_code_b)
+
+        with activate(self.projects_config()):
+            self.assertEqual(expected_return_value, main())
+
+        tokens = {r.headers['Authorization'] for r in mocker.request_history}
+        self.assertEqual({'Bearer token-a', 'Bearer token-b'}, tokens)
+
+        summary = [c.args[0] % c.args[2:] for c in mocked_log.call_args_list if 'project%s with' in c.args[0]]
+        self.assertEqual([expected_summary], summary)
+
+    @parameterized.expand([
+        # Only servers that are configured in no project are reported
+        (200, ['server-c']),
+        # Servers of a project that could not be listed may exist
+        (500, []),
+    ])
+    @Mocker()
+    @patch('hetzner_snap_and_rotate.__main__.log')
+    def test_selected_servers(self, status_code_b: int, expected_unknown: list[str], mocked_log, mocker):
+        self.mock_project(mocker, 'a', 1)
+        self.mock_project(mocker, 'b', 2, status_code=status_code_b)
+
+        cfg = self.projects_config()
+        cfg.selected_servers = ['server-a', 'server-b', 'server-c']
+        for project in cfg.project_configs.values():
+            project.selected_servers = cfg.selected_servers
+
+        with activate(cfg):
+            main()
+
+        unknown = [c.args[2] for c in mocked_log.call_args_list if 'does not exist' in c.args[0]]
+        self.assertEqual(expected_unknown, unknown)
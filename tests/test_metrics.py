@@ -0,0 +1,114 @@
+import os
+import requests
+
+from parameterized import parameterized
+from requests_mock import Mocker
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from hetzner_snap_and_rotate import metrics
+from hetzner_snap_and_rotate.api import api_request, ApiError
+from hetzner_snap_and_rotate.metrics import Counter, Gauge, Histogram, endpoint
+
+api_base = 'https://api.hetzner.cloud/v1/'
+
+
+class TestMetrics(TestCase):
+
+    def test_counter(self):
+        counter = Counter('test_requests', 'Test requests', ('method',))
+        counter.inc('GET')
+        counter.inc('GET', amount=2)
+        counter.inc('PUT')
+
+        self.assertEqual([
+            '# HELP test_requests_total Test requests',
+            '# TYPE test_requests_total counter',
+            'test_requests_total{method="GET"} 3',
+            'test_requests_total{method="PUT"} 1',
+        ], counter.render())
+
+    def test_gauge(self):
+        gauge = Gauge('test_status', 'Test status')
+        gauge.set(value=1)
+        gauge.set(value=0.5)
+
+        self.assertEqual(['test_status 0.5'], gauge.samples())
+
+    def test_histogram(self):
+        histogram = Histogram('test_seconds', 'Test durations', ('command',), buckets=(1, 10))
+        for value in [0.5, 1, 5, 20]:
+            histogram.observe('poweron', value=value)
+
+        self.assertEqual([
+            'test_seconds_bucket{command="poweron",le="1"} 2',
+            'test_seconds_bucket{command="poweron",le="10"} 3',
+            'test_seconds_bucket{command="poweron",le="+Inf"} 4',
+            'test_seconds_sum{command="poweron"} 26.5',
+            'test_seconds_count{command="poweron"} 4',
+        ], histogram.samples())
+
+    def test_label_escaping(self):
+        counter = Counter('test_errors', 'Test errors', ('stage',))
+        counter.inc('a"b\\c\nd')
+
+        self.assertEqual(['test_errors_total{stage="a\\"b\\\\c\\nd"} 1'], counter.samples())
+
+    @parameterized.expand([
+        ('servers', 'servers'),
+        ('servers/42', 'servers/{id}'),
+        ('servers/42/actions/create_image', 'servers/{id}/actions/create_image'),
+        ('images/1234567', 'images/{id}'),
+    ])
+    def test_endpoint(self, api_path: str, expected: str):
+        self.assertEqual(expected, endpoint(api_path))
+
+    @Mocker()
+    def test_api_request_metrics(self, mocker):
+        mocker.get(f'{api_base}images/98765', json={})
+        mocker.delete(f'{api_base}images/98765', status_code=404, json={'error': {'message': 'not found'}})
+
+        requests_before = metrics.api_requests.value('images/{id}', 'GET', '200')
+        durations_before = metrics.api_request_duration.count('images/{id}', 'GET')
+        errors_before = metrics.errors.value('api')
+
+        api_request(return_type=None, api_path='images/98765', api_token='123456')
+        with self.assertRaises(ApiError):
+            api_request(return_type=None, api_path='images/98765', api_token='123456', method='DELETE')
+
+        self.assertEqual(requests_before + 1, metrics.api_requests.value('images/{id}', 'GET', '200'))
+        self.assertEqual(durations_before + 1, metrics.api_request_duration.count('images/{id}', 'GET'))
+        self.assertEqual(1, metrics.api_requests.value('images/{id}', 'DELETE', '404'))
+        self.assertEqual(errors_before + 1, metrics.errors.value('api'))
+
+    def test_write_textfile(self):
+        with TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'hetzner.prom')
+            metrics.write_textfile(path)
+
+            with open(path) as f:
+                content = f.read()
+
+            self.assertEqual([path], [os.path.join(tmp_dir, n) for n in os.listdir(tmp_dir)])
+
+        self.assertIn('# TYPE hetzner_api_requests_total counter\n', content)
+        self.assertIn('# TYPE hetzner_run_duration_seconds histogram\n', content)
+
+    def test_serve(self):
+        server = metrics.serve(0, '127.0.0.1')
+
+        try:
+            host, port = server.server_address
+            with requests.Session() as session:
+                session.trust_env = False
+                response = session.get(f'http://{host}:{port}/metrics', timeout=5)
+                not_found = session.get(f'http://{host}:{port}/other', timeout=5)
+
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+        self.assertIn('# TYPE hetzner_errors_total counter', response.text)
+        self.assertEqual(404, not_found.status_code)
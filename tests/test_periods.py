@@ -1,12 +1,26 @@
 from datetime import datetime
+from zoneinfo import ZoneInfo
 from parameterized import parameterized
 from unittest import TestCase
 
-from hetzner_snap_and_rotate.periods import Period
+from hetzner_snap_and_rotate.periods import Period, period_key
 
 
 class TestPeriod(TestCase):
 
+    @parameterized.expand([
+        [datetime.fromisoformat('2024-03-01T00:20:00'), Period.QUARTER_HOURLY, datetime.fromisoformat('2024-03-01T00:30:00')],
+        [datetime.fromisoformat('2024-03-01T00:30:00'), Period.QUARTER_HOURLY, datetime.fromisoformat('2024-03-01T00:45:00')],
+        [datetime.fromisoformat('2024-03-01T01:20:00'), Period.HOURLY, datetime.fromisoformat('2024-03-01T02:00:00')],
+        [datetime.fromisoformat('2024-12-31T23:59:59'), Period.DAILY, datetime.fromisoformat('2025-01-01T00:00:00')],
+        [datetime.fromisoformat('2024-03-01T02:20:00'), Period.WEEKLY, datetime.fromisoformat('2024-03-04T00:00:00')],
+        [datetime.fromisoformat('2024-12-31T02:20:00'), Period.MONTHLY, datetime.fromisoformat('2025-01-01T00:00:00')],
+        [datetime.fromisoformat('2024-11-30T02:20:00'), Period.QUARTER_YEARLY, datetime.fromisoformat('2025-01-01T00:00:00')],
+        [datetime.fromisoformat('2024-02-29T02:20:00'), Period.YEARLY, datetime.fromisoformat('2025-01-01T00:00:00')],
+    ])
+    def test_next_start(self, t: datetime, period: Period, expected: datetime):
+        self.assertEqual(expected, period.next_start(t))
+
     @parameterized.expand([
         [datetime.fromisoformat('2024-03-01T00:20:00'), Period.QUARTER_HOURLY, datetime.fromisoformat('2024-03-01T00:15:00')],
         [datetime.fromisoformat('2024-03-01T01:20:00'), Period.HOURLY, datetime.fromisoformat('2024-03-01T01:00:00')],
@@ -19,6 +33,18 @@ class TestPeriod(TestCase):
     def test_start_of_period(self, t: datetime, period: Period, expected: datetime):
         self.assertEqual(expected, period.start_of_period(t))
 
+    @parameterized.expand([
+        [datetime.fromisoformat('2024-03-01T00:29:59'), Period.QUARTER_HOURLY, '2024-03-01_0015'],
+        [datetime.fromisoformat('2024-03-01T01:00:00'), Period.HOURLY, '2024-03-01_01'],
+        [datetime.fromisoformat('2024-03-01T00:00:00'), Period.DAILY, '2024-03-01'],
+        [datetime.fromisoformat('2024-12-30T02:20:00'), Period.WEEKLY, '2025-W01'],
+        [datetime.fromisoformat('2024-01-31T02:20:00'), Period.MONTHLY, '2024-01'],
+        [datetime.fromisoformat('2024-09-30T23:59:59'), Period.QUARTER_YEARLY, '2024-Q3'],
+        [datetime.fromisoformat('2024-01-01T00:00:00'), Period.YEARLY, '2024'],
+    ])
+    def test_period_key(self, t: datetime, period: Period, expected: str):
+        self.assertEqual(expected, period_key(period, t))
+
     @parameterized.expand([
         [datetime.fromisoformat('2024-03-01T00:20:00'), Period.QUARTER_HOURLY, [
             datetime.fromisoformat('2024-03-01T00:05:00'),
@@ -69,4 +95,27 @@ class TestPeriod(TestCase):
             self.assertEqual(periods[actual_count], t, 'Wrong start of period')
             actual_count += 1
 
-        self.assertEqual(actual_count, expected_count, 'Wrong count')
\ No newline at end of file
+        self.assertEqual(actual_count, expected_count, 'Wrong count')
+
+    @parameterized.expand([
+        [period, end]
+        for period in Period
+        for end in [
+            datetime.fromisoformat('2024-01-31T02:20:00'),
+            datetime.fromisoformat('2024-02-29T00:00:00'),
+            datetime.fromisoformat('2024-03-31T23:45:00+00:00'),
+            datetime.fromisoformat('2023-12-31T12:00:00+00:00'),
+            # Around the DST transitions in Europe/Vienna
+            datetime(2024, 3, 31, 3, 30, tzinfo=ZoneInfo('Europe/Vienna')),
+            datetime(2024, 10, 27, 2, 30, fold=1, tzinfo=ZoneInfo('Europe/Vienna')),
+        ]
+    ])
+    def test_boundaries(self, period: Period, end: datetime):
+        count = 40
+        expected = list(period.previous_periods(end, count))
+        boundaries = period.boundaries(end, count)
+
+        self.assertEqual(expected, list(boundaries), 'Wrong boundaries')
+        self.assertEqual([t.utcoffset() for t in expected], [t.utcoffset() for t in boundaries], 'Wrong UTC offsets')
+        self.assertIs(boundaries, period.boundaries(end, count), 'Boundaries were not cached')
+        self.assertEqual(expected[:5], list(period.boundaries(end, 5)), 'Wrong boundaries for a different count')
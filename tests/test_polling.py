@@ -0,0 +1,41 @@
+from datetime import timedelta
+from itertools import islice
+from parameterized import parameterized
+from unittest import TestCase
+
+from hetzner_snap_and_rotate.config import Config
+from hetzner_snap_and_rotate.polling import (
+    ExponentialBackoff, FixedInterval, PollingMetrics, Detection, polling_strategy, default_polling
+)
+
+
+class TestPolling(TestCase):
+
+    def test_fixed_interval(self):
+        self.assertEqual([3, 3, 3], list(islice(FixedInterval(interval=3).intervals(), 3)))
+
+    def test_exponential_backoff(self):
+        polling = Config.Polling(initial_interval=1, fast_poll_window=3, factor=2, max_interval=10, jitter=0)
+        self.assertEqual([1, 1, 1, 2, 4, 8, 10, 10], list(islice(ExponentialBackoff(polling=polling).intervals(), 8)))
+
+    def test_jitter(self):
+        polling = Config.Polling(initial_interval=10, fast_poll_window=100, max_interval=20, jitter=0.5)
+        for interval in islice(ExponentialBackoff(polling=polling).intervals(), 6):
+            self.assertTrue(5 <= interval <= 15, f'Interval {interval} out of jitter range')
+
+    @parameterized.expand([
+        ('create_image', None, default_polling['create_image']),
+        ('unknown', None, Config.Polling()),
+        ('poweron', {'poweron': Config.Polling(initial_interval=7)}, Config.Polling(initial_interval=7)),
+        ('shutdown', {'poweron': Config.Polling(initial_interval=7)}, default_polling['shutdown']),
+    ])
+    def test_polling_strategy(self, command: str, configured: dict, expected: Config.Polling):
+        strategy = polling_strategy(Config.Server(name='server', polling=configured), command)
+        self.assertEqual(expected, strategy.polling)
+
+    def test_metrics(self):
+        metrics = PollingMetrics()
+        metrics.record('poweron', Detection(waited=timedelta(seconds=2), delay=timedelta(seconds=1), polls=2))
+        metrics.record('poweron', Detection(waited=timedelta(seconds=4), delay=None, polls=4))
+
+        self.assertEqual(['poweron: 2 actions, avg. 3.0s waited, 3.0 polls, 1.0s detection delay'], metrics.summary())
@@ -0,0 +1,134 @@
+import json
+
+from datetime import datetime, timedelta, timezone
+from parameterized import parameterized
+from unittest import TestCase
+from unittest.mock import patch
+
+from hetzner_snap_and_rotate.config import Config, config
+from hetzner_snap_and_rotate.rotation import OperationType, RotationPlan, plan_rotation, plan_migration, execute_plan
+from hetzner_snap_and_rotate.servers import Server
+from hetzner_snap_and_rotate.snapshots import Snapshot, Protection
+
+
+p_end = datetime(2024, 3, 15, 12, 0, tzinfo=timezone.utc)
+
+
+def server_with_snapshots(name: str, days: int, protected: set[int] = None) -> Server:
+    server = Server(id=hash(name) % 1000, name=name)
+    server.config = Config.Server(name=name, rotate=True, daily=3, snapshot_name='{period_type}#{period_number}')
+
+    # One snapshot per day, the latest ones are already named correctly
+    server.snapshots = [
+        Snapshot(id=i, description='daily#1' if i == 1 else f'old-{i}',
+                 protection=Protection(delete=i in (protected or set())),
+                 created=p_end - timedelta(days=i, hours=1), created_from=server)
+        for i in range(1, days + 1)
+    ]
+
+    return server
+
+
+class RotationTest(TestCase):
+
+    def test_plan(self):
+        server = server_with_snapshots('server-1', 6, protected={5})
+        operations = plan_rotation(server, p_end)
+
+        renames = {op.snapshot_id: op.new_description for op in operations if op.type == OperationType.RENAME}
+        deletes = {op.snapshot_id: op.protected for op in operations if op.type == OperationType.DELETE}
+
+        # 'daily#1' is not renamed because its name does not change
+        self.assertEqual({2: 'daily#2', 3: 'daily#3'}, renames)
+        self.assertEqual({4: False, 5: True, 6: False}, deletes)
+
+        # The plan does not change anything
+        self.assertEqual(6, len(server.snapshots))
+        self.assertEqual('old-2', server.snapshots[1].description)
+
+    def test_plan_with_duplicated_snapshot(self):
+        server = server_with_snapshots('server-1', 6)
+
+        # The latest snapshot was listed twice, as a separate object
+        duplicate = server.snapshots[0]
+        server.snapshots.append(Snapshot(id=duplicate.id, description=duplicate.description,
+                                         protection=duplicate.protection, created=duplicate.created,
+                                         created_from=server))
+        operations = plan_rotation(server, p_end)
+
+        deletes = [op.snapshot_id for op in operations if op.type == OperationType.DELETE]
+        self.assertEqual([4, 5, 6], deletes)
+
+    def test_plan_with_rotation_labels(self):
+        server = server_with_snapshots('server-1', 6)
+        server.config.rotation_labels = True
+        operations = plan_rotation(server, p_end)
+
+        # Only deletions remain
+        self.assertEqual([(OperationType.DELETE, 4), (OperationType.DELETE, 5), (OperationType.DELETE, 6)],
+                         [(op.type, op.snapshot_id) for op in operations])
+
+    @patch('hetzner_snap_and_rotate.rotation.log')
+    @patch('hetzner_snap_and_rotate.snapshots.log')
+    def test_migration(self, mocked_snapshots_log, mocked_rotation_log):
+        server = server_with_snapshots('server-1', 3, protected={3})
+        server.config.snapshot_name = '{server}_{timestamp:%Y-%m-%d}'
+        self.assertEqual([], plan_migration(server))
+
+        server.config.rotation_labels = True
+        plan = RotationPlan(operations=plan_migration(server))
+        self.assertEqual([OperationType.RELABEL] * 3, [op.type for op in plan.operations])
+
+        with patch.object(config, 'dry_run', True):
+            self.assertEqual(0, execute_plan(plan, [server]))
+
+        # Protected snapshots are labeled but not renamed
+        self.assertEqual(['server-1_2024-03-14', 'server-1_2024-03-13', 'old-3'],
+                         [sn.description for sn in server.snapshots])
+        self.assertEqual({'snap-and-rotate/daily': '2024-03-13'}, server.snapshots[1].labels)
+
+        # Snapshots are migrated only once
+        self.assertEqual([], plan_migration(server))
+
+    def test_serializable(self):
+        plan = RotationPlan(operations=plan_rotation(server_with_snapshots('server-1', 4), p_end))
+        operations = json.loads(plan.to_json())['operations']
+
+        self.assertEqual(len(plan.operations), len(operations))
+        self.assertEqual({'type': 'delete', 'server': 'server-1', 'snapshot_id': 4, 'description': 'old-4',
+                          'new_description': None, 'protected': False, 'labels': None}, operations[-1])
+
+    @parameterized.expand([
+        (1,),
+        (4,),
+    ])
+    @patch('hetzner_snap_and_rotate.rotation.log')
+    @patch('hetzner_snap_and_rotate.snapshots.log')
+    def test_execute(self, max_parallelism: int, mocked_snapshots_log, mocked_rotation_log):
+        servers = [server_with_snapshots('server-1', 6, protected={5}), server_with_snapshots('server-2', 5)]
+        plan = RotationPlan(operations=[op for srv in servers for op in plan_rotation(srv, p_end)])
+
+        with patch.object(config, 'dry_run', True):
+            return_value = execute_plan(plan, servers, max_parallelism)
+
+        self.assertEqual(0, return_value)
+        self.assertEqual(['daily#1', 'daily#2', 'daily#3', 'old-5'], [sn.description for sn in servers[0].snapshots])
+        self.assertEqual(['daily#1', 'daily#2', 'daily#3'], [sn.description for sn in servers[1].snapshots])
+
+    @patch('hetzner_snap_and_rotate.rotation.log')
+    @patch('hetzner_snap_and_rotate.snapshots.log')
+    def test_failures_are_isolated(self, mocked_snapshots_log, mocked_rotation_log):
+        server = server_with_snapshots('server-1', 6)
+        plan = RotationPlan(operations=plan_rotation(server, p_end))
+
+        def set_description(snapshot: Snapshot, description: str):
+            if snapshot.id == 2:
+                raise TimeoutError()
+            snapshot.description = description
+
+        with patch.object(config, 'dry_run', True):
+            with patch.object(Snapshot, 'set_description', set_description):
+                return_value = execute_plan(plan, [server])
+
+        self.assertEqual(1, return_value)
+        self.assertEqual(['daily#1', 'old-2', 'daily#3'], [sn.description for sn in server.snapshots])
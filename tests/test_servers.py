@@ -0,0 +1,117 @@
+from parameterized import parameterized
+from requests_mock import Mocker
+from unittest import TestCase
+from unittest.mock import patch
+
+from hetzner_snap_and_rotate.api import Action
+from hetzner_snap_and_rotate.config import Config, config
+from hetzner_snap_and_rotate.durations import DurationHistory
+from hetzner_snap_and_rotate.servers import Server, ServerAction, Servers
+from hetzner_snap_and_rotate.snapshots import Snapshot, Protection
+
+api_base = 'https://api.hetzner.cloud/v1/'
+
+
+class ServersTest(TestCase):
+
+    @staticmethod
+    def serve_servers(names: list[str], per_page: int):
+
+        def do_serve(request, context):
+            page = int(request.qs['page'][0])
+            last_page = (len(names) + per_page - 1) // per_page
+
+            return {
+                'servers': [
+                    {'id': i, 'name': n, 'status': 'running', 'labels': {}}
+                    for i, n in enumerate(names) if (page-1)*per_page <= i < page*per_page
+                ],
+                'meta': {
+                    'pagination': {
+                        'page': page,
+                        'next_page': page+1 if page < last_page else None,
+                        'last_page': last_page,
+                    }
+                }
+            }
+
+        return do_serve
+
+    @Mocker()
+    def test_load_configured_servers(self, mocker):
+        names = [f'server-{i}' for i in range(7)]
+        mocker.get(f'{api_base}servers', json=ServersTest.serve_servers(names, per_page=2))
+
+        configured = {
+            'server-1': Config.Server(name='server-1'),
+            'server-4': Config.Server(name='server-4'),
+            'server-6': Config.Server(name='server-6'),
+        }
+
+        # Snapshots are consumed as a stream
+        snapshots = (
+            Snapshot(id=100+i, description='', protection=Protection(), created=None,
+                     created_from=Server(id=i % 7, name=''))
+            for i in range(21)
+        )
+
+        with patch.object(config, 'servers', configured):
+            servers = Servers.load_configured_servers(snapshots)
+
+        self.assertEqual(['server-1', 'server-4', 'server-6'], [srv.name for srv in servers.servers])
+        for srv in servers.servers:
+            self.assertIs(srv.config, configured[srv.name], 'Wrong server configuration')
+            self.assertEqual([srv.id + 100 + 7*k for k in range(3)], [sn.id for sn in srv.snapshots],
+                             'Wrong snapshots')
+
+    @parameterized.expand([
+        # Groups that the API can select are listed by one request each
+        [{'web': Config.ServerGroup(label_selector='role=web'), 'db': Config.ServerGroup(name_pattern='db-1')},
+         None, [{'label_selector': ['role=web']}, {'name': ['db-1']}], ['web-1', 'web-2', 'db-1']],
+        # A name pattern alone requires a listing of all servers
+        [{'web': Config.ServerGroup(label_selector='role=web'), 'db': Config.ServerGroup(name_pattern='db-*')},
+         None, [{}], ['web-1', 'web-2', 'db-1', 'db-2']],
+        # Servers selected on the command line are listed by name
+        [{'web': Config.ServerGroup(label_selector='role=web')},
+         ['web-2', 'db-1'], [{'name': ['web-2']}, {'name': ['db-1']}], ['web-2']],
+    ])
+    @Mocker()
+    @patch('hetzner_snap_and_rotate.servers.log')
+    def test_load_server_groups(self, groups: dict, selected: list, expected_queries: list, expected_names: list,
+                                mocked_log, mocker):
+        servers = [
+            {'id': i, 'name': n, 'status': 'running', 'labels': {'role': n.split('-')[0]}}
+            for i, n in enumerate(['web-1', 'web-2', 'db-1', 'db-2', 'other-1'])
+        ]
+
+        def do_serve(request, context):
+            listed = [srv for srv in servers
+                      if request.qs.get('name', [srv['name']])[0] == srv['name']
+                      and request.qs.get('label_selector', [None])[0] in [None, f'role={srv["labels"]["role"]}']]
+            return {'servers': listed, 'meta': {'pagination': {'page': 1, 'next_page': None}}}
+
+        mocker.get(f'{api_base}servers', json=do_serve)
+
+        with patch.object(config, 'servers', {}), patch.object(config, 'server_groups', groups), \
+                patch.object(config, 'selected_servers', selected):
+            loaded = Servers.load_configured_servers()
+
+        queries = [{k: v for k, v in r.qs.items() if k in ['name', 'label_selector']} for r in mocker.request_history]
+        self.assertEqual(expected_queries, queries)
+        self.assertEqual(expected_names, [srv.name for srv in loaded.servers])
+
+    @Mocker()
+    def test_timed_out_action_is_recorded(self, mocker):
+        action = {'id': 1, 'command': 'shutdown', 'status': 'running', 'progress': 0,
+                  'started': '2025-07-01T12:00:00Z', 'finished': None, 'resources': [], 'error': None}
+        mocker.post(f'{api_base}servers/1/actions/shutdown', json={'action': action})
+
+        server = Server(id=1, name='server-1')
+        history = DurationHistory()
+
+        with patch('hetzner_snap_and_rotate.servers.duration_history', history), \
+                patch.object(Action, 'wait_until_completed', side_effect=TimeoutError()):
+            self.assertRaises(TimeoutError, server.perform_action, ServerAction.SHUTDOWN, timeout=1)
+
+        self.assertEqual(1, len(history.durations(1, 'shutdown')))
+        self.assertEqual(3, len(history.samples(1, 'shutdown')[0]))
@@ -0,0 +1,179 @@
+import gc
+import json
+import threading
+import tracemalloc
+
+from datetime import datetime, timedelta, timezone
+from parameterized import parameterized
+from requests_mock import Mocker
+from unittest import TestCase
+from unittest.mock import patch
+
+from hetzner_snap_and_rotate.api import Page
+from hetzner_snap_and_rotate.config import Config, config
+from hetzner_snap_and_rotate.servers import Server
+from hetzner_snap_and_rotate.snapshots import Protection, Snapshot, SnapshotListing, Snapshots, create_snapshot
+
+api_base = 'https://api.hetzner.cloud/v1/'
+
+
+class SnapshotsTest(TestCase):
+
+    empty_page = {'images': [], 'meta': {'pagination': {'page': 1, 'next_page': None}}}
+
+    @parameterized.expand([
+        ({}, None),
+        ({'managed-by': 'snap-and-rotate'}, 'managed-by=snap-and-rotate'),
+        ({'a': 'b', 'c': 'd'}, 'a=b,c=d'),
+    ])
+    @Mocker()
+    def test_load_snapshots_params(self, snapshot_labels: dict, label_selector: str, mocker):
+        mocker.get(f'{api_base}images', json=self.empty_page)
+
+        with patch.object(config, 'snapshot_labels', snapshot_labels):
+            list(Snapshots.iter_snapshots())
+
+        qs = mocker.last_request.qs
+        self.assertEqual(qs['type'], ['snapshot'])
+        self.assertEqual(qs['sort'], ['id:asc'])
+        self.assertEqual(qs['per_page'], ['50'])
+        self.assertEqual(qs.get('label_selector'), [label_selector] if label_selector else None)
+
+    @patch('hetzner_snap_and_rotate.snapshots.log')
+    def test_labels_of_new_snapshot(self, mocked_log):
+        server = Server(id=1, name='server-1', labels={'VERSION': '1.0'})
+        server.config = Config.Server(name='server-1', snapshot_name='{server}')
+
+        with patch.object(config, 'snapshot_labels', {'managed-by': 'snap-and-rotate'}):
+            with patch.object(config, 'dry_run', True, create=True):
+                snapshot = create_snapshot(server)
+
+        self.assertEqual(snapshot.labels, {'VERSION': '1.0', 'managed-by': 'snap-and-rotate'})
+
+    @patch('hetzner_snap_and_rotate.snapshots.log')
+    def test_period_labels_of_new_snapshot(self, mocked_log):
+        server = Server(id=1, name='server-1')
+        server.config = Config.Server(name='server-1', snapshot_name='{server}', rotation_labels=True,
+                                      daily=7, weekly=0, yearly=1)
+
+        with patch.object(config, 'dry_run', True, create=True):
+            snapshot = create_snapshot(server)
+
+        self.assertEqual({'snap-and-rotate/daily', 'snap-and-rotate/yearly'}, set(snapshot.labels))
+        self.assertEqual(str(snapshot.created.astimezone(timezone.utc).year),
+                         snapshot.labels['snap-and-rotate/yearly'])
+
+    def test_period_labels_in_utc(self):
+        server = Server(id=1, name='server-1')
+        server.config = Config.Server(name='server-1', snapshot_name='{server}', rotation_labels=True, daily=7)
+        created = datetime(2025, 7, 1, 23, 30, tzinfo=timezone.utc)
+
+        with patch.object(config, 'local_tz', timezone(timedelta(hours=2)), create=True):
+            labels = Snapshot.period_labels(server, created)
+
+        self.assertEqual({'snap-and-rotate/daily': '2025-07-01'}, labels)
+
+    def test_listing_is_loaded_once(self):
+        loads = []
+        started = threading.Barrier(4)
+
+        def load():
+            loads.append(1)
+            return [Snapshot(id=100 + i, description='', protection=Protection(), created=None,
+                             created_from=Server(id=i % 2, name='')) for i in range(4)]
+
+        listing = SnapshotListing(load)
+        self.assertFalse(listing.loaded)
+
+        def attach(srv: Server):
+            started.wait()
+            listing.attach(srv)
+
+        servers = [Server(id=i % 2, name=f'server-{i}') for i in range(4)]
+        servers[0].snapshots = [Snapshot(id=102, description='new', protection=Protection(), created=None,
+                                         created_from=servers[0])]
+
+        threads = [threading.Thread(target=attach, args=(srv,)) for srv in servers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual([1], loads)
+        self.assertTrue(listing.loaded)
+
+        # A snapshot that is also listed is not attached twice
+        self.assertEqual([100, 102], [sn.id for sn in servers[0].snapshots])
+        self.assertEqual('new', servers[0].snapshots[1].description)
+        self.assertEqual([101, 103], [sn.id for sn in servers[1].snapshots])
+
+    def test_listing_skips_repeated_snapshots(self):
+        # Snapshot 101 moved to the next page while the listing was paged through
+        listing = SnapshotListing(lambda: [
+            Snapshot(id=i, description='', protection=Protection(), created=None, created_from=Server(id=1, name=''))
+            for i in [100, 101, 101, 102]
+        ])
+
+        self.assertEqual([100, 101, 102], [sn.id for sn in listing.of_server(1)])
+
+    def test_listing_failure_is_not_repeated(self):
+        loads = []
+
+        def load():
+            loads.append(1)
+            raise TimeoutError()
+
+        listing = SnapshotListing(load)
+        for i in range(2):
+            with self.assertRaises(TimeoutError):
+                listing.of_server(i)
+
+        self.assertEqual([1], loads)
+        self.assertFalse(listing.loaded)
+
+    @Mocker()
+    def test_footprint(self, mocker):
+        count = 10000
+        per_page = Page.max_per_page
+        last_page = count // per_page
+
+        def serve_page(request, context):
+            page = int(request.qs['page'][0])
+            return json.dumps({
+                'images': [
+                    {
+                        'id': 1000000 + i,
+                        'description': f'server-{i % 80}_daily#{i % 7}_2025-07-01_12:34:56',
+                        'created': f'2025-07-{1 + i % 28:02}T12:34:{i % 60:02}.{i % 1000}Z',
+                        'created_from': {'id': 4000 + i % 80, 'name': f'server-{i % 80}'},
+                        'protection': {'delete': False},
+                        'labels': {'VERSION': '1.2.3'},
+                    }
+                    for i in range((page - 1) * per_page, page * per_page)
+                ],
+                'meta': {'pagination': {'page': page, 'next_page': page + 1 if page < last_page else None,
+                                        'last_page': last_page}}
+            })
+
+        mocker.get(f'{api_base}images', text=serve_page)
+
+        gc.collect()
+        tracemalloc.start()
+
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            by_server = SnapshotListing().snapshots_by_server()
+            gc.collect()
+            per_snapshot = (tracemalloc.get_traced_memory()[0] - before) / count
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(last_page, mocker.call_count)
+        self.assertEqual(count, sum(len(snapshots) for snapshots in by_server.values()))
+
+        # Snapshots of a server on the first and on the last page share their source server and labels
+        first, last = by_server[4000][0], by_server[4000][-1]
+        self.assertIs(first.created_from, last.created_from, 'Servers not shared across pages')
+        self.assertIs(first.labels, last.labels, 'Labels not shared across pages')
+        self.assertFalse(hasattr(first, '__dict__'), 'Snapshot has a __dict__')
+        self.assertLess(per_snapshot, 400, f'{per_snapshot:.0f} bytes per snapshot')